@@ -9,6 +9,7 @@ import sys
 import json
 from datetime import datetime
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 class ZentiumAPITester:
     def __init__(self, base_url="https://90308466-a382-4768-a654-5790138beb2d.preview.emergentagent.com"):
@@ -286,6 +287,62 @@ class ZentiumAPITester:
         
         return success
     
+    def test_request_coalescing(self, concurrency=25):
+        """Stress test: concurrent identical reads share Mongo queries and return the same data"""
+        if not self.professional_id or not self.patient_id:
+            self.log("No professional/patient ID available", "ERROR")
+            return False
+            
+        self.tests_run += 1
+        self.log(f"Testing Request Coalescing with {concurrency} concurrent requests per endpoint...")
+        endpoints = {
+            "professional_dashboard": f"professionals/{self.professional_id}/dashboard",
+            "patients_cache": f"patients/{self.patient_id}/profile",
+            "chat_history": f"chat/{self.patient_id}/history",
+        }
+        
+        def fetch(endpoint):
+            response = requests.get(f"{self.api_url}/{endpoint}", timeout=30)
+            body = response.json()
+            return response.status_code, json.dumps(body, sort_keys=True)
+        
+        try:
+            before = requests.get(f"{self.api_url}/analytics/request-coalescing", timeout=10).json()
+            results = {}
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                for name, endpoint in endpoints.items():
+                    results[name] = list(pool.map(fetch, [endpoint] * concurrency))
+            after = requests.get(f"{self.api_url}/analytics/request-coalescing", timeout=10).json()
+        except Exception as e:
+            self.log(f"❌ Request Coalescing - Error: {str(e)}", "FAIL")
+            return False
+        
+        success = True
+        dashboard = json.loads(results["professional_dashboard"][0][1])
+        if "patients_count" not in dashboard:
+            self.log("❌ professional_dashboard: not served by the single-flight dashboard handler", "FAIL")
+            success = False
+        for name, responses in results.items():
+            if {status for status, _ in responses} != {200}:
+                self.log(f"❌ {name}: some concurrent requests failed", "FAIL")
+                success = False
+            if len({body for _, body in responses}) != 1:
+                self.log(f"❌ {name}: concurrent responses differ", "FAIL")
+                success = False
+            # Counters are per worker: run the API with a single worker for this test.
+            # Cache hits never reach single-flight, so compare queries with HTTP requests
+            calls = after.get(name, {}).get("calls", 0) - before.get(name, {}).get("calls", 0)
+            queries = after.get(name, {}).get("queries", 0) - before.get(name, {}).get("queries", 0)
+            self.log(f"{name}: {concurrency} requests, {calls} calls -> {queries} query executions")
+            if queries >= concurrency:
+                self.log(f"❌ {name}: {queries} Mongo queries for {concurrency} requests, nothing was coalesced", "FAIL")
+                success = False
+        
+        if success:
+            self.tests_passed += 1
+            self.log("✅ Request Coalescing - identical responses with fewer Mongo queries", "PASS")
+        return success
+    
     def run_all_tests(self):
         """Run all API tests"""
         self.log("🚀 Starting Zentium Assist API Tests")
@@ -302,6 +359,7 @@ class ZentiumAPITester:
             ("Crisis Detection", self.test_crisis_detection),
             ("Create & Complete Task", self.test_create_task),
             ("Chat History", self.test_chat_history),
+            ("Request Coalescing", self.test_request_coalescing),
             ("Analytics Dashboard", self.test_analytics_dashboard),
         ]
         
@@ -162,8 +162,12 @@ const ProfessionalDashboard = () => {
       const user = JSON.parse(localStorage.getItem("user"));
       if (!user?.profile?.id) return;
 
-      const response = await axios.get(`${API}/professionals/${user.profile.id}/dashboard`);
-      setDashboardData(response.data);
+      // Crisis alerts come already joined with the patient summary and the conversation around them
+      const [response, alertsResponse] = await Promise.all([
+        axios.get(`${API}/professionals/${user.profile.id}/dashboard`),
+        axios.get(`${API}/professionals/${user.profile.id}/crisis-alerts`)
+      ]);
+      setDashboardData({ ...response.data, crisis_alerts: alertsResponse.data });
     } catch (error) {
       console.error("Error loading dashboard:", error);
     }
@@ -188,30 +192,13 @@ const ProfessionalDashboard = () => {
     }
   };
 
-  const showCrisisDetail = async (alert) => {
-    try {
-      // Get patient information
-      const patientResponse = await axios.get(`${API}/patients/${alert.patient_id}/profile`);
-      
-      // Get recent chat history for context
-      const chatResponse = await axios.get(`${API}/chat/${alert.patient_id}/history?limit=10`);
-      
-      setSelectedCrisis({
-        ...alert,
-        patient: patientResponse.data,
-        chatHistory: chatResponse.data
-      });
-      setShowCrisisDetails(true);
-    } catch (error) {
-      console.error("Error loading crisis details:", error);
-      // Show basic crisis info even if we can't load additional details
-      setSelectedCrisis({
-        ...alert,
-        patient: { id: alert.patient_id, age: "Desconocido", gender: "No disponible" },
-        chatHistory: []
-      });
-      setShowCrisisDetails(true);
-    }
+  const showCrisisDetail = (alert) => {
+    setSelectedCrisis({
+      ...alert,
+      patient: alert.patient || { id: alert.patient_id, age: "Desconocido", gender: "No disponible" },
+      chatHistory: alert.context || []
+    });
+    setShowCrisisDetails(true);
   };
 
   const logout = () => {
@@ -720,15 +707,24 @@ const PatientInterface = () => {
         return;
       }
 
-      // Load all patient data
-      await Promise.all([
-        loadChatHistory(patientId),
-        loadTasks(patientId),
-        loadPatientProfile(patientId),
-        loadSessions(patientId)
-      ]);
+      // Load all patient data in one request; only failed sections are fetched again
+      const response = await axios.get(`${API}/patients/${patientId}/home`);
+      const { profile, chat, tasks, sessions, errors } = response.data;
+      if (errors.profile) loadPatientProfile(patientId); else setPatientProfile(profile);
+      if (errors.chat) loadChatHistory(patientId); else setChatMessages(chat);
+      if (errors.tasks) loadTasks(patientId); else setTasks(tasks);
+      if (errors.sessions) loadSessions(patientId); else setSessions(sessions);
     } catch (error) {
       console.error("Error loading patient data:", error);
+      const patientId = JSON.parse(localStorage.getItem("user"))?.profile?.id;
+      if (patientId) {
+        await Promise.all([
+          loadChatHistory(patientId),
+          loadTasks(patientId),
+          loadPatientProfile(patientId),
+          loadSessions(patientId)
+        ]);
+      }
     }
   };
 
@@ -0,0 +1,36 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+API_DIR = Path(__file__).resolve().parent.parent / "zentiumassist" / "api"
+sys.path.insert(0, str(API_DIR))
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """`server` con una base de datos mongomock-motor en lugar de MongoDB"""
+    from mongomock_motor import AsyncMongoMockClient
+
+    import server
+    from repositories import mongo_repositories
+    from tenancy import TenantDatabase, TenantRouter
+
+    client = AsyncMongoMockClient()
+    router = TenantRouter(client, "zentium_test")
+    db = TenantDatabase(router)
+    stale_db = TenantDatabase(router, stale=True)
+    monkeypatch.setattr(server, "client", client)
+    monkeypatch.setattr(server, "tenant_router", router)
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "stale_db", stale_db)
+    monkeypatch.setattr(server, "repos", mongo_repositories(db, stale_db))
+    return server
+
+
+@pytest.fixture
+def http(api):
+    """Fábrica de clientes httpx contra la app ASGI, sin red"""
+    import httpx
+
+    return lambda: httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url="http://testserver")
@@ -0,0 +1,50 @@
+import asyncio
+from datetime import datetime
+
+from http_cache import CompressionMiddleware, preferred_encodings
+
+BOTH = ("br", "gzip")
+
+
+def test_preferred_encodings_honours_q_values():
+    assert preferred_encodings("gzip, br", BOTH) == ["br", "gzip"]
+    assert preferred_encodings("br;q=0.5, gzip", BOTH) == ["gzip", "br"]
+    assert preferred_encodings("br;q=0, gzip", BOTH) == ["gzip"]
+    assert preferred_encodings("gzip;q=0", BOTH) == []
+    assert preferred_encodings("*;q=0.2, gzip;q=0", BOTH) == ["br"]
+    assert preferred_encodings("identity", BOTH) == []
+    assert preferred_encodings("br;q=abc, gzip", BOTH) == ["gzip"]
+
+
+def test_compression_skips_codings_with_q_zero():
+    middleware = CompressionMiddleware(app=None)
+    assert middleware._choose_encoding("gzip;q=0") is None
+    assert middleware._choose_encoding("br;q=0, gzip;q=0.8") == "gzip"
+
+
+def _task(task_id: str, patient_id: str) -> dict:
+    now = datetime.utcnow()
+    return {
+        "id": task_id, "patient_id": patient_id, "professional_id": "pro-1", "title": "Respiración",
+        "description": "Cinco minutos", "task_type": "exercise", "status": "assigned",
+        "created_at": now, "updated_at": now,
+    }
+
+
+def test_tasks_etag_changes_when_a_task_is_updated(api, http):
+    async def scenario():
+        await api.repos.tasks.create(_task("task-1", "patient-1"))
+        async with http() as client:
+            first = await client.get("/api/patients/patient-1/tasks")
+            assert first.status_code == 200
+            etag = first.headers["etag"]
+            cached = await client.get("/api/patients/patient-1/tasks", headers={"If-None-Match": etag})
+            assert cached.status_code == 304
+
+            await api.repos.tasks.complete("task-1", "Hecha", datetime.utcnow())
+            fresh = await client.get("/api/patients/patient-1/tasks", headers={"If-None-Match": etag})
+            assert fresh.status_code == 200
+            assert fresh.headers["etag"] != etag
+            assert fresh.json()[0]["status"] == "completed"
+
+    asyncio.run(scenario())
@@ -0,0 +1,75 @@
+import asyncio
+import json
+from datetime import datetime
+
+import llm_usage
+from llm_usage import UsageLedger, _today
+from task_scheduler import TaskScheduler
+
+
+class FakeChat:
+    def __init__(self, api_key, session_id, system_message):
+        self.system_message = system_message
+
+    def with_model(self, provider, model):
+        return self
+
+    async def send_message(self, message):
+        return json.dumps({item["id"]: "¡Muy bien!" for item in json.loads(message.text)})
+
+
+class FakeMessage:
+    def __init__(self, text):
+        self.text = text
+
+
+def test_task_feedback_usage_is_charged_to_the_task_owner(api, monkeypatch):
+    ledger = UsageLedger()
+    monkeypatch.setattr(api, "llm_usage", ledger)
+    monkeypatch.setattr(api, "_llm_classes", (FakeChat, FakeMessage))
+    shared = api.tenant_router.shared
+
+    async def scenario():
+        now = datetime.utcnow()
+        await api.db.tasks.insert_one({
+            "id": "task-1", "patient_id": "patient-1", "professional_id": "pro-1", "title": "Diario",
+            "description": "Tres líneas", "task_type": "reflection", "status": "completed",
+            "completion_notes": "Hecho", "completed_at": now, "ai_feedback_pending": True,
+        })
+        await TaskScheduler(api.db, api.generate_tasks_feedback)._process_feedback(["task-1"])
+        assert (await api.db.tasks.find_one({"id": "task-1"}))["ai_feedback"] == "¡Muy bien!"
+
+        await ledger.flush(shared)
+        rows = await shared.llm_usage.find({"endpoint": "task_feedback"}).to_list(None)
+        assert [(row["patient_id"], row["professional_id"]) for row in rows] == [("patient-1", "pro-1")]
+        assert rows[0]["total_tokens"] > 0
+
+    asyncio.run(scenario())
+
+
+class FakeChatReply(FakeChat):
+    async def send_message(self, message):
+        return "neutral"
+
+
+def test_chat_stops_at_the_daily_token_budget(api, http, monkeypatch):
+    monkeypatch.setattr(api, "_llm_classes", (FakeChatReply, FakeMessage))
+    monkeypatch.setattr(api, "enforce_llm_budget", lambda db, patient_id: llm_usage.enforce_llm_budget(db, patient_id, 1000))
+    shared = api.tenant_router.shared
+
+    async def scenario():
+        await api.db.patients.insert_one({"id": "budget-1", "user_id": "user-1", "professional_id": "pro-1"})
+        async with http() as client:
+            send = lambda text: client.post("/api/chat/budget-1/message", json={"message": text})
+            assert (await send("Hoy dormí mejor")).status_code == 200
+
+            await shared.llm_usage.insert_one({
+                "_id": "seed", "day": _today(), "patient_id": "budget-1", "total_tokens": 1000,
+            })
+            over = await send("Hoy dormí mejor")
+            assert over.status_code == 429
+            assert int(over.headers["Retry-After"]) > 0
+            # Una crisis pasa aunque el presupuesto esté agotado
+            assert (await send("quiero morir")).status_code == 200
+
+    asyncio.run(scenario())
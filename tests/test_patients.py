@@ -0,0 +1,48 @@
+import asyncio
+
+
+def _record_creates(api, monkeypatch) -> list:
+    created = []
+    create = api.repos.patients.create
+
+    async def recording_create(patient):
+        created.append(patient["id"])
+        await create(patient)
+
+    monkeypatch.setattr(api.repos.patients, "create", recording_create)
+    return created
+
+
+def test_patient_registration_goes_through_the_repository(api, http, monkeypatch):
+    created = _record_creates(api, monkeypatch)
+
+    async def scenario():
+        async with http() as client:
+            response = await client.post("/api/auth/register", json={
+                "email": "ana@example.com", "name": "Ana", "password": "password123", "role": "patient"
+            })
+            assert response.status_code == 200
+        patient = await api.repos.patients.get(created[0])
+        assert patient["user_id"] == response.json()["id"]
+
+    asyncio.run(scenario())
+    assert len(created) == 1
+
+
+def test_professional_creates_patient_through_the_repository(api, http, monkeypatch):
+    created = _record_creates(api, monkeypatch)
+
+    async def scenario():
+        await api.db.professionals.insert_one({
+            "id": "pro-1", "user_id": "user-1", "license_number": "L-1",
+            "specialization": "Psicología Clínica", "institution": "Zentium Assist",
+        })
+        async with http() as client:
+            response = await client.post("/api/professionals/pro-1/patients", json={
+                "age": 30, "gender": "Femenino", "emergency_contact": "+34 600 000 000", "professional_id": "pro-1"
+            })
+            assert response.status_code == 201
+        assert created == [response.json()["id"]]
+        assert (await api.repos.patients.get(created[0]))["professional_id"] == "pro-1"
+
+    asyncio.run(scenario())
@@ -0,0 +1,89 @@
+import asyncio
+from ipaddress import ip_network
+
+from starlette.requests import Request
+
+from rate_limit import RateLimiter, client_ip
+
+PROXIES = [ip_network("10.0.0.0/8"), ip_network("127.0.0.1/32")]
+
+
+class FakeChat:
+    def __init__(self, api_key, session_id, system_message):
+        self.system_message = system_message
+
+    def with_model(self, provider, model):
+        return self
+
+    async def send_message(self, message):
+        return "neutral"
+
+
+class FakeMessage:
+    def __init__(self, text):
+        self.text = text
+
+
+def _request(peer: str, forwarded: str = None) -> Request:
+    headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+    return Request({"type": "http", "headers": headers, "client": (peer, 50000)})
+
+
+def test_forwarded_for_is_ignored_from_untrusted_peers():
+    assert client_ip(_request("203.0.113.7", "198.51.100.1"), PROXIES) == "203.0.113.7"
+
+
+def test_forwarded_for_takes_the_rightmost_untrusted_address():
+    request = _request("10.0.0.2", "1.2.3.4, 198.51.100.1, 10.0.0.5")
+    assert client_ip(request, PROXIES) == "198.51.100.1"
+    assert client_ip(_request("10.0.0.2", "10.0.0.9, 10.0.0.5"), PROXIES) == "10.0.0.2"
+    assert client_ip(_request("10.0.0.2", "198.51.100.1, not-an-ip"), PROXIES) == "10.0.0.2"
+
+
+async def _insert_patients(api, professional_id: str, *patient_ids: str):
+    await api.db.patients.insert_many([
+        {"id": patient_id, "user_id": f"user-{patient_id}", "professional_id": professional_id}
+        for patient_id in patient_ids
+    ])
+
+
+def test_chat_is_limited_per_professional(api, http, monkeypatch):
+    monkeypatch.setattr(api, "rate_limiter", RateLimiter({"patient": 10, "professional": 3, "ip": 10}, backend="memory"))
+    monkeypatch.setattr(api, "_llm_classes", (FakeChat, FakeMessage))
+
+    async def scenario():
+        await _insert_patients(api, "pro-rl", "rl-1", "rl-2", "rl-3", "rl-4")
+        async with http() as client:
+            statuses = [
+                (await client.post(f"/api/chat/{patient_id}/message", json={"message": "Hoy estoy algo cansado"})).status_code
+                for patient_id in ("rl-1", "rl-2", "rl-3", "rl-4")
+            ]
+            assert statuses == [200, 200, 200, 429]
+            # Los indicios de crisis nunca se limitan
+            crisis = await client.post("/api/chat/rl-4/message", json={"message": "quiero morir"})
+            assert crisis.status_code == 200
+
+    asyncio.run(scenario())
+
+
+def test_chat_ip_limit_uses_forwarded_for_from_trusted_proxy(api, http, monkeypatch):
+    # El cliente de pruebas conecta desde 127.0.0.1, proxy de confianza por defecto
+    monkeypatch.setattr(api, "rate_limiter", RateLimiter({"patient": 10, "professional": 10, "ip": 2}, backend="memory"))
+    monkeypatch.setattr(api, "_llm_classes", (FakeChat, FakeMessage))
+
+    async def scenario():
+        await _insert_patients(api, "pro-ip", "ip-1")
+
+        async def send(forwarded: str) -> int:
+            response = await client.post(
+                "/api/chat/ip-1/message", json={"message": "Hola"}, headers={"X-Forwarded-For": forwarded}
+            )
+            return response.status_code
+
+        async with http() as client:
+            assert [await send("198.51.100.1") for _ in range(3)] == [200, 200, 429]
+            assert await send("198.51.100.2") == 200
+            # Lo que el cliente escribe a la izquierda no evita el límite
+            assert await send("192.0.2.99, 198.51.100.1") == 429
+
+    asyncio.run(scenario())
@@ -0,0 +1,78 @@
+import asyncio
+
+import numpy as np
+from mongomock_motor import AsyncMongoMockClient
+
+import session_vectors
+from session_vectors import VECTOR_DIM, SessionIndex, SessionIndexRegistry, store_session_vector
+
+
+def _vectors(n: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    # Vectores no negativos: todas las similitudes son positivas
+    return np.abs(rng.normal(size=(n, VECTOR_DIM))).astype(np.float32)
+
+
+def _index(n: int) -> SessionIndex:
+    return SessionIndex([f"s{i}" for i in range(n)], [f"p{i % 3}" for i in range(n)], _vectors(n))
+
+
+def test_exclude_still_returns_k_results():
+    index = _index(10)
+    query = index.vectors[0] / index.idf
+    hits = index.query(query, 3, exclude="s0")
+    assert len(hits) == 3
+    assert "s0" not in {hit["session_id"] for hit in hits}
+
+
+def test_upsert_adds_and_replaces_without_rebuilding():
+    index = _index(10)
+    new = _vectors(1, seed=1)[0]
+    index.upsert("s-new", "p9", new)
+    assert index.query(new, 1)[0]["session_id"] == "s-new"
+    assert index.query(new, 1, patient_id="p9")[0]["session_id"] == "s-new"
+
+    replacement = index.vectors[4] / index.idf
+    index.upsert("s-new", "p9", replacement)
+    assert len(index.ids) == 11
+    assert {hit["session_id"] for hit in index.query(replacement, 2)} == {"s-new", "s4"}
+    assert index.changes == 2
+
+
+def test_upsert_moves_the_row_between_ivf_lists(monkeypatch):
+    monkeypatch.setattr(session_vectors, "EXACT_SEARCH_LIMIT", 50)
+    index = _index(200)
+    assert index.centroids is not None
+
+    for i, vector in enumerate(_vectors(40, seed=2)):
+        index.upsert(f"s{i % 20}" if i % 2 else f"extra{i}", "p0", vector)
+    rows = np.concatenate(index.lists)
+    # Cada sesión está exactamente en una lista, la de su centroide más cercano
+    assert sorted(rows.tolist()) == list(range(len(index.ids)))
+    for number, members in enumerate(index.lists):
+        for row in members:
+            assert index._nearest_list(index.vectors[row]) == number
+
+
+def test_registry_updates_in_place_and_rebuilds_on_drift(monkeypatch):
+    db = AsyncMongoMockClient()["zentium_test"]
+    registry = SessionIndexRegistry(ttl=3600)
+    monkeypatch.setattr(session_vectors, "session_indexes", registry)
+    vectors = _vectors(10)
+
+    async def scenario():
+        for i, vector in enumerate(vectors[:5]):
+            await store_session_vector(db, {"id": f"s{i}", "professional_id": "pro", "patient_id": "p"}, vector, None)
+        index = await registry.get(db, "pro")
+        assert len(index.ids) == 5
+
+        await store_session_vector(db, {"id": "s5", "professional_id": "pro", "patient_id": "p"}, vectors[5], None)
+        assert await registry.get(db, "pro") is index
+        assert "s5" in index.position
+
+        await store_session_vector(db, {"id": "s6", "professional_id": "pro", "patient_id": "p"}, vectors[6], None)
+        rebuilt = await registry.get(db, "pro")
+        assert rebuilt is not index
+        assert rebuilt.changes == 0 and len(rebuilt.ids) == 7
+
+    asyncio.run(scenario())
@@ -0,0 +1,106 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from mongomock_motor import AsyncMongoMockClient
+
+import task_scheduler
+from task_scheduler import FEEDBACK_MAX_ATTEMPTS, FEEDBACK_SWEEP_MINUTES, TaskScheduler
+
+
+def _completed_task(task_id: str, minutes_ago: float) -> dict:
+    completed_at = datetime.utcnow() - timedelta(minutes=minutes_ago)
+    return {
+        "id": task_id, "patient_id": "patient-1", "professional_id": "pro-1", "title": "Diario",
+        "description": "Tres líneas", "task_type": "reflection", "status": "completed",
+        "completion_notes": "Hecho", "completed_at": completed_at, "ai_feedback_pending": True,
+        "created_at": completed_at, "updated_at": completed_at,
+    }
+
+
+def test_failed_feedback_backs_off_and_gives_up():
+    db = AsyncMongoMockClient()["zentium_test"]
+
+    async def no_feedback(tasks):
+        return {}
+
+    async def scenario():
+        scheduler = TaskScheduler(db, no_feedback)
+        await db.tasks.insert_one(_completed_task("task-1", FEEDBACK_SWEEP_MINUTES + 1))
+
+        await scheduler._process_feedback(["task-1"])
+        task = await db.tasks.find_one({"id": "task-1"})
+        assert task["ai_feedback_attempts"] == 1
+        assert task["ai_feedback_pending"] is True
+        assert task["ai_feedback_retry_at"] > datetime.utcnow()
+        # Sin llegar su reintento, el barrido no la reencola
+        assert await scheduler._sweep_feedback() == {"requeued": 0}
+
+        for _ in range(FEEDBACK_MAX_ATTEMPTS - 1):
+            await db.tasks.update_one({"id": "task-1"}, {"$set": {"ai_feedback_retry_at": datetime.utcnow()}})
+            assert await scheduler._sweep_feedback() == {"requeued": 1}
+            scheduler._feedback_pending.clear()
+            await scheduler._process_feedback(["task-1"])
+
+        task = await db.tasks.find_one({"id": "task-1"})
+        assert task["ai_feedback_attempts"] == FEEDBACK_MAX_ATTEMPTS
+        assert task["ai_feedback_failed"] is True
+        assert "ai_feedback_pending" not in task
+        assert await scheduler._sweep_feedback() == {"requeued": 0}
+        assert scheduler.stats["feedback_failed"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_generator_errors_count_as_attempts(monkeypatch):
+    monkeypatch.setattr(task_scheduler, "FEEDBACK_MAX_ATTEMPTS", 1)
+    db = AsyncMongoMockClient()["zentium_test"]
+
+    async def broken(tasks):
+        raise RuntimeError("LLM caído")
+
+    async def scenario():
+        await db.tasks.insert_one(_completed_task("task-1", 0))
+        await TaskScheduler(db, broken)._process_feedback(["task-1"])
+        task = await db.tasks.find_one({"id": "task-1"})
+        assert task["ai_feedback_failed"] is True
+        assert "ai_feedback_pending" not in task
+
+    asyncio.run(scenario())
+
+
+def test_successful_feedback_clears_retry_state():
+    db = AsyncMongoMockClient()["zentium_test"]
+
+    async def feedback(tasks):
+        return {task["id"]: "¡Buen trabajo!" for task in tasks}
+
+    async def scenario():
+        task = _completed_task("task-1", 0)
+        task.update(ai_feedback_attempts=2, ai_feedback_retry_at=datetime.utcnow())
+        await db.tasks.insert_one(task)
+        await TaskScheduler(db, feedback)._process_feedback(["task-1"])
+        task = await db.tasks.find_one({"id": "task-1"})
+        assert task["ai_feedback"] == "¡Buen trabajo!"
+        for field in ("ai_feedback_pending", "ai_feedback_attempts", "ai_feedback_retry_at"):
+            assert field not in task
+
+    asyncio.run(scenario())
+
+
+def test_reminder_changes_the_tasks_etag(api, http):
+    async def scenario():
+        now = datetime.utcnow()
+        await api.db.tasks.insert_one({
+            "id": "task-1", "patient_id": "patient-1", "professional_id": "pro-1", "title": "Paseo",
+            "description": "Veinte minutos", "task_type": "exercise", "status": "assigned",
+            "due_date": now + timedelta(hours=2), "reminder_sent_at": None,
+            "created_at": now - timedelta(days=1), "updated_at": now - timedelta(days=1),
+        })
+        async with http() as client:
+            etag = (await client.get("/api/patients/patient-1/tasks")).headers["etag"]
+            await TaskScheduler(api.db, None)._send_reminders(["task-1"], datetime.utcnow())
+            response = await client.get("/api/patients/patient-1/tasks", headers={"If-None-Match": etag})
+            assert response.status_code == 200
+            assert response.json()[0]["reminder_sent_at"] is not None
+
+    asyncio.run(scenario())
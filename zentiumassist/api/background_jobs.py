@@ -0,0 +1,44 @@
+"""
+Utilidades para tareas periódicas en segundo plano.
+
+Cada tarea toma una concesión (lease) en Mongo antes de ejecutarse, de modo
+que con varios workers solo uno la ejecuta en cada intervalo.
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable
+
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+
+async def acquire_job_lease(db, job: str, hold: timedelta) -> bool:
+    """Toma la concesión de `job` durante `hold` si nadie la tiene vigente"""
+    now = datetime.utcnow()
+    try:
+        await db.job_leases.find_one_and_update(
+            {"_id": job, "locked_until": {"$lt": now}},
+            {"$set": {"locked_until": now + hold}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Otro worker tiene la concesión vigente
+        return False
+    return True
+
+
+async def run_periodic(db, job: str, interval: timedelta, run: Callable[[], Awaitable[Any]]):
+    """Ejecuta `run` cada `interval` mientras la app está activa"""
+    while True:
+        try:
+            if await acquire_job_lease(db, job, interval):
+                summary = await run()
+                logger.info(f"Job {job} completed: {summary}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error in job {job}: {e}")
+        await asyncio.sleep(interval.total_seconds())
@@ -0,0 +1,163 @@
+"""
+Almacenamiento por niveles (caliente/frío) de `chat_messages`.
+
+Los mensajes con más de `CHAT_ARCHIVE_AFTER_DAYS` días se empaquetan en
+buckets comprimidos por paciente y mes dentro de `chat_archive`, de modo que
+la colección caliente y sus índices se mantienen pequeños. El historial se
+lee de ambos niveles de forma transparente. Ambos guardan los mensajes en la
+forma compacta de `storage_codec` y los devuelven ya decodificados.
+"""
+
+import os
+import zlib
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import bson
+from pymongo import ASCENDING, DESCENDING, ReplaceOne
+
+from background_jobs import run_periodic
+from risk_scoring import RECENT_CRISIS_DAYS, RISK_LOOKBACK_DAYS
+from storage_codec import decode_chat_message, decode_uuid, encode_chat_message, id_filter
+
+# La puntuación de riesgo y las alertas de crisis solo leen la colección caliente:
+# nunca se archiva nada dentro de sus ventanas
+MIN_ARCHIVE_AFTER_DAYS = max(RISK_LOOKBACK_DAYS, RECENT_CRISIS_DAYS) + 1
+ARCHIVE_AFTER_DAYS = max(int(os.environ.get("CHAT_ARCHIVE_AFTER_DAYS", "90")), MIN_ARCHIVE_AFTER_DAYS)
+ARCHIVE_INTERVAL_HOURS = float(os.environ.get("CHAT_ARCHIVE_INTERVAL_HOURS", "6"))
+ARCHIVE_BATCH_SIZE = 5000
+COMPRESSION_LEVEL = 6
+
+
+def encode_bucket(messages: List[Dict[str, Any]]) -> bytes:
+    """Serializa los mensajes en BSON (conserva fechas) y los comprime"""
+    return zlib.compress(bson.encode({"messages": messages}), COMPRESSION_LEVEL)
+
+
+def decode_bucket(bucket: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [decode_chat_message(m) for m in bson.decode(zlib.decompress(bucket["payload"]))["messages"]]
+
+
+def _bucket_month(timestamp: datetime) -> str:
+    return timestamp.strftime("%Y-%m")
+
+
+def build_buckets(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Agrupa mensajes (ordenados por fecha) en buckets por paciente y mes"""
+    groups: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+    for message in messages:
+        message.pop("_id", None)
+        message = encode_chat_message(message)
+        key = (message["patient_id"], _bucket_month(message["timestamp"]))
+        groups.setdefault(key, []).append(message)
+
+    buckets = []
+    for (patient_id, month), items in groups.items():
+        buckets.append({
+            # El id depende del primer mensaje: reintentar el mismo lote no duplica buckets
+            "_id": f"{decode_uuid(patient_id)}:{month}:{decode_uuid(items[0]['id'])}",
+            "patient_id": patient_id,
+            "month": month,
+            "first_ts": items[0]["timestamp"],
+            "last_ts": items[-1]["timestamp"],
+            "count": len(items),
+            "crisis_count": sum(1 for m in items if m.get("is_crisis")),
+            "payload": bson.Binary(encode_bucket(items)),
+            "archived_at": datetime.utcnow()
+        })
+    return buckets
+
+
+async def archive_old_messages(db, older_than_days: int = ARCHIVE_AFTER_DAYS, batch_size: int = ARCHIVE_BATCH_SIZE) -> Dict[str, Any]:
+    """
+    Mueve los mensajes antiguos de `chat_messages` a `chat_archive`.
+
+    Procesa lotes ordenados por fecha: primero escribe los buckets y después
+    borra los originales, así un fallo a mitad nunca pierde mensajes.
+    """
+    if older_than_days < MIN_ARCHIVE_AFTER_DAYS:
+        raise ValueError(f"older_than_days must be at least {MIN_ARCHIVE_AFTER_DAYS}")
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    moved = 0
+    buckets_written = 0
+    while True:
+        batch = await db.chat_messages.find(
+            {"timestamp": {"$lt": cutoff}}
+        ).sort("timestamp", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+
+        hot_ids = [message["_id"] for message in batch]
+        buckets = build_buckets(batch)
+        await db.chat_archive.bulk_write(
+            [ReplaceOne({"_id": bucket["_id"]}, bucket, upsert=True) for bucket in buckets],
+            ordered=False
+        )
+        await db.chat_messages.delete_many({"_id": {"$in": hot_ids}})
+        moved += len(hot_ids)
+        buckets_written += len(buckets)
+
+    return {"moved": moved, "buckets": buckets_written, "cutoff": cutoff}
+
+
+async def read_archived_messages(db, patient_id: str, before: Optional[datetime], limit: int) -> List[Dict[str, Any]]:
+    """Devuelve hasta `limit` mensajes archivados anteriores a `before`, del más reciente al más antiguo"""
+    query: Dict[str, Any] = {"patient_id": id_filter(patient_id)}
+    if before:
+        query["first_ts"] = {"$lt": before}
+
+    messages: List[Dict[str, Any]] = []
+    cursor = db.chat_archive.find(query).sort("last_ts", -1)
+    async for bucket in cursor:
+        items = [m for m in decode_bucket(bucket) if before is None or m["timestamp"] < before]
+        items.sort(key=lambda m: m["timestamp"], reverse=True)
+        messages.extend(items)
+        if len(messages) >= limit:
+            break
+    return messages[:limit]
+
+
+async def read_chat_history(db, patient_id: str, limit: int, before: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """Historial del más reciente al más antiguo, leyendo del nivel frío si el caliente no alcanza"""
+    query: Dict[str, Any] = {"patient_id": id_filter(patient_id)}
+    if before:
+        query["timestamp"] = {"$lt": before}
+    messages = [
+        decode_chat_message(doc)
+        for doc in await db.chat_messages.find(query, {"_id": 0}).sort("timestamp", -1).limit(limit).to_list(limit)
+    ]
+
+    if len(messages) < limit:
+        boundary = messages[-1]["timestamp"] if messages else before
+        seen = {m["id"] for m in messages}
+        archived = await read_archived_messages(db, patient_id, boundary, limit - len(messages))
+        messages.extend(m for m in archived if m["id"] not in seen)
+    return messages
+
+
+async def iter_archived_messages(db, patient_id: str) -> AsyncIterator[Dict[str, Any]]:
+    """Recorre todos los mensajes archivados de un paciente en orden cronológico"""
+    cursor = db.chat_archive.find({"patient_id": id_filter(patient_id)}).sort("first_ts", 1)
+    async for bucket in cursor:
+        for message in sorted(decode_bucket(bucket), key=lambda m: m["timestamp"]):
+            yield message
+
+
+async def count_archived_crisis(db) -> int:
+    pipeline = [{"$group": {"_id": None, "total": {"$sum": "$crisis_count"}}}]
+    result = await db.chat_archive.aggregate(pipeline).to_list(1)
+    return result[0]["total"] if result else 0
+
+
+async def ensure_archive_indexes(db):
+    """Índices de ambos niveles para el historial y el movimiento por fecha"""
+    await db.chat_messages.create_index([("patient_id", ASCENDING), ("timestamp", DESCENDING)])
+    await db.chat_messages.create_index([("timestamp", ASCENDING)])
+    await db.chat_archive.create_index([("patient_id", ASCENDING), ("last_ts", DESCENDING)])
+    await db.chat_archive.create_index([("patient_id", ASCENDING), ("first_ts", ASCENDING)])
+
+
+async def chat_archive_loop(db):
+    """Mueve periódicamente los mensajes antiguos al archivo"""
+    interval = timedelta(hours=ARCHIVE_INTERVAL_HOURS)
+    await run_periodic(db, "chat_archive", interval, lambda: archive_old_messages(db))
@@ -0,0 +1,98 @@
+"""
+Circuit breaker para el proveedor LLM.
+
+Tras `failure_threshold` fallos consecutivos el circuito se abre y durante
+`cooldown` segundos las llamadas fallan al instante con `CircuitOpenError`
+(las funciones de IA devuelven entonces su respuesta de respaldo sin esperar
+al timeout del proveedor). Pasado ese tiempo se deja pasar una única
+llamada de prueba (semiabierto): si tiene éxito el circuito se cierra, si
+falla vuelve a abrirse.
+"""
+
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int, cooldown: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self._rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return CLOSED
+        if time.monotonic() - self._opened_at < self.cooldown:
+            return OPEN
+        return HALF_OPEN
+
+    def before_call(self):
+        """Lanza CircuitOpenError si la llamada no debe intentarse"""
+        state = self.state
+        if state == CLOSED:
+            return
+        if state == HALF_OPEN and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return
+        self._rejected += 1
+        raise CircuitOpenError(f"{self.name} circuit is open")
+
+    def record_success(self):
+        if self._opened_at is not None:
+            logger.info(f"Circuit {self.name} closed")
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self._failures += 1
+        if self._trial_in_flight or self._failures >= self.failure_threshold:
+            if self._opened_at is None or self._trial_in_flight:
+                logger.warning(f"Circuit {self.name} opened after {self._failures} consecutive failures")
+            self._opened_at = time.monotonic()
+        self._trial_in_flight = False
+
+    async def call(self, fn, *args, **kwargs) -> Any:
+        self.before_call()
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        except BaseException:
+            # Cancelada: ni éxito ni fallo, pero libera la llamada de prueba
+            self._trial_in_flight = False
+            raise
+        self.record_success()
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self._failures,
+            "rejected": self._rejected,
+        }
+
+
+llm_circuit = CircuitBreaker(
+    "llm",
+    failure_threshold=int(os.environ.get("LLM_CIRCUIT_FAILURES", "5")),
+    cooldown=float(os.environ.get("LLM_CIRCUIT_COOLDOWN_SECONDS", "30")),
+)
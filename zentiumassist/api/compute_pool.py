@@ -0,0 +1,130 @@
+"""
+Descarga del trabajo de CPU fuera del event loop.
+
+Una transcripción larga tokenizada en el handler bloquea el event loop y con
+él el chat de todos los pacientes del worker. Las funciones marcadas con
+`@cpu_bound` se ejecutan con `await fn.offload(...)` en:
+
+- `PROCESS`: un `ProcessPoolExecutor` para Python puro, que no suelta el GIL
+  (tokenización, hashing palabra a palabra...). Los argumentos y el
+  resultado se serializan, así que solo compensa con entradas grandes:
+  `inline_if` decide cuándo ejecutarla directamente.
+- `THREAD`: un pool de hilos para NumPy y código que suelta el GIL.
+
+Ambos pools se dimensionan con el número de CPUs y los crea y cierra el
+lifespan de la app; sin arrancar (scripts, pruebas) todo se ejecuta en línea.
+Se mide por pool la cola (tareas esperando un worker libre), la espera hasta
+empezar y el tiempo de ejecución.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+PROCESS = "process"
+THREAD = "thread"
+
+CPU_COUNT = os.cpu_count() or 1
+PROCESS_WORKERS = int(os.environ.get("COMPUTE_PROCESS_WORKERS", str(max(1, CPU_COUNT - 1))))
+THREAD_WORKERS = int(os.environ.get("COMPUTE_THREAD_WORKERS", str(min(32, CPU_COUNT + 4))))
+
+
+def _timed_call(fn: Callable, args: tuple, kwargs: dict):
+    """Se ejecuta en el worker: devuelve cuándo empezó y acabó (reloj de pared, común a los procesos)"""
+    started = time.time()
+    result = fn(*args, **kwargs)
+    return started, time.time(), result
+
+
+class PoolStats:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        in_flight = self.submitted - self.completed - self.failed
+        done = max(self.completed, 1)
+        return {
+            "workers": self.workers,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "in_flight": in_flight,
+            "queue_depth": max(0, in_flight - self.workers),
+            "avg_wait_ms": round(self.wait_seconds / done * 1000, 2),
+            "max_wait_ms": round(self.max_wait_seconds * 1000, 2),
+            "avg_run_ms": round(self.run_seconds / done * 1000, 2),
+        }
+
+
+class ComputePool:
+    def __init__(self, process_workers: int = PROCESS_WORKERS, thread_workers: int = THREAD_WORKERS):
+        self._sizes = {PROCESS: process_workers, THREAD: thread_workers}
+        self._executors: Dict[str, Executor] = {}
+        self.stats = {kind: PoolStats(size) for kind, size in self._sizes.items()}
+
+    def start(self):
+        # spawn: el worker no hereda los hilos del driver de Mongo ni el event loop
+        self._executors[PROCESS] = ProcessPoolExecutor(
+            max_workers=self._sizes[PROCESS], mp_context=multiprocessing.get_context("spawn")
+        )
+        self._executors[THREAD] = ThreadPoolExecutor(max_workers=self._sizes[THREAD], thread_name_prefix="compute")
+
+    def shutdown(self):
+        for executor in self._executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        self._executors.clear()
+
+    async def run(self, kind: str, fn: Callable, *args, **kwargs) -> Any:
+        executor = self._executors.get(kind)
+        if executor is None:
+            return fn(*args, **kwargs)
+        stats = self.stats[kind]
+        stats.submitted += 1
+        submitted = time.time()
+        try:
+            started, finished, result = await asyncio.get_running_loop().run_in_executor(
+                executor, _timed_call, fn, args, kwargs
+            )
+        except BaseException:
+            stats.failed += 1
+            raise
+        wait = max(0.0, started - submitted)
+        stats.completed += 1
+        stats.wait_seconds += wait
+        stats.max_wait_seconds = max(stats.max_wait_seconds, wait)
+        stats.run_seconds += finished - started
+        return result
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {kind: stats.snapshot() for kind, stats in self.stats.items()}
+
+
+compute_pool = ComputePool()
+
+
+def cpu_bound(fn: Optional[Callable] = None, *, pool: str = PROCESS, inline_if: Optional[Callable[..., bool]] = None):
+    """
+    Marca una función de CPU. La función no cambia (sigue pudiendo llamarse
+    directamente y serializarse por nombre para el pool de procesos) y gana
+    `fn.offload(*args, **kwargs)`, que la ejecuta en el pool indicado salvo
+    cuando `inline_if(*args, **kwargs)` es cierto.
+    """
+    def mark(fn: Callable) -> Callable:
+        async def offload(*args, **kwargs):
+            if inline_if is not None and inline_if(*args, **kwargs):
+                return fn(*args, **kwargs)
+            return await compute_pool.run(pool, fn, *args, **kwargs)
+
+        fn.offload = offload
+        return fn
+
+    return mark(fn) if fn is not None else mark
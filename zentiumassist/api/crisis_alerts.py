@@ -0,0 +1,103 @@
+"""
+Alertas de crisis con su contexto, en una sola petición.
+
+El detalle de cada alerta pedía antes el perfil del paciente y su historial
+(2N+1 peticiones por vista del dashboard). `load_crisis_alerts` devuelve las
+alertas de los pacientes de un profesional ya unidas a:
+
+- `patient`: resumen del paciente, de la misma consulta (por lotes) con la que
+  se obtienen los pacientes del profesional.
+- `context`: los mensajes alrededor de la alerta, en orden cronológico.
+
+Las alertas y su contexto salen de una única agregación: cada `$lookup`
+correlacionado corta la ventana con `$sort` + `$limit` sobre el índice
+(`patient_id`, `timestamp`), de modo que nunca se carga el historial completo
+del paciente (requiere MongoDB 5.0+).
+"""
+
+import os
+from typing import Any, Dict, List
+
+from pymongo import ASCENDING, DESCENDING
+
+from storage_codec import decode_chat_message, ids_filter
+
+CRISIS_ALERTS_LIMIT = int(os.environ.get("CRISIS_ALERTS_LIMIT", "20"))
+CONTEXT_BEFORE = 10
+CONTEXT_AFTER = 5
+MAX_CONTEXT = 50
+
+PATIENT_SUMMARY_FIELDS = [
+    "id", "user_id", "age", "gender", "diagnosis", "risk_level", "risk_score",
+    "emergency_contact", "session_count", "last_session",
+]
+
+
+def _context_lookup(name: str, operator: str, direction: int, size: int) -> Dict[str, Any]:
+    return {
+        "$lookup": {
+            "from": "chat_messages",
+            "localField": "patient_id",
+            "foreignField": "patient_id",
+            "let": {"ts": "$timestamp"},
+            "pipeline": [
+                {"$match": {"$expr": {operator: ["$timestamp", "$$ts"]}}},
+                {"$sort": {"timestamp": direction}},
+                {"$limit": size},
+                {"$project": {"_id": 0}},
+            ],
+            "as": name,
+        }
+    }
+
+
+def crisis_alerts_pipeline(patient_ids: List[str], limit: int, before: int, after: int) -> List[Dict[str, Any]]:
+    pipeline: List[Dict[str, Any]] = [
+        {"$match": {"patient_id": ids_filter(patient_ids), "is_crisis": True}},
+        {"$sort": {"timestamp": -1}},
+        {"$limit": limit},
+        {"$project": {"_id": 0}},
+    ]
+    # $limit no admite 0: una ventana vacía simplemente no se busca
+    if before:
+        pipeline.append(_context_lookup("context_before", "$lt", -1, before))
+    if after:
+        pipeline.append(_context_lookup("context_after", "$gt", 1, after))
+    return pipeline
+
+
+async def ensure_crisis_alert_indexes(db):
+    """Índice parcial solo con los mensajes de crisis: el `$match` no recorre el resto del chat"""
+    await db.chat_messages.create_index(
+        [("patient_id", ASCENDING), ("is_crisis", ASCENDING), ("timestamp", DESCENDING)],
+        name="crisis_alerts",
+        partialFilterExpression={"is_crisis": True}
+    )
+
+
+async def load_crisis_alerts(
+    db,
+    professional_id: str,
+    limit: int = CRISIS_ALERTS_LIMIT,
+    before: int = CONTEXT_BEFORE,
+    after: int = CONTEXT_AFTER,
+) -> List[Dict[str, Any]]:
+    """Alertas más recientes primero, cada una con `patient` y `context`"""
+    projection = {field: 1 for field in PATIENT_SUMMARY_FIELDS}
+    projection["_id"] = 0
+    patients = {
+        patient["id"]: patient
+        for patient in await db.patients.find({"professional_id": professional_id}, projection).to_list(None)
+    }
+    if not patients:
+        return []
+
+    alerts = []
+    async for doc in db.chat_messages.aggregate(crisis_alerts_pipeline(list(patients), limit, before, after)):
+        earlier = [decode_chat_message(m) for m in reversed(doc.pop("context_before", []))]
+        later = [decode_chat_message(m) for m in doc.pop("context_after", [])]
+        alert = decode_chat_message(doc)
+        alert["patient"] = patients.get(alert["patient_id"])
+        alert["context"] = earlier + [decode_chat_message(doc)] + later
+        alerts.append(alert)
+    return alerts
@@ -0,0 +1,250 @@
+"""
+Caché de lectura de pacientes y profesionales.
+
+`find_one({"id": ...})` sobre `patients` y `professionals` se repite en el
+perfil, en cada crisis del chat, al crear tareas y al crear pacientes. Esta
+caché en proceso (LRU con TTL) sirve esas lecturas desde memoria:
+
+- Los fallos se cargan de Mongo a través de single-flight, así que un pico de
+  peticiones sobre el mismo documento hace una sola consulta.
+- Todo handler que modifica estas colecciones llama a `invalidate` (las altas
+  no lo necesitan: no se guardan en caché los documentos inexistentes).
+- Con `ENTITY_CACHE_CHANGE_STREAMS=true` (requiere replica set) cada worker
+  escucha los change streams e invalida también las escrituras de los demás;
+  sin ellos, el TTL acota cuánto puede quedar desactualizada otra réplica.
+
+Los documentos devueltos se comparten entre peticiones: no deben modificarse.
+
+Benchmark del camino del chat (lectura del paciente + guardado de los dos
+mensajes) con la caché activada y desactivada, contra `MONGO_URL` y una base
+`<DB_NAME>_benchmark` que se borra al terminar:
+
+    python entity_cache.py --patients 1000 --users 50 --messages 20
+"""
+
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from pymongo.errors import PyMongoError
+
+from single_flight import single_flight
+
+ENTITY_CACHE_TTL_SECONDS = float(os.environ.get("ENTITY_CACHE_TTL_SECONDS", "30"))
+ENTITY_CACHE_MAX_ENTRIES = int(os.environ.get("ENTITY_CACHE_MAX_ENTRIES", "10000"))
+ENTITY_CACHE_CHANGE_STREAMS = os.environ.get("ENTITY_CACHE_CHANGE_STREAMS", "false").lower() == "true"
+
+logger = logging.getLogger(__name__)
+
+
+class TtlLru:
+    """Diccionario acotado: cada entrada caduca a los `ttl` segundos y, lleno, se descarta la menos usada"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Any) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: Any, value: Any):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class EntityCache:
+    def __init__(self, collection: str, ttl: float = ENTITY_CACHE_TTL_SECONDS, max_entries: int = ENTITY_CACHE_MAX_ENTRIES):
+        self.collection = collection
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # id -> (caducidad, documento, _id de Mongo)
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any], Any]]" = OrderedDict()
+        # _id de Mongo -> id de la entidad, para traducir los eventos del change stream
+        self._object_ids: Dict[Any, str] = {}
+        self._flight = single_flight(f"{collection}_cache")
+        # Se incrementa en cada invalidación: una carga que empezó antes no se guarda
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.load_seconds = 0.0
+
+    async def _load(self, db, entity_id: str) -> Optional[Dict[str, Any]]:
+        generation = self._generation
+        started = time.perf_counter()
+        doc = await db[self.collection].find_one({"id": entity_id})
+        self.load_seconds += time.perf_counter() - started
+        if doc is None:
+            return None
+        object_id = doc.pop("_id", None)
+        if generation != self._generation:
+            return doc
+        self._entries[entity_id] = (time.monotonic() + self.ttl, doc, object_id)
+        self._object_ids[object_id] = entity_id
+        if len(self._entries) > self.max_entries:
+            self.invalidate(next(iter(self._entries)))
+        return doc
+
+    async def get(self, db, entity_id: str) -> Optional[Dict[str, Any]]:
+        """Documento por `id`, desde memoria si está vigente o desde Mongo si no"""
+        entry = self._entries.get(entity_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(entity_id)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return await self._flight.do(entity_id, lambda: self._load(db, entity_id))
+
+    def invalidate(self, *entity_ids: str):
+        self._generation += 1
+        for entity_id in entity_ids:
+            entry = self._entries.pop(entity_id, None)
+            if entry is not None:
+                self._object_ids.pop(entry[2], None)
+
+    def invalidate_object_id(self, object_id: Any):
+        entity_id = self._object_ids.get(object_id)
+        if entity_id is not None:
+            self.invalidate(entity_id)
+
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+        self._object_ids.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "avg_load_ms": round(1000 * self.load_seconds / self.misses, 3) if self.misses else None,
+        }
+
+
+patient_cache = EntityCache("patients")
+professional_cache = EntityCache("professionals")
+ENTITY_CACHES = {cache.collection: cache for cache in (patient_cache, professional_cache)}
+
+
+def entity_cache_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: cache.stats() for name, cache in ENTITY_CACHES.items()}
+
+
+async def watch_entity_changes(db):
+    """Invalida la caché con las escrituras de cualquier worker (change streams)"""
+    if not ENTITY_CACHE_CHANGE_STREAMS:
+        return
+    pipeline = [{"$match": {"ns.coll": {"$in": list(ENTITY_CACHES)}}}]
+    try:
+        async with db.watch(pipeline) as stream:
+            async for change in stream:
+                cache = ENTITY_CACHES.get(change.get("ns", {}).get("coll"))
+                if cache is None or change["operationType"] in ("drop", "rename"):
+                    # dropDatabase / invalidate: no se sabe qué documentos cambiaron
+                    for stale in ([cache] if cache else ENTITY_CACHES.values()):
+                        stale.clear()
+                elif "documentKey" in change:
+                    cache.invalidate_object_id(change["documentKey"]["_id"])
+    except PyMongoError:
+        # Sin replica set no hay change streams: queda solo la invalidación local y el TTL
+        logger.exception("Entity cache change stream stopped")
+        for cache in ENTITY_CACHES.values():
+            cache.clear()
+
+
+# =============================================================================
+# BENCHMARK
+# =============================================================================
+
+async def _chat_path(db, cache: Optional[EntityCache], patient_id: str, latencies: Dict[str, list]):
+    """Lo que hace `send_chat_message` con Mongo antes de llamar al LLM y al terminar"""
+    import uuid
+    from datetime import datetime
+
+    started = time.perf_counter()
+    patient = await (cache.get(db, patient_id) if cache else db.patients.find_one({"id": patient_id}))
+    looked_up = time.perf_counter()
+    now = datetime.utcnow()
+    await db.chat_messages.insert_many([
+        {"id": str(uuid.uuid4()), "patient_id": patient_id, "message": "Hoy estoy algo mejor", "sender": sender,
+         "professional_id": patient["professional_id"], "timestamp": now}
+        for sender in ("patient", "assistant")
+    ])
+    latencies["lookup"].append(looked_up - started)
+    latencies["message"].append(time.perf_counter() - started)
+
+
+async def benchmark(db, patients: int, users: int, messages: int, ttl: float = ENTITY_CACHE_TTL_SECONDS):
+    import asyncio
+    import random
+    import uuid
+
+    ids = [str(uuid.uuid4()) for _ in range(patients)]
+    await db.patients.insert_many([
+        {"id": patient_id, "professional_id": str(i % max(1, patients // 20)), "risk_level": "low"}
+        for i, patient_id in enumerate(ids)
+    ])
+    await db.patients.create_index("id")
+
+    async def user(cache: Optional[EntityCache], latencies: Dict[str, list]):
+        # Cada usuario es un paciente que envía varios mensajes seguidos
+        patient_id = random.choice(ids)
+        for _ in range(messages):
+            await _chat_path(db, cache, patient_id, latencies)
+
+    def percentile(values: list, fraction: float) -> float:
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000
+
+    print(f"{'caché':<8}{'mensajes':>10}{'hit rate':>10}{'lookup p50':>12}{'lookup p95':>12}{'msg p50':>10}{'msg p95':>10}")
+    for name, cache in (("off", None), ("on", EntityCache("patients", ttl=ttl))):
+        latencies: Dict[str, list] = {"lookup": [], "message": []}
+        await asyncio.gather(*(user(cache, latencies) for _ in range(users)))
+        hit_rate = cache.stats()["hit_rate"] if cache else 0.0
+        print(
+            f"{name:<8}{len(latencies['message']):>10}{hit_rate:>10.2%}"
+            f"{percentile(latencies['lookup'], 0.5):>12.3f}{percentile(latencies['lookup'], 0.95):>12.3f}"
+            f"{percentile(latencies['message'], 0.5):>10.3f}{percentile(latencies['message'], 0.95):>10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+    parser = argparse.ArgumentParser(description="Camino del chat con y sin la caché de pacientes")
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=50, help="Pacientes chateando a la vez")
+    parser.add_argument("--messages", type=int, default=20, help="Mensajes por paciente")
+    args = parser.parse_args()
+
+    async def main():
+        client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+        db = client[f"{os.environ.get('DB_NAME', 'zentium')}_benchmark"]
+        try:
+            await benchmark(db, args.patients, args.users, args.messages)
+        finally:
+            await client.drop_database(db.name)
+            client.close()
+
+    asyncio.run(main())
@@ -0,0 +1,146 @@
+"""
+Sondas de salud en segundo plano.
+
+Un bucle por worker mantiene el estado de salud en memoria y `/live`,
+`/ready` y `/health` solo leen esa instantánea, así que los balanceadores
+pueden consultarlos con la frecuencia que quieran sin coste:
+
+- Mongo: el driver ya envía heartbeats a cada servidor; un listener guarda el
+  último resultado, de modo que la sonda no añade carga a la base de datos.
+  Solo si no hay heartbeats recientes (p. ej. antes del primero) se hace un
+  `ping`, como mucho uno por intervalo.
+- LLM: no se hace ninguna llamada de pago; se considera disponible si hay
+  clave configurada y su circuit breaker no está abierto.
+- Event loop: el retraso con que despierta el propio bucle de la sonda
+  (el peor de los últimos ~5 s).
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from pymongo import monitoring
+
+from circuit_breaker import OPEN, llm_circuit
+
+logger = logging.getLogger(__name__)
+
+LAG_SAMPLE_INTERVAL = 0.5
+LAG_WINDOW_SAMPLES = 10
+PROBE_INTERVAL_SECONDS = float(os.environ.get("HEALTH_PROBE_INTERVAL_SECONDS", "5"))
+HEARTBEAT_STALE_SECONDS = float(os.environ.get("HEALTH_HEARTBEAT_STALE_SECONDS", "30"))
+PING_TIMEOUT_SECONDS = 2.0
+MAX_LOOP_LAG_MS = float(os.environ.get("HEALTH_MAX_LOOP_LAG_MS", "500"))
+
+
+class HeartbeatTracker(monitoring.ServerHeartbeatListener):
+    """Último heartbeat del driver por servidor (se llama desde sus hilos de monitorización)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._servers: Dict[Any, tuple] = {}
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        with self._lock:
+            self._servers[event.connection_id] = (time.monotonic(), True, event.duration * 1000)
+
+    def failed(self, event):
+        with self._lock:
+            self._servers[event.connection_id] = (time.monotonic(), False, event.duration * 1000)
+
+    def status(self, stale_after: float) -> Optional[Dict[str, Any]]:
+        """None si no hay heartbeats recientes de ningún servidor"""
+        now = time.monotonic()
+        with self._lock:
+            recent = [s for s in self._servers.values() if now - s[0] < stale_after]
+        if not recent:
+            return None
+        reachable = [s for s in recent if s[1]]
+        return {
+            "up": bool(reachable),
+            "latency_ms": round(min(s[2] for s in reachable), 1) if reachable else None,
+            "source": "heartbeat",
+        }
+
+
+class HealthMonitor:
+    def __init__(self):
+        self.heartbeats = HeartbeatTracker()
+        self._lag_samples = deque([0.0], maxlen=LAG_WINDOW_SAMPLES)
+        self.database: Dict[str, Any] = {"up": False, "latency_ms": None, "source": "none"}
+        self.llm_configured = False
+        self.checked_at: Optional[datetime] = None
+        self._last_ping = float("-inf")
+
+    async def _probe_database(self, db):
+        status = self.heartbeats.status(HEARTBEAT_STALE_SECONDS)
+        if status is not None:
+            self.database = status
+            return
+        if time.monotonic() - self._last_ping < PROBE_INTERVAL_SECONDS:
+            return
+        self._last_ping = time.monotonic()
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(db.command("ping"), PING_TIMEOUT_SECONDS)
+            self.database = {"up": True, "latency_ms": round((time.perf_counter() - started) * 1000, 1), "source": "ping"}
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Database health probe failed: {e}")
+            self.database = {"up": False, "latency_ms": None, "source": "ping"}
+
+    async def run(self, db, llm_configured: bool):
+        self.llm_configured = llm_configured
+        next_probe = 0.0
+        while True:
+            started = time.monotonic()
+            if started >= next_probe:
+                await self._probe_database(db)
+                self.checked_at = datetime.utcnow()
+                next_probe = started + PROBE_INTERVAL_SECONDS
+            expected = time.monotonic() + LAG_SAMPLE_INTERVAL
+            await asyncio.sleep(LAG_SAMPLE_INTERVAL)
+            self._lag_samples.append(max(0.0, time.monotonic() - expected) * 1000)
+
+    @property
+    def loop_lag_ms(self) -> float:
+        """Peor retraso de los últimos segundos, para que un bloqueo puntual no pase desapercibido"""
+        return round(max(self._lag_samples), 1)
+
+    def llm_status(self) -> str:
+        if not self.llm_configured:
+            return "not_configured"
+        return "circuit_open" if llm_circuit.state == OPEN else "operational"
+
+    def readiness(self) -> Dict[str, Any]:
+        """Instantánea para /ready: `ready` decide el 200/503"""
+        database_ok = self.checked_at is not None and self.database["up"]
+        loop_ok = self.loop_lag_ms <= MAX_LOOP_LAG_MS
+        llm = self.llm_status()
+        ready = database_ok and loop_ok
+        if not ready:
+            status = "starting" if self.checked_at is None else "not_ready"
+        else:
+            status = "ready" if llm == "operational" else "degraded"
+        return {
+            "status": status,
+            "ready": ready,
+            "checked_at": self.checked_at,
+            "checks": {
+                "database": self.database,
+                "event_loop": {"lag_ms": self.loop_lag_ms, "max_lag_ms": MAX_LOOP_LAG_MS, "ok": loop_ok},
+                "llm": {"status": llm, "circuit": llm_circuit.stats()},
+            },
+        }
+
+
+health_monitor = HealthMonitor()
@@ -0,0 +1,198 @@
+"""
+Compresión de respuestas y GET condicional (ETag / 304).
+
+- `CompressionMiddleware`: comprime con brotli (si está instalado) o gzip
+  las respuestas de texto/JSON a partir de un tamaño mínimo.
+- `ConditionalGetMiddleware`: añade un ETag calculado sobre el cuerpo de las
+  respuestas GET que no lo traen y responde 304 si el cliente ya lo tiene.
+- `resource_etag` / `collection_version`: ETags baratos a partir de
+  versiones (`updated_at`, número de documentos...) para que los endpoints
+  respondan 304 sin consultar ni serializar los documentos completos.
+"""
+
+import gzip
+import hashlib
+from typing import Any, Dict, List, Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # brotli es opcional; sin él se usa solo gzip
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript", "image/svg+xml")
+DEFAULT_MINIMUM_SIZE = 1024
+CACHE_CONTROL = "private, no-cache"
+
+
+def resource_etag(*parts: Any) -> str:
+    """ETag débil derivado de los valores de versión de un recurso"""
+    digest = hashlib.sha1("|".join(str(p) for p in parts).encode("utf-8")).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def _strip_weak(tag: str) -> str:
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def etag_matches(request_headers, etag: str) -> bool:
+    """Compara If-None-Match con el ETag actual (comparación débil)"""
+    header = request_headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    current = _strip_weak(etag)
+    return any(_strip_weak(candidate) == current for candidate in header.split(","))
+
+
+def preferred_encodings(accept_encoding: str, supported: Tuple[str, ...]) -> List[str]:
+    """
+    Codificaciones de `supported` aceptables según Accept-Encoding, de mayor a
+    menor `q` (a igual `q`, en el orden de `supported`). `q=0` las excluye y
+    `*` cubre las no mencionadas (RFC 9110 §12.5.3).
+    """
+    weights: Dict[str, float] = {}
+    for part in accept_encoding.lower().split(","):
+        coding, *params = [item.strip() for item in part.split(";")]
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding] = q
+    ranked = [
+        (weights.get(coding, weights.get("*", 0.0)), -position, coding)
+        for position, coding in enumerate(supported)
+    ]
+    return [coding for q, _, coding in sorted(ranked, reverse=True) if q > 0]
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": CACHE_CONTROL})
+
+
+def check_not_modified(request: Request, *version_parts: Any) -> Tuple[str, Optional[Response]]:
+    """Devuelve el ETag del recurso y una respuesta 304 si el cliente ya lo tiene"""
+    etag = resource_etag(request.url.path, request.url.query, *version_parts)
+    return etag, (not_modified(etag) if etag_matches(request.headers, etag) else None)
+
+
+async def collection_version(db, collection: str, query: Dict[str, Any], fields: List[str]) -> Tuple[Any, ...]:
+    """
+    Versión de un conjunto de documentos: número de documentos y máximo de
+    cada campo de fecha indicado. Cambia con cualquier alta o actualización
+    que toque esos campos.
+    """
+    group: Dict[str, Any] = {"_id": None, "count": {"$sum": 1}}
+    for i, field in enumerate(fields):
+        group[f"v{i}"] = {"$max": f"${field}"}
+    result = await db[collection].aggregate([{"$match": query}, {"$group": group}]).to_list(1)
+    if not result:
+        return (0,)
+    return (result[0]["count"],) + tuple(result[0][f"v{i}"] for i in range(len(fields)))
+
+
+class _BufferedResponse:
+    """Retiene el inicio de la respuesta hasta saber si el cuerpo llega en un solo mensaje"""
+
+    def __init__(self, send: Send):
+        self.send = send
+        self.start: Optional[Message] = None
+        self.passthrough = False
+
+    async def __call__(self, message: Message, handle_body):
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+        if message.get("more_body", False):
+            # Respuesta en streaming: se reenvía sin modificar
+            self.passthrough = True
+            await self.send(self.start)
+            await self.send(message)
+            return
+        await handle_body(self.start, message.get("body", b""))
+
+
+class ConditionalGetMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+        request_headers = Headers(scope=scope)
+
+        async def handle_body(start: Message, body: bytes):
+            headers = MutableHeaders(raw=start["headers"])
+            if start["status"] == 200 and "etag" not in headers:
+                headers["ETag"] = resource_etag(hashlib.sha1(body).hexdigest())
+                headers.setdefault("Cache-Control", CACHE_CONTROL)
+            if start["status"] == 200 and etag_matches(request_headers, headers["etag"]):
+                response = not_modified(headers["etag"])
+                await response(scope, receive, send)
+                return
+            await send(start)
+            await send({"type": "http.response.body", "body": body})
+
+        buffered = _BufferedResponse(send)
+        await self.app(scope, receive, lambda message: buffered(message, handle_body))
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, minimum_size: int = DEFAULT_MINIMUM_SIZE, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def _choose_encoding(self, accept_encoding: str) -> Optional[str]:
+        supported = ("br", "gzip") if brotli is not None else ("gzip",)
+        preferred = preferred_encodings(accept_encoding, supported)
+        return preferred[0] if preferred else None
+
+    def _compress(self, encoding: str, body: bytes) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = self._choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        async def handle_body(start: Message, body: bytes):
+            headers = MutableHeaders(raw=start["headers"])
+            content_type = headers.get("content-type", "")
+            if (
+                len(body) >= self.minimum_size
+                and "content-encoding" not in headers
+                and content_type.startswith(COMPRESSIBLE_TYPES)
+            ):
+                body = self._compress(encoding, body)
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(body))
+                headers.add_vary_header("Accept-Encoding")
+            await send(start)
+            await send({"type": "http.response.body", "body": body})
+
+        buffered = _BufferedResponse(send)
+        await self.app(scope, receive, lambda message: buffered(message, handle_body))
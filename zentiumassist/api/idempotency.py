@@ -0,0 +1,232 @@
+"""
+Claves de idempotencia para los endpoints de escritura con LLM.
+
+Los clientes móviles reintentan por timeout `POST /chat/{id}/message`,
+`POST /sessions` y `PUT /sessions/{id}/transcript`. Sin idempotencia cada
+reintento vuelve a llamar al LLM y duplica mensajes. Con la cabecera
+`Idempotency-Key`:
+
+- La primera petición reclama la clave en `idempotency_keys` (con el hash del
+  método, la ruta, la query y el cuerpo) y al terminar guarda la respuesta.
+- Un reintento con la misma clave recibe la respuesta guardada, con
+  `Idempotent-Replayed: true`, sin ejecutar el endpoint.
+- Un duplicado concurrente espera a que termine la primera petición (en el
+  mismo worker con un evento, entre workers consultando Mongo). Si el worker
+  que la tenía cae, la reclamación caduca y el siguiente reintento la retoma.
+- La misma clave con otro cuerpo devuelve 422.
+
+Solo se guardan las respuestas 2xx: tras un 429 o un 5xx el reintento vuelve
+a ejecutarse. Las claves caducan con un índice TTL. Sin cabecera, el endpoint
+funciona como siempre.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Pattern, Tuple
+
+from bson import Binary
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse, Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+IDEMPOTENCY_HEADER = "idempotency-key"
+IDEMPOTENCY_TTL_HOURS = float(os.environ.get("IDEMPOTENCY_TTL_HOURS", "24"))
+# Lo que puede tardar como mucho una petición con LLM antes de darla por perdida
+IDEMPOTENCY_LOCK_SECONDS = float(os.environ.get("IDEMPOTENCY_LOCK_SECONDS", "120"))
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get("IDEMPOTENCY_WAIT_SECONDS", "60"))
+POLL_INTERVAL_SECONDS = 0.25
+MAX_KEY_LENGTH = 255
+
+IDEMPOTENT_ROUTES: List[Tuple[str, Pattern]] = [
+    ("POST", re.compile(r"^/api/chat/[^/]+/message$")),
+    ("POST", re.compile(r"^/api/sessions$")),
+    ("PUT", re.compile(r"^/api/sessions/[^/]+/transcript$")),
+]
+
+logger = logging.getLogger(__name__)
+
+
+def request_hash(scope: Scope, body: bytes) -> str:
+    digest = hashlib.sha256()
+    for part in (scope["method"], scope["path"], scope.get("query_string", b"").decode("latin-1")):
+        digest.update(part.encode("utf-8") + b"\0")
+    digest.update(body)
+    return digest.hexdigest()
+
+
+def _error(status_code: int, detail: str, headers: Optional[Dict[str, str]] = None) -> Response:
+    return JSONResponse({"detail": detail}, status_code=status_code, headers=headers)
+
+
+class IdempotencyMiddleware:
+    def __init__(self, app: ASGIApp, db_getter, routes: List[Tuple[str, Pattern]] = IDEMPOTENT_ROUTES):
+        self.app = app
+        self.db_getter = db_getter
+        self.routes = routes
+        # Peticiones en curso en este worker: los duplicados esperan al evento
+        self._running: Dict[str, asyncio.Event] = {}
+
+    def _applies(self, scope: Scope) -> bool:
+        return any(scope["method"] == method and pattern.match(scope["path"]) for method, pattern in self.routes)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not self._applies(scope):
+            await self.app(scope, receive, send)
+            return
+        key = Headers(scope=scope).get(IDEMPOTENCY_HEADER)
+        db = self.db_getter()
+        if not key or db is None:
+            await self.app(scope, receive, send)
+            return
+        if len(key) > MAX_KEY_LENGTH:
+            await _error(400, f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters")(scope, receive, send)
+            return
+
+        body = await _read_body(receive)
+        fingerprint = request_hash(scope, body)
+        owner = str(uuid.uuid4())
+        deadline = asyncio.get_running_loop().time() + IDEMPOTENCY_WAIT_SECONDS
+        while True:
+            record = await self._claim(db, key, fingerprint, owner)
+            if record is None:
+                await self._execute(db, key, owner, scope, _replay_body(body, receive), send)
+                return
+            if record["request_hash"] != fingerprint:
+                await _error(422, "Idempotency-Key was already used with a different request")(scope, receive, send)
+                return
+            if record["status"] == "completed":
+                await self._replay(record, scope, receive, send)
+                return
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                await _error(409, "A request with this Idempotency-Key is still in progress", {"Retry-After": "5"})(scope, receive, send)
+                return
+            await self._wait(key, min(remaining, POLL_INTERVAL_SECONDS))
+
+    async def _claim(self, db, key: str, fingerprint: str, owner: str) -> Optional[Dict[str, Any]]:
+        """None si esta petición se queda la clave; si no, el registro existente"""
+        now = datetime.utcnow()
+        try:
+            # Nueva, o en curso pero abandonada por un worker que cayó
+            await db.idempotency_keys.find_one_and_update(
+                {"_id": key, "status": "in_progress", "request_hash": fingerprint, "locked_until": {"$lt": now}},
+                {
+                    "$set": {"owner": owner, "locked_until": now + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)},
+                    "$setOnInsert": {
+                        "created_at": now,
+                        "expires_at": now + timedelta(hours=IDEMPOTENCY_TTL_HOURS),
+                    },
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            return None
+        except DuplicateKeyError:
+            record = await db.idempotency_keys.find_one({"_id": key})
+            # Liberada justo entre medias: se vuelve a intentar
+            return record or {"request_hash": fingerprint, "status": "in_progress"}
+
+    async def _wait(self, key: str, timeout: float):
+        event = self._running.get(key)
+        if event is None:
+            await asyncio.sleep(timeout)
+            return
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _execute(self, db, key: str, owner: str, scope: Scope, receive: Receive, send: Send):
+        event = self._running[key] = asyncio.Event()
+        start: Dict[str, Any] = {}
+        chunks: List[bytes] = []
+
+        async def capture(message: Message):
+            if message["type"] == "http.response.start":
+                start.update(message)
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, capture)
+            if not 200 <= start.get("status", 500) < 300:
+                await self._release(db, key, owner)
+            else:
+                await db.idempotency_keys.update_one(
+                    {"_id": key, "owner": owner},
+                    {
+                        "$set": {
+                            "status": "completed",
+                            "status_code": start["status"],
+                            "headers": [[name.decode("latin-1"), value.decode("latin-1")] for name, value in start.get("headers", [])],
+                            "body": Binary(b"".join(chunks)),
+                            "completed_at": datetime.utcnow(),
+                        },
+                        "$unset": {"locked_until": ""},
+                    }
+                )
+        except BaseException:
+            await self._release(db, key, owner)
+            raise
+        finally:
+            self._running.pop(key, None)
+            event.set()
+
+    @staticmethod
+    async def _release(db, key: str, owner: str):
+        """Sin respuesta correcta que guardar, el reintento debe volver a ejecutarse"""
+        try:
+            await asyncio.shield(db.idempotency_keys.delete_one({"_id": key, "owner": owner, "status": "in_progress"}))
+        except Exception as e:
+            logger.error(f"Error releasing idempotency key {key}: {e}")
+
+    @staticmethod
+    async def _replay(record: Dict[str, Any], scope: Scope, receive: Receive, send: Send):
+        headers = [
+            (name.encode("latin-1"), value.encode("latin-1"))
+            for name, value in record.get("headers", [])
+            if name.lower() not in ("content-length", "idempotent-replayed")
+        ]
+        body = bytes(record.get("body", b""))
+        headers.append((b"content-length", str(len(body)).encode("latin-1")))
+        headers.append((b"idempotent-replayed", b"true"))
+        await send({"type": "http.response.start", "status": record["status_code"], "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+
+async def _read_body(receive: Receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(chunks)
+
+
+def _replay_body(body: bytes, receive: Receive) -> Receive:
+    """Entrega al endpoint el cuerpo ya leído y después delega en el `receive` original"""
+    sent = False
+
+    async def replay() -> Message:
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+
+    return replay
+
+
+async def ensure_idempotency_indexes(db):
+    await db.idempotency_keys.create_index("expires_at", expireAfterSeconds=0)
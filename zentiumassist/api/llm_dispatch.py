@@ -0,0 +1,239 @@
+"""
+Cola con prioridades para las llamadas al LLM.
+
+Con la concurrencia del proveedor saturada, un paciente en crisis esperaba
+detrás de análisis de transcripciones y del chat rutinario. `LlmDispatcher`
+limita las llamadas simultáneas del worker y reparte los huecos por carril:
+
+- `CRISIS`: mensajes con indicios de crisis (palabras clave o una crisis
+  reciente del paciente). Tiene `reserved` huecos que los demás carriles no
+  pueden ocupar, así que normalmente no espera.
+- `CHAT`: chat interactivo y su clasificación de sentimiento.
+- `BACKGROUND`: análisis de transcripciones y feedback de tareas.
+
+Dentro de un carril el orden es FIFO. Contra la inanición, cada
+`starvation_seconds` de espera una petición sube un nivel de prioridad (a
+igual nivel gana el carril original más prioritario), de modo que el trabajo
+de fondo siempre acaba saliendo aunque el chat no pare.
+
+El carril de cada llamada sale del argumento `priority` o, si no se indica,
+de `llm_priority` (ContextVar que fija el endpoint). Se mide por carril la
+cola, la espera hasta obtener hueco (media, p95 y máxima) y cuántas
+peticiones subieron por antigüedad.
+
+Simulación con latencia del proveedor fija, frente a una cola FIFO:
+
+    python llm_dispatch.py --concurrency 8 --latency 0.2 --seconds 10
+"""
+
+import asyncio
+import os
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Callable, Deque, Dict, Optional
+
+CRISIS = "crisis"
+CHAT = "chat"
+BACKGROUND = "background"
+LANES = (CRISIS, CHAT, BACKGROUND)
+_RANK = {lane: rank for rank, lane in enumerate(LANES)}
+
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "8"))
+LLM_CRISIS_RESERVED_SLOTS = int(os.environ.get("LLM_CRISIS_RESERVED_SLOTS", "1"))
+LLM_STARVATION_SECONDS = float(os.environ.get("LLM_STARVATION_SECONDS", "5"))
+WAIT_SAMPLES = 1000
+
+# Carril de las llamadas al LLM de la petición o tarea actual
+llm_priority: ContextVar[str] = ContextVar("llm_priority", default=CHAT)
+
+
+def set_llm_priority(lane: str):
+    llm_priority.set(lane)
+
+
+class _Waiter:
+    __slots__ = ("lane", "enqueued_at", "future")
+
+    def __init__(self, lane: str, future: asyncio.Future):
+        self.lane = lane
+        self.enqueued_at = time.monotonic()
+        self.future = future
+
+
+class LaneStats:
+    def __init__(self):
+        self.submitted = 0
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.promoted = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.recent_waits: Deque[float] = deque(maxlen=WAIT_SAMPLES)
+
+    def record_wait(self, wait: float):
+        self.started += 1
+        self.wait_seconds += wait
+        self.max_wait_seconds = max(self.max_wait_seconds, wait)
+        self.recent_waits.append(wait)
+
+    def snapshot(self) -> Dict[str, Any]:
+        waits = sorted(self.recent_waits)
+        p95 = waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0
+        return {
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "promoted": self.promoted,
+            "avg_wait_ms": round(self.wait_seconds / max(self.started, 1) * 1000, 2),
+            "p95_wait_ms": round(p95 * 1000, 2),
+            "max_wait_ms": round(self.max_wait_seconds * 1000, 2),
+        }
+
+
+class LlmDispatcher:
+    def __init__(
+        self,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        reserved: int = LLM_CRISIS_RESERVED_SLOTS,
+        starvation_seconds: float = LLM_STARVATION_SECONDS,
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.reserved = min(max(0, reserved), self.max_concurrency - 1)
+        self.starvation_seconds = starvation_seconds
+        self._queues: Dict[str, Deque[_Waiter]] = {lane: deque() for lane in LANES}
+        self._active: Dict[str, int] = {lane: 0 for lane in LANES}
+        self._stats: Dict[str, LaneStats] = {lane: LaneStats() for lane in LANES}
+
+    async def run(self, fn: Callable, *args, priority: Optional[str] = None, **kwargs) -> Any:
+        """Espera un hueco en el carril `priority` (por defecto `llm_priority`) y ejecuta `fn`"""
+        lane = priority or llm_priority.get()
+        await self._acquire(lane)
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception:
+            self._stats[lane].failed += 1
+            raise
+        finally:
+            self._release(lane)
+        self._stats[lane].completed += 1
+        return result
+
+    def _limit(self, lane: str) -> int:
+        return self.max_concurrency if lane == CRISIS else self.max_concurrency - self.reserved
+
+    def _level(self, waiter: _Waiter, now: float) -> int:
+        """Prioridad efectiva: sube un nivel por cada `starvation_seconds` esperando"""
+        if self.starvation_seconds <= 0:
+            return _RANK[waiter.lane]
+        return max(0, _RANK[waiter.lane] - int((now - waiter.enqueued_at) // self.starvation_seconds))
+
+    async def _acquire(self, lane: str):
+        self._stats[lane].submitted += 1
+        waiter = _Waiter(lane, asyncio.get_running_loop().create_future())
+        self._queues[lane].append(waiter)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Tenía hueco pero se canceló antes de usarlo
+                self._release(lane)
+            elif waiter in self._queues[lane]:
+                self._queues[lane].remove(waiter)
+            raise
+
+    def _release(self, lane: str):
+        self._active[lane] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """Da huecos libres a las peticiones en cola, la más prioritaria primero"""
+        while sum(self._active.values()) < self.max_concurrency:
+            now = time.monotonic()
+            # La cabeza de cada cola es su petición más antigua, la de mayor prioridad efectiva
+            heads = [queue[0] for queue in self._queues.values() if queue]
+            if not heads:
+                return
+            waiter = min(heads, key=lambda w: (self._level(w, now), _RANK[w.lane], w.enqueued_at))
+            if waiter.future.done():
+                # Cancelada mientras esperaba: se descarta
+                self._queues[waiter.lane].popleft()
+                continue
+            if sum(self._active.values()) >= self._limit(waiter.lane):
+                # Solo quedan huecos reservados a crisis
+                return
+            self._queues[waiter.lane].popleft()
+            self._active[waiter.lane] += 1
+            stats = self._stats[waiter.lane]
+            stats.record_wait(now - waiter.enqueued_at)
+            if self._level(waiter, now) < _RANK[waiter.lane]:
+                stats.promoted += 1
+            waiter.future.set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "reserved_for_crisis": self.reserved,
+            "starvation_seconds": self.starvation_seconds,
+            "active": sum(self._active.values()),
+            "lanes": {
+                lane: {"active": self._active[lane], "queued": len(self._queues[lane]), **self._stats[lane].snapshot()}
+                for lane in LANES
+            },
+        }
+
+
+llm_dispatcher = LlmDispatcher()
+
+
+# =============================================================================
+# SIMULACIÓN
+# =============================================================================
+
+async def simulate(dispatcher: LlmDispatcher, latency: float, seconds: float, rates: Dict[str, float], fifo: bool = False) -> Dict[str, list]:
+    """Llegadas de Poisson por carril contra un proveedor de latencia fija; devuelve las esperas ordenadas"""
+    import random
+
+    waits: Dict[str, list] = {lane: [] for lane in rates}
+
+    async def call(lane: str):
+        started = time.monotonic()
+        await dispatcher.run(asyncio.sleep, latency, priority=CHAT if fifo else lane)
+        waits[lane].append(time.monotonic() - started - latency)
+
+    async def arrivals(lane: str, rate: float):
+        calls = []
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            await asyncio.sleep(random.expovariate(rate))
+            calls.append(asyncio.ensure_future(call(lane)))
+        await asyncio.gather(*calls)
+
+    await asyncio.gather(*(arrivals(lane, rate) for lane, rate in rates.items()))
+    return {lane: sorted(values) for lane, values in waits.items()}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Espera por carril con prioridades frente a FIFO")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.2, help="Segundos por llamada al proveedor")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--crisis-rate", type=float, default=1, help="Llamadas por segundo")
+    parser.add_argument("--chat-rate", type=float, default=30)
+    parser.add_argument("--background-rate", type=float, default=15)
+    args = parser.parse_args()
+    rates = {CRISIS: args.crisis_rate, CHAT: args.chat_rate, BACKGROUND: args.background_rate}
+
+    print(f"{'cola':<12}{'carril':<12}{'llamadas':>10}{'p50 ms':>10}{'p95 ms':>10}{'máx ms':>10}")
+    for name, fifo in (("fifo", True), ("prioridad", False)):
+        dispatcher = LlmDispatcher(args.concurrency, 0 if fifo else LLM_CRISIS_RESERVED_SLOTS)
+        waits = asyncio.run(simulate(dispatcher, args.latency, args.seconds, rates, fifo))
+        for lane in LANES:
+            values = waits[lane] or [0.0]
+            p50 = values[len(values) // 2] * 1000
+            p95 = values[min(len(values) - 1, int(len(values) * 0.95))] * 1000
+            print(f"{name:<12}{lane:<12}{len(waits[lane]):>10}{p50:>10.1f}{p95:>10.1f}{values[-1] * 1000:>10.1f}")
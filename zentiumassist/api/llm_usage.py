@@ -0,0 +1,285 @@
+"""
+Contabilidad de tokens y coste del LLM.
+
+Toda llamada al proveedor pasa por `send_llm_message` (server.py), que anota
+aquí el modelo, el endpoint, los tokens de entrada y salida y a quién se
+atribuye (tenant, paciente, profesional). Los tokens se cuentan con
+`tiktoken` si está instalado y si no con la estimación de ~4 caracteres por
+token; `emergentintegrations` no devuelve el uso del proveedor.
+
+- Los contadores se agregan en memoria por (día, tenant, modelo, endpoint,
+  paciente, profesional), así que anotar una llamada no toca Mongo.
+- `UsageLedger.run` los vuelca periódicamente a `llm_usage` (base compartida)
+  con upserts `$inc`: cada worker suma lo suyo sin coordinarse.
+- `usage_report` agrupa el ledger por paciente, profesional, modelo, endpoint,
+  día o tenant y calcula el coste estimado con `LLM_PRICES_PER_MILLION`.
+
+Las llamadas por lotes (sentimiento, feedback de tareas) reparten sus tokens
+entre los pacientes del lote en proporción al tamaño de cada elemento.
+
+El presupuesto diario por paciente (`enforce_llm_budget`) se comprueba contra
+este mismo ledger: lo ya volcado más lo pendiente en este worker. Lo que otros
+workers aún no han volcado puede tardar `LLM_USAGE_FLUSH_SECONDS` en contar.
+"""
+
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence
+
+from pymongo import UpdateOne
+
+from rate_limit import estimate_tokens, too_many_requests
+from tenancy import current_tenant
+
+try:
+    import tiktoken
+except ImportError:  # opcional; sin él se estima por caracteres
+    tiktoken = None
+
+LLM_USAGE_FLUSH_SECONDS = float(os.environ.get("LLM_USAGE_FLUSH_SECONDS", "30"))
+LLM_DAILY_TOKEN_BUDGET = int(os.environ.get("LLM_DAILY_TOKEN_BUDGET", "50000"))
+DEFAULT_MODEL = "default"
+
+# USD por millón de tokens (entrada, salida)
+LLM_PRICES_PER_MILLION = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+
+GROUP_FIELDS = ("patient_id", "professional_id", "model", "endpoint", "day", "tenant")
+
+logger = logging.getLogger(__name__)
+
+
+class UsageOwner(NamedTuple):
+    tenant: str
+    patient_id: Optional[str] = None
+    professional_id: Optional[str] = None
+
+
+# Paciente y profesional a los que se atribuyen las llamadas de la petición actual
+usage_entity: ContextVar[tuple] = ContextVar("usage_entity", default=(None, None))
+
+
+def set_usage_entity(patient_id: Optional[str] = None, professional_id: Optional[str] = None):
+    usage_entity.set((patient_id, professional_id))
+
+
+def current_owner() -> UsageOwner:
+    patient_id, professional_id = usage_entity.get()
+    return UsageOwner(current_tenant.get(), patient_id, professional_id)
+
+
+_encodings: Dict[str, Any] = {}
+
+
+def count_tokens(text: Optional[str], model: str = DEFAULT_MODEL) -> int:
+    if not text:
+        return 0
+    if tiktoken is None:
+        return estimate_tokens(text)
+    encoding = _encodings.get(model)
+    if encoding is None:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("o200k_base")
+        _encodings[model] = encoding
+    return len(encoding.encode(text))
+
+
+def _split(total: int, weights: Sequence[int]) -> List[int]:
+    """Reparte `total` en proporción a `weights` sin perder unidades por redondeo"""
+    if sum(weights) <= 0:
+        weights = [1] * len(weights)
+    shares = [total * weight // sum(weights) for weight in weights]
+    shares[0] += total - sum(shares)
+    return shares
+
+
+class UsageLedger:
+    def __init__(self):
+        # (día, tenant, modelo, endpoint, paciente, profesional) -> contadores
+        self._pending: Dict[tuple, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        # Contadores de un volcado en curso: siguen contando para el presupuesto hasta escribirse
+        self._flushing: Dict[tuple, Dict[str, int]] = {}
+        self.recorded_calls = 0
+        self.flushed_rows = 0
+        self.last_flush_at: Optional[datetime] = None
+
+    def record(
+        self,
+        model: Optional[str],
+        endpoint: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        owners: Optional[Sequence[UsageOwner]] = None,
+        weights: Optional[Sequence[int]] = None,
+        failed: bool = False,
+    ):
+        """Anota una llamada; con varios `owners` los tokens se reparten según `weights`"""
+        owners = list(owners) if owners else [current_owner()]
+        weights = list(weights) if weights else [1] * len(owners)
+        day = _today()
+        self.recorded_calls += 1
+        shares = zip(owners, _split(prompt_tokens, weights), _split(completion_tokens, weights))
+        for i, (owner, prompt, completion) in enumerate(shares):
+            counters = self._pending[(day, owner.tenant, model or DEFAULT_MODEL, endpoint, owner.patient_id, owner.professional_id)]
+            counters["prompt_tokens"] += prompt
+            counters["completion_tokens"] += completion
+            counters["total_tokens"] += prompt + completion
+            counters["items"] += 1
+            # La llamada cuenta una vez aunque se reparta entre varios pacientes
+            if i == 0:
+                counters["calls"] += 1
+                counters["failed_calls"] += int(failed)
+
+    async def flush(self, db) -> int:
+        pending, self._pending = self._pending, defaultdict(lambda: defaultdict(int))
+        if not pending:
+            return 0
+        self._flushing = pending
+        now = datetime.utcnow()
+        operations = []
+        for (day, tenant, model, endpoint, patient_id, professional_id), counters in pending.items():
+            operations.append(UpdateOne(
+                {"_id": "|".join([day, tenant, model, endpoint, patient_id or "-", professional_id or "-"])},
+                {
+                    "$inc": dict(counters),
+                    "$set": {"updated_at": now},
+                    "$setOnInsert": {
+                        "day": day,
+                        "tenant": tenant,
+                        "model": model,
+                        "endpoint": endpoint,
+                        "patient_id": patient_id,
+                        "professional_id": professional_id,
+                    },
+                },
+                upsert=True
+            ))
+        try:
+            await db.llm_usage.bulk_write(operations, ordered=False)
+        except Exception:
+            # Se devuelven a memoria para el siguiente volcado
+            for key, counters in pending.items():
+                for field, value in counters.items():
+                    self._pending[key][field] += value
+            raise
+        finally:
+            self._flushing = {}
+        self.flushed_rows += len(operations)
+        self.last_flush_at = now
+        return len(operations)
+
+    def unflushed_tokens(self, patient_id: str, day: str) -> int:
+        """Tokens del paciente en `day` que este worker aún no ha escrito en Mongo"""
+        return sum(
+            counters["total_tokens"]
+            for rows in (self._pending, self._flushing)
+            for key, counters in rows.items()
+            if key[0] == day and key[4] == patient_id
+        )
+
+    async def run(self, db, interval: float = LLM_USAGE_FLUSH_SECONDS):
+        """Vuelca los contadores cada `interval` segundos mientras la app está activa"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush(db)
+            except Exception as e:
+                logger.error(f"Error flushing LLM usage: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "recorded_calls": self.recorded_calls,
+            "pending_rows": len(self._pending),
+            "flushed_rows": self.flushed_rows,
+            "last_flush_at": self.last_flush_at,
+        }
+
+
+llm_usage = UsageLedger()
+
+
+def _today() -> str:
+    return datetime.utcnow().strftime("%Y-%m-%d")
+
+
+async def patient_tokens_today(db, patient_id: str) -> int:
+    day = _today()
+    pipeline = [
+        {"$match": {"day": day, "patient_id": patient_id}},
+        {"$group": {"_id": None, "tokens": {"$sum": "$total_tokens"}}},
+    ]
+    rows = await db.llm_usage.aggregate(pipeline).to_list(1)
+    return (rows[0]["tokens"] if rows else 0) + llm_usage.unflushed_tokens(patient_id, day)
+
+
+async def enforce_llm_budget(db, patient_id: str, budget: int = LLM_DAILY_TOKEN_BUDGET):
+    """Lanza 429 hasta medianoche (UTC) si el paciente agotó su presupuesto diario de tokens"""
+    if await patient_tokens_today(db, patient_id) >= budget:
+        now = datetime.utcnow()
+        midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        raise too_many_requests(
+            (midnight - now).total_seconds(),
+            "Se alcanzó el límite diario del asistente. Si necesitas ayuda urgente, contacta a tu profesional o a servicios de emergencia."
+        )
+
+
+def estimated_cost(model: str, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+    prices = LLM_PRICES_PER_MILLION.get(model)
+    if prices is None:
+        return None
+    return round((prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1_000_000, 6)
+
+
+async def usage_report(
+    db,
+    group_by: str = "patient_id",
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    filters: Optional[Dict[str, str]] = None,
+    limit: int = 100,
+) -> List[Dict[str, Any]]:
+    """Uso agregado por `group_by` entre los días `start` y `end` (YYYY-MM-DD, inclusive), de mayor a menor"""
+    match: Dict[str, Any] = {field: value for field, value in (filters or {}).items() if value}
+    if start or end:
+        match["day"] = {**({"$gte": start} if start else {}), **({"$lte": end} if end else {})}
+    # El coste depende del modelo: se agrupa también por él y se suma después
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": {"key": f"${group_by}", "model": "$model"},
+            "calls": {"$sum": "$calls"},
+            "failed_calls": {"$sum": "$failed_calls"},
+            "items": {"$sum": "$items"},
+            "prompt_tokens": {"$sum": "$prompt_tokens"},
+            "completion_tokens": {"$sum": "$completion_tokens"},
+            "total_tokens": {"$sum": "$total_tokens"},
+        }},
+    ]
+    rows: Dict[Any, Dict[str, Any]] = {}
+    async for group in db.llm_usage.aggregate(pipeline):
+        key = group["_id"].get("key")
+        row = rows.setdefault(key, {
+            group_by: key, "calls": 0, "failed_calls": 0, "items": 0, "prompt_tokens": 0,
+            "completion_tokens": 0, "total_tokens": 0, "estimated_cost_usd": 0.0, "models": {},
+        })
+        for field in ("calls", "failed_calls", "items", "prompt_tokens", "completion_tokens", "total_tokens"):
+            row[field] += group[field]
+        model = group["_id"]["model"]
+        cost = estimated_cost(model, group["prompt_tokens"], group["completion_tokens"])
+        row["models"][model] = group["total_tokens"]
+        if cost is not None:
+            row["estimated_cost_usd"] = round(row["estimated_cost_usd"] + cost, 6)
+    return sorted(rows.values(), key=lambda r: r["total_tokens"], reverse=True)[:limit]
+
+
+async def ensure_llm_usage_indexes(db):
+    await db.llm_usage.create_index([("day", 1), ("patient_id", 1)])
+    await db.llm_usage.create_index([("day", 1), ("professional_id", 1)])
@@ -0,0 +1,90 @@
+"""
+Micro-batching de llamadas concurrentes.
+
+Cada mensaje de chat lanzaba su propia clasificación de sentimiento contra
+el LLM. Un `MicroBatcher` reúne las peticiones que llegan dentro de una
+ventana corta (por defecto 20 ms) o hasta `max_items`, ejecuta una sola
+llamada con el lote completo y resuelve el futuro de cada llamante con su
+propio resultado. En pico, las peticiones al proveedor (y la presión sobre
+sus límites de tasa) bajan en proporción al tamaño medio del lote.
+
+La función de lote recibe la lista de elementos y devuelve los resultados en
+el mismo orden; si lanza una excepción, todos los llamantes del lote la
+reciben. Cada lote lleva contadores para medir su tamaño medio.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Generic, List, Optional, Set, Tuple, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+_batchers: Dict[str, "MicroBatcher"] = {}
+
+
+class MicroBatcher(Generic[T, R]):
+    def __init__(self, name: str, run_batch: Callable[[List[T]], Awaitable[List[R]]], max_items: int = 16, window: float = 0.02):
+        self.name = name
+        self.run_batch = run_batch
+        self.max_items = max_items
+        self.window = window
+        self._pending: List[Tuple[T, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # El loop solo guarda referencias débiles a las tareas: sin esta, un lote en curso podría recolectarse
+        self._running: Set[asyncio.Task] = set()
+        self.items = 0
+        self.batches = 0
+        self.failed_batches = 0
+        _batchers[name] = self
+
+    async def submit(self, item: T) -> R:
+        """Añade `item` al lote en curso y espera su resultado"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((item, future))
+        self.items += 1
+        if len(self._pending) >= self.max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        # Si un llamante se cancela, el lote sigue para los demás
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            self.batches += 1
+            task = asyncio.ensure_future(self._run(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: List[Tuple[T, asyncio.Future]]):
+        try:
+            results = await self.run_batch([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(f"{self.name}: {len(results)} results for {len(batch)} items")
+        except Exception as e:
+            self.failed_batches += 1
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "items": self.items,
+            "batches": self.batches,
+            "failed_batches": self.failed_batches,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "pending": len(self._pending),
+            "running_batches": len(self._running),
+        }
+
+
+def micro_batch_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: batcher.stats() for name, batcher in _batchers.items()}
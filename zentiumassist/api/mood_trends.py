@@ -0,0 +1,254 @@
+"""
+Motor de tendencias de ánimo y progreso sobre las sesiones.
+
+Las series de sesiones de uno o muchos pacientes se cargan en arreglos de
+NumPy ordenados por (paciente, fecha) y todas las métricas se calculan por
+grupos de forma vectorizada, sin bucles de Python por paciente.
+"""
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from compute_pool import THREAD, cpu_bound
+
+SESSION_TREND_FIELDS = {
+    "_id": 0,
+    "id": 1,
+    "patient_id": 1,
+    "session_date": 1,
+    "mood_before": 1,
+    "mood_after": 1,
+    "duration_minutes": 1,
+}
+
+DEFAULT_WINDOW = 3
+
+# Umbrales de deterioro (escala de ánimo 1-10)
+SLOPE_DETERIORATION_PER_WEEK = -0.5
+WINDOW_DROP_DETERIORATION = -1.5
+LOW_MOOD_THRESHOLD = 3.0
+
+# Series pequeñas: el cálculo cuesta menos que el salto a otro hilo
+INLINE_SESSIONS = 500
+
+EPOCH = datetime(1970, 1, 1)
+
+
+@dataclass
+class SessionSeries:
+    """Series de sesiones en columnas, ordenadas por paciente y fecha"""
+    patient_ids: np.ndarray      # ids únicos de paciente, uno por grupo
+    codes: np.ndarray            # índice de grupo de cada sesión
+    session_ids: List[str]
+    session_dates: List[Optional[datetime]]
+    days: np.ndarray             # días desde epoch (float64)
+    mood_before: np.ndarray      # float64, NaN si falta
+    mood_after: np.ndarray
+    duration: np.ndarray
+
+    @property
+    def size(self) -> int:
+        return int(self.codes.size)
+
+
+def _as_float(value: Optional[Any]) -> float:
+    return float("nan") if value is None else float(value)
+
+
+async def load_session_series(db, query: Dict[str, Any]) -> SessionSeries:
+    """Carga las sesiones que cumplen `query` en arreglos columnares"""
+    cursor = db.sessions.find(query, SESSION_TREND_FIELDS).sort([("patient_id", 1), ("session_date", 1)])
+
+    patient_col: List[str] = []
+    session_ids: List[str] = []
+    session_dates: List[Optional[datetime]] = []
+    days: List[float] = []
+    before: List[float] = []
+    after: List[float] = []
+    duration: List[float] = []
+    async for doc in cursor:
+        session_date = doc.get("session_date")
+        patient_col.append(doc["patient_id"])
+        session_ids.append(doc.get("id"))
+        session_dates.append(session_date)
+        days.append((session_date - EPOCH).total_seconds() / 86400.0 if isinstance(session_date, datetime) else float("nan"))
+        before.append(_as_float(doc.get("mood_before")))
+        after.append(_as_float(doc.get("mood_after")))
+        duration.append(_as_float(doc.get("duration_minutes")))
+
+    patient_ids, codes = np.unique(np.asarray(patient_col, dtype=object), return_inverse=True)
+    return SessionSeries(
+        patient_ids=patient_ids,
+        codes=codes.astype(np.int64),
+        session_ids=session_ids,
+        session_dates=session_dates,
+        days=np.asarray(days, dtype=np.float64),
+        mood_before=np.asarray(before, dtype=np.float64),
+        mood_after=np.asarray(after, dtype=np.float64),
+        duration=np.asarray(duration, dtype=np.float64),
+    )
+
+
+def _group_starts(codes: np.ndarray, groups: int) -> np.ndarray:
+    """Índice de la primera sesión de cada grupo (las sesiones son contiguas por grupo)"""
+    starts = np.zeros(groups, dtype=np.int64)
+    if codes.size:
+        boundaries = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        starts[codes[boundaries]] = boundaries
+    return starts
+
+
+def _group_ends(codes: np.ndarray, groups: int) -> np.ndarray:
+    """Índice de la última sesión de cada grupo"""
+    ends = np.zeros(groups, dtype=np.int64)
+    if codes.size:
+        boundaries = np.flatnonzero(np.r_[codes[1:] != codes[:-1], True])
+        ends[codes[boundaries]] = boundaries
+    return ends
+
+
+def grouped_rolling_mean(values: np.ndarray, codes: np.ndarray, window: int) -> np.ndarray:
+    """Media móvil de `window` sesiones dentro de cada grupo, ignorando NaN"""
+    n = values.size
+    if n == 0:
+        return np.empty(0, dtype=np.float64)
+    valid = ~np.isnan(values)
+    csum = np.concatenate(([0.0], np.cumsum(np.where(valid, values, 0.0))))
+    ccount = np.concatenate(([0], np.cumsum(valid)))
+
+    groups = int(codes.max()) + 1
+    starts = _group_starts(codes, groups)[codes]
+    idx = np.arange(n)
+    lo = np.maximum(idx + 1 - window, starts)
+    sums = csum[idx + 1] - csum[lo]
+    counts = ccount[idx + 1] - ccount[lo]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+
+def _grouped_nanmean(values: np.ndarray, codes: np.ndarray, groups: int) -> np.ndarray:
+    valid = ~np.isnan(values)
+    sums = np.bincount(codes, weights=np.where(valid, values, 0.0), minlength=groups)
+    counts = np.bincount(codes, weights=valid.astype(np.float64), minlength=groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+
+def grouped_slope(x: np.ndarray, y: np.ndarray, codes: np.ndarray, groups: int) -> np.ndarray:
+    """Pendiente de mínimos cuadrados de y frente a x para cada grupo"""
+    valid = ~(np.isnan(x) | np.isnan(y))
+    xv = np.where(valid, x, 0.0)
+    yv = np.where(valid, y, 0.0)
+    n = np.bincount(codes, weights=valid.astype(np.float64), minlength=groups)
+    sx = np.bincount(codes, weights=xv, minlength=groups)
+    sy = np.bincount(codes, weights=yv, minlength=groups)
+    sxx = np.bincount(codes, weights=xv * xv, minlength=groups)
+    sxy = np.bincount(codes, weights=xv * yv, minlength=groups)
+    denominator = n * sxx - sx * sx
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where((n >= 2) & (denominator > 0), (n * sxy - sx * sy) / denominator, np.nan)
+
+
+def _nan_to_none(values: np.ndarray) -> List[Optional[float]]:
+    return [None if np.isnan(v) else round(float(v), 3) for v in values]
+
+
+@cpu_bound(pool=THREAD, inline_if=lambda series, window=DEFAULT_WINDOW: series.size < INLINE_SESSIONS)
+def compute_trends(series: SessionSeries, window: int = DEFAULT_WINDOW) -> Dict[str, Any]:
+    """
+    Calcula métricas de tendencia por paciente en un solo lote.
+
+    Devuelve columnas por paciente: número de sesiones, medias de ánimo,
+    delta medio (después - antes), medias móviles al final de la serie,
+    pendiente semanal del ánimo posterior y marca de deterioro.
+    """
+    groups = int(series.patient_ids.size)
+    codes = series.codes
+    if groups == 0:
+        empty = np.empty(0)
+        return {"patient_ids": [], "window": window, "columns": {}, "deteriorating": empty.astype(bool)}
+
+    # Días relativos a la primera sesión de cada paciente para estabilizar la regresión
+    starts = _group_starts(codes, groups)
+    ends = _group_ends(codes, groups)
+    days = series.days - series.days[starts][codes]
+
+    delta = series.mood_after - series.mood_before
+    rolling_after = grouped_rolling_mean(series.mood_after, codes, window)
+
+    session_count = np.bincount(codes, minlength=groups)
+    slope_per_week = grouped_slope(days, series.mood_after, codes, groups) * 7.0
+
+    last_rolling = rolling_after[ends]
+    previous_idx = ends - window
+    has_previous = previous_idx >= starts
+    previous_rolling = np.where(has_previous, rolling_after[np.maximum(previous_idx, 0)], np.nan)
+    window_change = last_rolling - previous_rolling
+
+    with np.errstate(invalid="ignore"):
+        deteriorating = (
+            (slope_per_week <= SLOPE_DETERIORATION_PER_WEEK)
+            | (window_change <= WINDOW_DROP_DETERIORATION)
+            | (last_rolling <= LOW_MOOD_THRESHOLD)
+        )
+
+    return {
+        "patient_ids": series.patient_ids.tolist(),
+        "window": window,
+        "columns": {
+            "session_count": session_count,
+            "avg_mood_before": _grouped_nanmean(series.mood_before, codes, groups),
+            "avg_mood_after": _grouped_nanmean(series.mood_after, codes, groups),
+            "avg_mood_delta": _grouped_nanmean(delta, codes, groups),
+            "avg_duration_minutes": _grouped_nanmean(series.duration, codes, groups),
+            "rolling_mood_after": last_rolling,
+            "window_change": window_change,
+            "slope_per_week": slope_per_week,
+        },
+        "deteriorating": deteriorating,
+    }
+
+
+def trends_to_records(trends: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Convierte el resultado columnar en una lista de resúmenes por paciente"""
+    columns = trends["columns"]
+    if not trends["patient_ids"]:
+        return []
+    converted = {
+        name: (values.tolist() if name == "session_count" else _nan_to_none(values))
+        for name, values in columns.items()
+    }
+    deteriorating = trends["deteriorating"].tolist()
+    return [
+        {
+            "patient_id": patient_id,
+            **{name: values[i] for name, values in converted.items()},
+            "deteriorating": bool(deteriorating[i]),
+        }
+        for i, patient_id in enumerate(trends["patient_ids"])
+    ]
+
+
+def session_timeline(series: SessionSeries, window: int = DEFAULT_WINDOW) -> List[Dict[str, Any]]:
+    """Serie por sesión con medias móviles, para la vista de un paciente"""
+    rolling_before = grouped_rolling_mean(series.mood_before, series.codes, window)
+    rolling_after = grouped_rolling_mean(series.mood_after, series.codes, window)
+    delta = series.mood_after - series.mood_before
+    columns = {
+        "mood_before": _nan_to_none(series.mood_before),
+        "mood_after": _nan_to_none(series.mood_after),
+        "mood_delta": _nan_to_none(delta),
+        "rolling_mood_before": _nan_to_none(rolling_before),
+        "rolling_mood_after": _nan_to_none(rolling_after),
+    }
+    return [
+        {
+            "session_id": session_id,
+            "session_date": series.session_dates[i],
+            **{name: values[i] for name, values in columns.items()},
+        }
+        for i, session_id in enumerate(series.session_ids)
+    ]
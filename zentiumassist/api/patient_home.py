@@ -0,0 +1,145 @@
+"""
+Pantalla de inicio del paciente en una sola petición.
+
+Al abrir la vista del paciente el frontend pedía perfil, historial de chat,
+tareas y sesiones por separado: cuatro viajes por el proxy y por toda la pila
+de middlewares. `load_patient_home` lanza las cuatro lecturas a la vez con
+`asyncio.gather` y devuelve solo los campos que pinta cada sección.
+
+Fallo parcial: cada sección tiene su propio timeout y sus errores se recogen
+en `errors` (`{"tasks": "timeout"}`) con la sección a `null`; el resto de la
+respuesta sigue siendo válida y el frontend puede reintentar solo lo que falte.
+
+Benchmark contra las cuatro llamadas (en serie y en paralelo, como hacía el
+frontend), con la API en marcha:
+
+    python patient_home.py --base-url http://localhost:8001/api --patient <id> --rounds 100
+"""
+
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+PATIENT_HOME_SECTION_TIMEOUT_SECONDS = float(os.environ.get("PATIENT_HOME_SECTION_TIMEOUT_SECONDS", "3"))
+CHAT_LIMIT = 50
+TASKS_LIMIT = 50
+SESSIONS_LIMIT = 20
+
+PROFILE_FIELDS = [
+    "id", "user_id", "professional_id", "age", "gender", "diagnosis", "risk_level",
+    "session_count", "last_session", "created_at",
+]
+TASK_FIELDS = [
+    "id", "title", "description", "task_type", "status", "due_date", "completion_notes",
+    "ai_feedback", "created_at", "completed_at",
+]
+# Sin `transcript` ni `ai_analysis`, con diferencia los campos más pesados de la sesión
+SESSION_FIELDS = [
+    "id", "session_type", "status", "session_date", "duration_minutes", "notes",
+    "mood_before", "mood_after",
+]
+
+logger = logging.getLogger(__name__)
+
+
+class PatientNotFound(Exception):
+    pass
+
+
+async def _section(name: str, load: Callable[[], Awaitable[Any]], timeout: float, errors: Dict[str, str]) -> Any:
+    try:
+        return await asyncio.wait_for(load(), timeout)
+    except PatientNotFound:
+        raise
+    except asyncio.TimeoutError:
+        errors[name] = "timeout"
+    except Exception as e:
+        logger.error(f"Patient home section {name} failed: {e}")
+        errors[name] = "error"
+    return None
+
+
+async def load_patient_home(
+    repos,
+    load_profile: Callable[[str], Awaitable[Optional[Dict[str, Any]]]],
+    patient_id: str,
+    timeout: float = PATIENT_HOME_SECTION_TIMEOUT_SECONDS,
+) -> Dict[str, Any]:
+    """Perfil, chat reciente (más antiguo primero), tareas y sesiones; lanza `PatientNotFound`"""
+    errors: Dict[str, str] = {}
+
+    async def profile():
+        patient = await load_profile(patient_id)
+        if patient is None:
+            raise PatientNotFound(patient_id)
+        return {field: patient.get(field) for field in PROFILE_FIELDS}
+
+    async def chat():
+        return list(reversed(await repos.chat.history(patient_id, CHAT_LIMIT)))
+
+    sections = ("profile", "chat", "tasks", "sessions")
+    results = await asyncio.gather(
+        _section("profile", profile, timeout, errors),
+        _section("chat", chat, timeout, errors),
+        _section("tasks", lambda: repos.tasks.list_by_patient(patient_id, TASKS_LIMIT, TASK_FIELDS), timeout, errors),
+        _section("sessions", lambda: repos.sessions.list_by_patient(patient_id, SESSIONS_LIMIT, SESSION_FIELDS), timeout, errors),
+    )
+    home = dict(zip(sections, results))
+    home["errors"] = errors
+    return home
+
+
+# =============================================================================
+# BENCHMARK
+# =============================================================================
+
+def benchmark(base_url: str, patient_id: str, rounds: int):
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    import requests
+
+    paths = [
+        f"/patients/{patient_id}/profile",
+        f"/chat/{patient_id}/history",
+        f"/patients/{patient_id}/tasks",
+        f"/patients/{patient_id}/sessions",
+    ]
+    http = requests.Session()
+    parallel = ThreadPoolExecutor(max_workers=len(paths))
+
+    def fetch(path: str) -> int:
+        response = http.get(base_url + path)
+        response.raise_for_status()
+        return len(response.content)
+
+    variants = {
+        "4 llamadas en serie": lambda: sum(fetch(path) for path in paths),
+        "4 llamadas en paralelo": lambda: sum(parallel.map(fetch, paths)),
+        "patient home": lambda: fetch(f"/patients/{patient_id}/home"),
+    }
+    print(f"{'variante':<24}{'p50 ms':>10}{'p95 ms':>10}{'bytes':>10}")
+    for name, run in variants.items():
+        run()  # calentamiento
+        latencies = []
+        for _ in range(rounds):
+            started = time.perf_counter()
+            size = run()
+            latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1000
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000
+        print(f"{name:<24}{p50:>10.2f}{p95:>10.2f}{size:>10}")
+    parallel.shutdown()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Patient home frente a las cuatro llamadas por separado")
+    parser.add_argument("--base-url", default="http://localhost:8001/api")
+    parser.add_argument("--patient", required=True, help="ID del paciente")
+    parser.add_argument("--rounds", type=int, default=100)
+    args = parser.parse_args()
+    benchmark(args.base_url.rstrip("/"), args.patient, args.rounds)
@@ -0,0 +1,173 @@
+"""
+Limitación de tasa.
+
+- Token buckets en memoria por paciente, profesional e IP.
+- Opcionalmente (`RATE_LIMIT_BACKEND=mongo`) contadores atómicos por ventana
+  en Mongo para que el límite se cumpla entre varios workers.
+
+El presupuesto diario de tokens LLM por paciente se calcula sobre el ledger
+de `llm_usage`.
+
+Los endpoints deciden cuándo aplicar los límites; el tráfico con indicios de
+crisis nunca se limita.
+"""
+
+import math
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network, ip_address, ip_network
+from typing import Dict, List, Optional, Tuple, Union
+
+from fastapi import HTTPException, Request
+from pymongo import ReturnDocument
+
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+
+# Solicitudes por minuto permitidas para cada ámbito
+DEFAULT_LIMITS_PER_MINUTE = {
+    "patient": int(os.environ.get("RATE_LIMIT_PATIENT_PER_MIN", "20")),
+    "professional": int(os.environ.get("RATE_LIMIT_PROFESSIONAL_PER_MIN", "120")),
+    "ip": int(os.environ.get("RATE_LIMIT_IP_PER_MIN", "60")),
+}
+
+IPAddress = Union[IPv4Address, IPv6Address]
+IPNetwork = Union[IPv4Network, IPv6Network]
+
+# Proxies de entrada (IPs o redes, separadas por comas) cuyo X-Forwarded-For es fiable
+TRUSTED_PROXIES: List[IPNetwork] = [
+    ip_network(entry.strip(), strict=False)
+    for entry in os.environ.get("TRUSTED_PROXIES", "127.0.0.1,::1").split(",")
+    if entry.strip()
+]
+
+MAX_TRACKED_KEYS = 100_000
+WINDOW_SECONDS = 60
+
+# Aproximación habitual de ~4 caracteres por token
+CHARS_PER_TOKEN = 4
+
+
+class TokenBucket:
+    """Bucket de capacidad fija que se rellena a ritmo constante"""
+
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, amount: float = 1.0) -> Tuple[bool, float]:
+        """Consume `amount` tokens; devuelve (permitido, segundos hasta poder reintentar)"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True, 0.0
+        return False, (amount - self.tokens) / self.rate
+
+
+class RateLimiter:
+    def __init__(self, limits_per_minute: Dict[str, int], backend: str = RATE_LIMIT_BACKEND, max_keys: int = MAX_TRACKED_KEYS):
+        self.limits = limits_per_minute
+        self.backend = backend
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[Tuple[str, str], TokenBucket]" = OrderedDict()
+
+    def _bucket(self, scope: str, key: str) -> TokenBucket:
+        bucket = self._buckets.get((scope, key))
+        if bucket is None:
+            limit = self.limits[scope]
+            bucket = TokenBucket(capacity=limit, rate=limit / WINDOW_SECONDS)
+            self._buckets[(scope, key)] = bucket
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end((scope, key))
+        return bucket
+
+    async def _shared_window(self, db, scope: str, key: str) -> Tuple[bool, float]:
+        """Contador atómico por ventana fija compartido entre workers"""
+        now = time.time()
+        window = int(now // WINDOW_SECONDS)
+        counter = await db.rate_limits.find_one_and_update(
+            {"_id": f"{scope}:{key}:{window}"},
+            {
+                "$inc": {"count": 1},
+                "$setOnInsert": {"expires_at": datetime.utcnow() + timedelta(seconds=2 * WINDOW_SECONDS)}
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        if counter["count"] <= self.limits[scope]:
+            return True, 0.0
+        return False, (window + 1) * WINDOW_SECONDS - now
+
+    async def check(self, db, scope: str, key: Optional[str]) -> Tuple[bool, float]:
+        if not key:
+            return True, 0.0
+        allowed, retry_after = self._bucket(scope, key).take()
+        if allowed and self.backend == "mongo":
+            allowed, retry_after = await self._shared_window(db, scope, key)
+        return allowed, retry_after
+
+    async def enforce(self, db, **keys: Optional[str]):
+        """Aplica los límites de cada ámbito (`patient=...`, `ip=...`) y lanza 429 si alguno se excede"""
+        for scope, key in keys.items():
+            allowed, retry_after = await self.check(db, scope, key)
+            if not allowed:
+                raise too_many_requests(retry_after, "Demasiadas solicitudes. Intenta de nuevo en unos segundos.")
+
+
+def too_many_requests(retry_after: float, detail: str) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+
+def _parse_ip(address: str) -> Optional[IPAddress]:
+    try:
+        return ip_address(address)
+    except ValueError:
+        return None
+
+
+def _is_trusted(address: Optional[IPAddress], proxies: List[IPNetwork]) -> bool:
+    return address is not None and any(address in network for network in proxies)
+
+
+def client_ip(request: Request, proxies: Optional[List[IPNetwork]] = None) -> Optional[str]:
+    """
+    IP del cliente. `X-Forwarded-For` solo se tiene en cuenta si la conexión
+    viene de un proxy de `TRUSTED_PROXIES`; entonces se toma la dirección más a
+    la derecha que no sea otro proxy de confianza (las de la izquierda las
+    escribe el cliente y no sirven para limitar).
+    """
+    proxies = TRUSTED_PROXIES if proxies is None else proxies
+    peer = request.client.host if request.client else None
+    forwarded = request.headers.get("x-forwarded-for")
+    if not forwarded or peer is None or not _is_trusted(_parse_ip(peer), proxies):
+        return peer
+    for entry in reversed(forwarded.split(",")):
+        address = _parse_ip(entry.strip())
+        if address is None:
+            # Cabecera manipulada: no se puede saber quién hay detrás
+            return peer
+        if not _is_trusted(address, proxies):
+            return str(address)
+    return peer
+
+
+def estimate_tokens(*texts: Optional[str]) -> int:
+    return sum(len(text) for text in texts if text) // CHARS_PER_TOKEN + 1
+
+
+async def ensure_rate_limit_indexes(db):
+    """TTL para que los contadores de ventana caduquen solos"""
+    await db.rate_limits.create_index("expires_at", expireAfterSeconds=0)
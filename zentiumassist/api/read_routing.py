@@ -0,0 +1,90 @@
+"""
+Enrutado de lecturas en un replica set.
+
+- `db` (primario): escrituras y lecturas que deben ver lo que el propio
+  usuario acaba de escribir (enviar un mensaje y la primera página del
+  historial, perfiles, tareas, sesiones...).
+- `stale_read_db(db)`: lecturas que toleran unos segundos de retraso
+  (analíticas, dashboards, tendencias, páginas antiguas del historial) van a
+  los secundarios con `secondaryPreferred` y `maxStalenessSeconds`. Si ningún
+  secundario está lo bastante al día el driver usa el primario.
+- Si una lectura en un secundario tuviera que ver una escritura anterior,
+  ambas deben hacerse en la misma sesión causal
+  (`start_session(causal_consistency=True)`); el benchmark lo comprueba.
+
+Con un solo nodo todas las lecturas van al primario, sin cambios.
+
+`python read_routing.py [lecturas]` mide contra `MONGO_URL` (p. ej. un
+replica set local de tres nodos) cuántas consultas atiende cada miembro con
+una y otra preferencia de lectura.
+"""
+
+import os
+import sys
+import time
+
+from pymongo.read_preferences import SecondaryPreferred
+
+# Mongo exige al menos 90 s (heartbeatFrequencyMS + idleWritePeriodMS)
+MIN_MAX_STALENESS_SECONDS = 90
+MAX_STALENESS_SECONDS = max(MIN_MAX_STALENESS_SECONDS, int(os.environ.get("MONGO_MAX_STALENESS_SECONDS", "120")))
+STALE_READS_ENABLED = os.environ.get("MONGO_STALE_READS", "true").lower() == "true"
+
+
+def stale_read_preference() -> SecondaryPreferred:
+    return SecondaryPreferred(max_staleness=MAX_STALENESS_SECONDS)
+
+
+def stale_read_db(db):
+    """La misma base de datos, leyendo de secundarios cuando los hay"""
+    if not STALE_READS_ENABLED:
+        return db
+    return db.with_options(read_preference=stale_read_preference())
+
+
+def _member_query_counts(client):
+    """Consultas atendidas por cada miembro (`opcounters.query` de serverStatus)"""
+    from pymongo import MongoClient
+
+    counts = {}
+    for host, port in client.nodes:
+        member = MongoClient(host, port, directConnection=True)
+        try:
+            counts[f"{host}:{port}"] = member.admin.command("serverStatus")["opcounters"]["query"]
+        finally:
+            member.close()
+    return counts
+
+
+def benchmark(reads: int = 2000):
+    from pymongo import MongoClient
+
+    client = MongoClient(os.environ["MONGO_URL"])
+    db = client[os.environ["DB_NAME"]]
+    db.read_routing_benchmark.drop()
+    db.read_routing_benchmark.insert_many([{"n": i} for i in range(100)])
+    time.sleep(2)  # replicación a los secundarios
+
+    for label, target in (("primary", db), ("secondaryPreferred", stale_read_db(db))):
+        before = _member_query_counts(client)
+        started = time.perf_counter()
+        for i in range(reads):
+            target.read_routing_benchmark.find_one({"n": i % 100})
+        elapsed = time.perf_counter() - started
+        after = _member_query_counts(client)
+        print(f"{label}: {reads} lecturas en {elapsed:.2f}s")
+        for member, count in after.items():
+            served = count - before.get(member, count)
+            print(f"  {member}: {served} consultas ({served / reads:.0%})")
+
+    # Lectura de la propia escritura en un secundario dentro de una sesión causal
+    with client.start_session(causal_consistency=True) as session:
+        db.read_routing_benchmark.insert_one({"n": "causal"}, session=session)
+        found = stale_read_db(db).read_routing_benchmark.find_one({"n": "causal"}, session=session)
+        print(f"lectura causal en secundario: {'ok' if found else 'NO VISIBLE'}")
+    db.read_routing_benchmark.drop()
+    client.close()
+
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,156 @@
+"""
+Exportación en streaming del historial completo de pacientes y profesionales.
+
+Los documentos se leen directamente de los cursores de Mongo y se emiten
+línea a línea (NDJSON) o como entradas de un ZIP, de modo que la memoria
+usada no depende del tamaño del historial del paciente.
+"""
+
+import json
+import zipfile
+import zlib
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from chat_archive import iter_archived_messages
+from storage_codec import decode_chat_message, id_filter
+
+EXPORT_BATCH_SIZE = 500
+
+# (tipo de registro, colección, campo de orden) exportados por paciente
+PATIENT_SECTIONS: List[Tuple[str, str, str]] = [
+    ("session", "sessions", "session_date"),
+    ("task", "tasks", "created_at"),
+    ("chat_message", "chat_messages", "timestamp"),
+]
+
+
+def _json_default(value: Any):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def to_ndjson_line(record_type: str, data: Dict[str, Any]) -> bytes:
+    """Serializa un registro como una línea NDJSON"""
+    line = json.dumps({"type": record_type, "data": data}, ensure_ascii=False, default=_json_default)
+    return (line + "\n").encode("utf-8")
+
+
+async def _iter_collection(db, collection: str, query: Dict[str, Any], sort_field: str) -> AsyncIterator[Dict[str, Any]]:
+    cursor = db[collection].find(query, {"_id": 0}).sort(sort_field, 1).batch_size(EXPORT_BATCH_SIZE)
+    async for doc in cursor:
+        yield doc
+
+
+async def iter_patient_records(db, patient: Dict[str, Any]) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    """Recorre perfil, sesiones, tareas y chat completo (archivado y reciente) de un paciente"""
+    yield "patient", patient
+    for record_type, collection, sort_field in PATIENT_SECTIONS:
+        if collection == "chat_messages":
+            async for doc in iter_archived_messages(db, patient["id"]):
+                yield record_type, doc
+            async for doc in _iter_collection(db, collection, {"patient_id": id_filter(patient["id"])}, sort_field):
+                yield record_type, decode_chat_message(doc)
+            continue
+        async for doc in _iter_collection(db, collection, {"patient_id": patient["id"]}, sort_field):
+            yield record_type, doc
+
+
+async def iter_professional_records(db, professional: Dict[str, Any]) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    """Recorre el perfil del profesional y el historial de cada paciente asignado"""
+    yield "professional", professional
+    patients = db.patients.find({"professional_id": professional["id"]}, {"_id": 0}).batch_size(EXPORT_BATCH_SIZE)
+    async for patient in patients:
+        async for record in iter_patient_records(db, patient):
+            yield record
+
+
+async def stream_ndjson(records: AsyncIterator[Tuple[str, Dict[str, Any]]], compress: bool = False) -> AsyncIterator[bytes]:
+    """Convierte los registros en NDJSON, comprimiendo con gzip al vuelo si se pide"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    async for record_type, data in records:
+        chunk = to_ndjson_line(record_type, data)
+        if compressor:
+            chunk = compressor.compress(chunk)
+            if not chunk:
+                continue
+        yield chunk
+    if compressor:
+        yield compressor.flush()
+
+
+class _ChunkSink:
+    """Destino no posicionable para zipfile que acumula bytes hasta vaciarlos"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _zip_entry_name(prefix: str, record_type: str) -> str:
+    if record_type in ("patient", "professional"):
+        return f"{prefix}{record_type}.ndjson"
+    return f"{prefix}{record_type}s.ndjson"
+
+
+async def stream_zip(records: AsyncIterator[Tuple[str, Dict[str, Any]]]) -> AsyncIterator[bytes]:
+    """
+    Empaqueta los registros en un ZIP con una entrada por tipo y paciente.
+
+    Los registros llegan agrupados por paciente y tipo, así que basta con
+    abrir una entrada nueva cada vez que cambia el tipo o empieza un paciente.
+    """
+    sink = _ChunkSink()
+    archive = zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED)
+    entry = None
+    entry_type: Optional[str] = None
+    prefix = ""
+    try:
+        async for record_type, data in records:
+            if record_type != entry_type or record_type == "patient":
+                if entry:
+                    entry.close()
+                if record_type == "patient":
+                    prefix = f"patients/{data['id']}/"
+                entry = archive.open(_zip_entry_name(prefix, record_type), mode="w", force_zip64=True)
+                entry_type = record_type
+            entry.write(to_ndjson_line(record_type, data))
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+        if entry:
+            entry.close()
+    finally:
+        archive.close()
+    yield sink.drain()
+
+
+def export_filename(prefix: str, entity_id: str, fmt: str, compress: bool) -> str:
+    if fmt == "zip":
+        return f"{prefix}-{entity_id}.zip"
+    return f"{prefix}-{entity_id}.ndjson" + (".gz" if compress else "")
+
+
+def export_media_type(fmt: str, compress: bool) -> str:
+    if fmt == "zip":
+        return "application/zip"
+    return "application/gzip" if compress else "application/x-ndjson"
+
+
+def export_stream(records: AsyncIterator[Tuple[str, Dict[str, Any]]], fmt: str, compress: bool) -> AsyncIterator[bytes]:
+    if fmt == "zip":
+        return stream_zip(records)
+    return stream_ndjson(records, compress=compress)
+
@@ -0,0 +1,192 @@
+"""
+Capa de repositorios: acceso a datos por agregado, independiente del motor.
+
+Cada agregado (pacientes, sesiones, tareas, chat) tiene una interfaz asíncrona
+que trabaja con diccionarios en la forma de la API. `mongo_repositories` es la
+implementación sobre Motor que usan los handlers; `sql_repositories` ofrece la
+misma interfaz sobre SQLite o MariaDB, y `repository_benchmark.py` ejecuta la
+misma carga de endpoints sobre ambas.
+
+`version` devuelve la huella (número de documentos y fechas máximas) con la
+que los handlers calculan el ETag de cada listado.
+"""
+
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from chat_archive import read_chat_history
+from http_cache import collection_version
+from storage_codec import encode_chat_message, id_filter
+
+Document = Dict[str, Any]
+Version = Tuple[Any, ...]
+
+
+class PatientRepository(ABC):
+    @abstractmethod
+    async def get(self, patient_id: str) -> Optional[Document]:
+        ...
+
+    @abstractmethod
+    async def list_by_professional(self, professional_id: str, risk_level: Optional[str] = None, limit: int = 100) -> List[Document]:
+        """Pacientes del profesional, de mayor a menor `risk_score`"""
+
+    @abstractmethod
+    async def create(self, patient: Document):
+        ...
+
+
+class SessionRepository(ABC):
+    @abstractmethod
+    async def create(self, session: Document):
+        ...
+
+    @abstractmethod
+    async def list_by_patient(self, patient_id: str, limit: int = 50, fields: Optional[Sequence[str]] = None) -> List[Document]:
+        """Sesiones del paciente, de la más reciente a la más antigua; solo `fields` si se indican"""
+
+    @abstractmethod
+    async def version(self, patient_id: str) -> Version:
+        ...
+
+
+class TaskRepository(ABC):
+    @abstractmethod
+    async def create(self, task: Document):
+        ...
+
+    @abstractmethod
+    async def list_by_patient(self, patient_id: str, limit: int = 50, fields: Optional[Sequence[str]] = None) -> List[Document]:
+        """Tareas del paciente, de la más reciente a la más antigua; solo `fields` si se indican"""
+
+    @abstractmethod
+    async def complete(self, task_id: str, completion_notes: Optional[str], completed_at: datetime) -> bool:
+        """Marca la tarea como completada con feedback pendiente; False si no existe"""
+
+    @abstractmethod
+    async def version(self, patient_id: str) -> Version:
+        ...
+
+
+class ChatRepository(ABC):
+    @abstractmethod
+    async def append(self, messages: List[Document]):
+        ...
+
+    @abstractmethod
+    async def history(self, patient_id: str, limit: int, before: Optional[datetime] = None) -> List[Document]:
+        """Mensajes del más reciente al más antiguo, anteriores a `before` si se indica"""
+
+    @abstractmethod
+    async def version(self, patient_id: str) -> Version:
+        ...
+
+
+def projection(fields: Optional[Sequence[str]]) -> Dict[str, int]:
+    if fields is None:
+        return {"_id": 0}
+    return {"_id": 0, **{field: 1 for field in fields}}
+
+
+@dataclass
+class Repositories:
+    patients: PatientRepository
+    sessions: SessionRepository
+    tasks: TaskRepository
+    chat: ChatRepository
+
+
+# =============================================================================
+# MONGO
+# =============================================================================
+
+class MongoPatientRepository(PatientRepository):
+    def __init__(self, db):
+        self.db = db
+
+    async def get(self, patient_id: str) -> Optional[Document]:
+        return await self.db.patients.find_one({"id": patient_id}, {"_id": 0})
+
+    async def list_by_professional(self, professional_id: str, risk_level: Optional[str] = None, limit: int = 100) -> List[Document]:
+        query = {"professional_id": professional_id}
+        if risk_level:
+            query["risk_level"] = risk_level
+        return await self.db.patients.find(query, {"_id": 0}).sort("risk_score", -1).to_list(limit)
+
+    async def create(self, patient: Document):
+        await self.db.patients.insert_one(dict(patient))
+
+
+class MongoSessionRepository(SessionRepository):
+    def __init__(self, db):
+        self.db = db
+
+    async def create(self, session: Document):
+        await self.db.sessions.insert_one(dict(session))
+
+    async def list_by_patient(self, patient_id: str, limit: int = 50, fields: Optional[Sequence[str]] = None) -> List[Document]:
+        cursor = self.db.sessions.find({"patient_id": patient_id}, projection(fields))
+        return await cursor.sort("session_date", -1).to_list(limit)
+
+    async def version(self, patient_id: str) -> Version:
+        return await collection_version(self.db, "sessions", {"patient_id": patient_id}, ["created_at", "updated_at"])
+
+
+class MongoTaskRepository(TaskRepository):
+    def __init__(self, db):
+        self.db = db
+
+    async def create(self, task: Document):
+        await self.db.tasks.insert_one(dict(task))
+
+    async def list_by_patient(self, patient_id: str, limit: int = 50, fields: Optional[Sequence[str]] = None) -> List[Document]:
+        cursor = self.db.tasks.find({"patient_id": patient_id}, projection(fields))
+        return await cursor.sort("created_at", -1).to_list(limit)
+
+    async def complete(self, task_id: str, completion_notes: Optional[str], completed_at: datetime) -> bool:
+        result = await self.db.tasks.update_one(
+            {"id": task_id},
+            {
+                "$set": {
+                    "status": "completed",
+                    "completed_at": completed_at,
+                    "completion_notes": completion_notes,
+                    "updated_at": completed_at,
+                    "ai_feedback_pending": True
+                },
+                "$unset": {"ai_feedback_attempts": "", "ai_feedback_retry_at": "", "ai_feedback_failed": ""}
+            }
+        )
+        return result.matched_count > 0
+
+    async def version(self, patient_id: str) -> Version:
+        return await collection_version(self.db, "tasks", {"patient_id": patient_id}, ["created_at", "updated_at"])
+
+
+class MongoChatRepository(ChatRepository):
+    def __init__(self, db, stale_db=None):
+        self.db = db
+        # Las páginas antiguas no cambian: pueden leerse de secundarios
+        self.stale_db = stale_db if stale_db is not None else db
+
+    async def append(self, messages: List[Document]):
+        await self.db.chat_messages.insert_many([encode_chat_message(m) for m in messages])
+
+    async def history(self, patient_id: str, limit: int, before: Optional[datetime] = None) -> List[Document]:
+        # Lee los mensajes recientes y, al paginar hacia atrás, el archivo
+        return await read_chat_history(self.db if before is None else self.stale_db, patient_id, limit, before)
+
+    async def version(self, patient_id: str) -> Version:
+        # Los mensajes son inmutables: el más reciente y el total identifican la primera página
+        return await collection_version(self.db, "chat_messages", {"patient_id": id_filter(patient_id)}, ["timestamp"])
+
+
+def mongo_repositories(db, stale_db=None) -> Repositories:
+    return Repositories(
+        patients=MongoPatientRepository(db),
+        sessions=MongoSessionRepository(db),
+        tasks=MongoTaskRepository(db),
+        chat=MongoChatRepository(db, stale_db),
+    )
@@ -0,0 +1,229 @@
+"""
+Cálculo y mantenimiento de `Patient.risk_level`.
+
+Dos modos:
+- Por eventos: cada análisis de sesión o mensaje de crisis eleva el nivel
+  de riesgo del paciente con una actualización atómica (nunca lo reduce).
+- En lote: un recálculo periódico combina crisis recientes, historial de
+  sentimiento, el último análisis clínico y las tendencias de ánimo para
+  todos los pacientes a la vez, y escribe los cambios con `bulk_write`.
+"""
+
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+from background_jobs import run_periodic
+from entity_cache import patient_cache
+from mood_trends import compute_trends, load_session_series
+from storage_codec import decode_uuid, sentiment_filter
+
+RISK_LEVELS = ["low", "medium", "high"]
+RISK_RANK = {level: rank for rank, level in enumerate(RISK_LEVELS)}
+
+# El análisis de transcripciones responde en español
+ANALYSIS_RISK_ALIASES = {
+    "bajo": "low", "baja": "low", "low": "low",
+    "medio": "medium", "media": "medium", "moderado": "medium", "medium": "medium",
+    "alto": "high", "alta": "high", "high": "high", "crítico": "high", "critico": "high",
+}
+
+NEGATIVE_SENTIMENTS = ("negativo", "negative", "crisis")
+
+RISK_LOOKBACK_DAYS = int(os.environ.get("RISK_LOOKBACK_DAYS", "30"))
+RECENT_CRISIS_DAYS = 7
+RESCORE_INTERVAL_HOURS = float(os.environ.get("RISK_RESCORE_INTERVAL_HOURS", "24"))
+BULK_WRITE_CHUNK = 1000
+
+# Pesos del score compuesto (0-100)
+WEIGHT_CRISIS = 40.0
+WEIGHT_SENTIMENT = 25.0
+WEIGHT_ANALYSIS = 20.0
+WEIGHT_MOOD = 15.0
+CRISIS_SATURATION = 3
+MEDIUM_THRESHOLD = 30.0
+HIGH_THRESHOLD = 60.0
+LEVEL_SCORE_FLOOR = {"low": 0.0, "medium": MEDIUM_THRESHOLD, "high": HIGH_THRESHOLD}
+
+
+def normalize_risk_level(value: Optional[str]) -> Optional[str]:
+    """Normaliza el nivel de riesgo devuelto por la IA a low/medium/high"""
+    if not value or not isinstance(value, str):
+        return None
+    return ANALYSIS_RISK_ALIASES.get(value.strip().lower())
+
+
+def _lower_levels(level: str) -> List[str]:
+    return RISK_LEVELS[:RISK_RANK[level]]
+
+
+async def escalate_patient_risk(db, patient_id: str, level: str, reason: str) -> bool:
+    """
+    Eleva el nivel de riesgo del paciente si el actual es inferior.
+
+    El filtro sobre los niveles inferiores hace la operación atómica e
+    idempotente; las bajadas de nivel solo las aplica el recálculo en lote.
+    """
+    lower = _lower_levels(level)
+    if not lower:
+        return False
+    result = await db.patients.update_one(
+        {"id": patient_id, "risk_level": {"$in": lower + [None]}},
+        {
+            "$set": {
+                "risk_level": level,
+                "risk_reason": reason,
+                "risk_updated_at": datetime.utcnow()
+            },
+            "$max": {"risk_score": LEVEL_SCORE_FLOOR[level]}
+        }
+    )
+    patient_cache.invalidate(patient_id)
+    return result.modified_count > 0
+
+
+async def apply_session_analysis_risk(db, patient_id: str, analysis: Dict[str, Any]) -> bool:
+    """Actualización incremental tras analizar la transcripción de una sesión"""
+    level = normalize_risk_level(analysis.get("risk_level"))
+    if not level:
+        return False
+    return await escalate_patient_risk(db, patient_id, level, "session_analysis")
+
+
+async def record_crisis_event(db, patient_id: str) -> bool:
+    """Actualización incremental cuando un mensaje de chat se marca como crisis"""
+    await db.patients.update_one(
+        {"id": patient_id},
+        {"$inc": {"crisis_count": 1}, "$set": {"last_crisis_at": datetime.utcnow()}}
+    )
+    patient_cache.invalidate(patient_id)
+    return await escalate_patient_risk(db, patient_id, "high", "crisis_message")
+
+
+async def _count_by_patient(db, collection: str, match: Dict[str, Any]) -> Dict[str, int]:
+    pipeline = [{"$match": match}, {"$group": {"_id": "$patient_id", "count": {"$sum": 1}}}]
+    counts: Dict[str, int] = {}
+    async for doc in db[collection].aggregate(pipeline):
+        # Durante la migración un paciente puede tener ids en ambas formas
+        patient_id = decode_uuid(doc["_id"])
+        counts[patient_id] = counts.get(patient_id, 0) + doc["count"]
+    return counts
+
+
+async def _latest_analysis_levels(db, since: datetime) -> Dict[str, Optional[str]]:
+    pipeline = [
+        {"$match": {"ai_analysis.risk_level": {"$exists": True}, "session_date": {"$gte": since}}},
+        {"$sort": {"session_date": -1}},
+        {"$group": {"_id": "$patient_id", "risk_level": {"$first": "$ai_analysis.risk_level"}}},
+    ]
+    return {
+        doc["_id"]: normalize_risk_level(doc["risk_level"])
+        async for doc in db.sessions.aggregate(pipeline)
+    }
+
+
+def _align(patient_ids: List[str], values: Dict[str, Any], default=0.0) -> np.ndarray:
+    return np.fromiter((values.get(pid, default) for pid in patient_ids), dtype=np.float64, count=len(patient_ids))
+
+
+def score_patients(
+    crisis_counts: np.ndarray,
+    recent_crisis: np.ndarray,
+    negative_ratio: np.ndarray,
+    analysis_rank: np.ndarray,
+    deteriorating: np.ndarray,
+) -> Dict[str, np.ndarray]:
+    """Combina las señales en un score 0-100 y un nivel por paciente"""
+    score = (
+        WEIGHT_CRISIS * np.minimum(crisis_counts, CRISIS_SATURATION) / CRISIS_SATURATION
+        + WEIGHT_SENTIMENT * negative_ratio
+        + WEIGHT_ANALYSIS * analysis_rank / (len(RISK_LEVELS) - 1)
+        + WEIGHT_MOOD * deteriorating
+    )
+    rank = np.where(score >= HIGH_THRESHOLD, 2, np.where(score >= MEDIUM_THRESHOLD, 1, 0))
+    # Una crisis reciente o un análisis de riesgo alto siempre implican riesgo alto
+    rank = np.where((recent_crisis > 0) | (analysis_rank >= 2), 2, rank)
+    # El score nunca queda por debajo del umbral de su nivel, para ordenar de forma coherente
+    floors = np.array([LEVEL_SCORE_FLOOR[level] for level in RISK_LEVELS])
+    score = np.maximum(score, floors[rank])
+    return {"score": np.round(score, 1), "rank": rank}
+
+
+async def recompute_all_risk(db, now: Optional[datetime] = None) -> Dict[str, Any]:
+    """Recalcula el riesgo de todos los pacientes y escribe solo los cambios"""
+    now = now or datetime.utcnow()
+    since = now - timedelta(days=RISK_LOOKBACK_DAYS)
+    recent_since = now - timedelta(days=RECENT_CRISIS_DAYS)
+
+    current = {
+        doc["id"]: (doc.get("risk_level"), doc.get("risk_score"))
+        async for doc in db.patients.find({}, {"_id": 0, "id": 1, "risk_level": 1, "risk_score": 1})
+    }
+    patient_ids = list(current)
+    if not patient_ids:
+        return {"patients": 0, "updated": 0, "computed_at": now}
+
+    crisis = await _count_by_patient(db, "chat_messages", {"is_crisis": True, "timestamp": {"$gte": since}})
+    recent = await _count_by_patient(db, "chat_messages", {"is_crisis": True, "timestamp": {"$gte": recent_since}})
+    sentiment_total = await _count_by_patient(
+        db, "chat_messages", {**sentiment_filter(), "timestamp": {"$gte": since}}
+    )
+    sentiment_negative = await _count_by_patient(
+        db, "chat_messages", {**sentiment_filter(NEGATIVE_SENTIMENTS), "timestamp": {"$gte": since}}
+    )
+    analysis_levels = await _latest_analysis_levels(db, since)
+    trends = await compute_trends.offload(await load_session_series(db, {"session_date": {"$gte": since}}))
+    deteriorating = dict(zip(trends["patient_ids"], trends["deteriorating"].astype(np.float64)))
+
+    total = _align(patient_ids, sentiment_total)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        negative_ratio = np.where(total > 0, _align(patient_ids, sentiment_negative) / np.maximum(total, 1), 0.0)
+    result = score_patients(
+        crisis_counts=_align(patient_ids, crisis),
+        recent_crisis=_align(patient_ids, recent),
+        negative_ratio=negative_ratio,
+        analysis_rank=_align(patient_ids, {pid: RISK_RANK[lvl] for pid, lvl in analysis_levels.items() if lvl}),
+        deteriorating=_align(patient_ids, deteriorating),
+    )
+
+    operations = []
+    changed_ids = []
+    for pid, score, rank in zip(patient_ids, result["score"].tolist(), result["rank"].tolist()):
+        level = RISK_LEVELS[rank]
+        if current[pid] == (level, score):
+            continue
+        changed_ids.append(pid)
+        operations.append(UpdateOne(
+            {"id": pid},
+            {"$set": {"risk_level": level, "risk_score": score, "risk_reason": "batch_rescore", "risk_updated_at": now}}
+        ))
+
+    updated = 0
+    for start in range(0, len(operations), BULK_WRITE_CHUNK):
+        outcome = await db.patients.bulk_write(operations[start:start + BULK_WRITE_CHUNK], ordered=False)
+        updated += outcome.modified_count
+    patient_cache.invalidate(*changed_ids)
+
+    levels, counts = np.unique(result["rank"], return_counts=True)
+    return {
+        "patients": len(patient_ids),
+        "updated": updated,
+        "distribution": {RISK_LEVELS[int(lvl)]: int(n) for lvl, n in zip(levels, counts)},
+        "computed_at": now
+    }
+
+
+async def ensure_risk_indexes(db):
+    """Índices para ordenar y filtrar pacientes por riesgo desde los dashboards"""
+    await db.patients.create_index([("professional_id", ASCENDING), ("risk_score", DESCENDING)])
+    await db.patients.create_index([("professional_id", ASCENDING), ("risk_level", ASCENDING)])
+    await db.chat_messages.create_index([("is_crisis", ASCENDING), ("timestamp", DESCENDING)])
+
+
+async def risk_rescore_loop(db):
+    """Recálculo periódico (por defecto cada 24 h) mientras la app está activa"""
+    interval = timedelta(hours=RESCORE_INTERVAL_HOURS)
+    await run_periodic(db, "risk_rescore", interval, lambda: recompute_all_risk(db))
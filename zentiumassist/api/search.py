@@ -0,0 +1,326 @@
+"""
+Búsqueda de texto completo en el historial clínico.
+
+Usa índices de texto de Mongo con idioma español (stemming de Snowball e
+insensibilidad a tildes) sobre `chat_messages.message` y
+`sessions.notes` / `sessions.transcript`. Cada resultado trae un fragmento
+con las posiciones de los términos encontrados para resaltarlos en el
+frontend.
+
+El `textScore` de cada colección depende de los pesos de su índice (las notas
+pesan el triple que la transcripción), así que no es comparable entre
+fuentes: cada fuente se ordena por su `textScore` (`text_score`) y se escala
+a su mejor resultado (`score` = 1.0) antes de mezclarlas.
+
+La búsqueda siempre se acota a los pacientes de un profesional. Los
+mensajes ya movidos a `chat_archive` no se indexan.
+
+Benchmark sobre un corpus sintético (por defecto 2 millones de mensajes) en
+`<DB_NAME>_search_benchmark`:
+
+    python search.py generate --messages 2000000 --patients 20000
+    python search.py bench --rounds 20
+    python search.py drop
+"""
+
+import re
+import unicodedata
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from storage_codec import decode_chat_message, ids_filter
+
+SEARCH_LANGUAGE = "spanish"
+SEARCH_SOURCES = ("chat", "sessions")
+SNIPPET_LENGTH = 200
+# Ids de paciente por consulta `$in` al chat; los profesionales con más se buscan por tandas
+PATIENT_BATCH_SIZE = 5000
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+# Palabras vacías que el índice de texto ignora y no deben resaltarse
+STOPWORDS = {
+    "de", "la", "el", "en", "y", "a", "que", "los", "las", "del", "se", "un", "una", "por", "con",
+    "no", "su", "para", "es", "al", "lo", "me", "mi", "muy", "pero", "como", "mas", "ya", "le", "o",
+}
+
+# Sufijos flexivos frecuentes (ya sin tildes), para resaltar variantes de un
+# mismo término; la coincidencia real la decide el stemmer de Mongo
+SPANISH_SUFFIXES = sorted(
+    ["amientos", "imientos", "amiento", "imiento", "aciones", "acion", "mente", "ando", "iendo",
+     "adas", "idas", "ados", "idos", "ada", "ida", "ado", "ido", "ar", "er", "ir", "es", "as", "os", "a", "o", "e", "s"],
+    key=len, reverse=True
+)
+
+
+def fold(text: str) -> str:
+    """Minúsculas y sin tildes (la ñ se conserva)"""
+    text = unicodedata.normalize("NFD", text.lower())
+    text = "".join(c for c in text if unicodedata.category(c) != "Mn" or c == "\u0303")
+    return unicodedata.normalize("NFC", text)
+
+
+def light_stem(word: str) -> str:
+    for suffix in SPANISH_SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+def query_stems(query: str) -> List[str]:
+    """Raíces de los términos de la consulta, ignorando los excluidos con '-'"""
+    terms = [t for t in query.split() if not t.startswith("-")]
+    words = [fold(w) for t in terms for w in WORD_RE.findall(t)]
+    return list(dict.fromkeys(light_stem(w) for w in words if len(w) > 1 and w not in STOPWORDS))
+
+
+def highlight(text: str, stems: List[str], length: int = SNIPPET_LENGTH) -> Dict[str, Any]:
+    """
+    Fragmento de `text` alrededor de la primera coincidencia, con las
+    posiciones [inicio, fin) de cada término dentro del fragmento.
+    """
+    spans: List[Tuple[int, int]] = [
+        match.span() for match in WORD_RE.finditer(text)
+        if any(fold(match.group()).startswith(stem) for stem in stems)
+    ]
+    start = 0
+    if spans and len(text) > length:
+        start = max(0, min(spans[0][0] - length // 4, len(text) - length))
+        # No cortar una palabra al principio del fragmento
+        while start > 0 and text[start - 1].isalnum():
+            start -= 1
+    end = min(len(text), start + length)
+    return {
+        "snippet": ("…" if start > 0 else "") + text[start:end] + ("…" if end < len(text) else ""),
+        "highlights": [
+            [s - start + (1 if start > 0 else 0), e - start + (1 if start > 0 else 0)]
+            for s, e in spans if s >= start and e <= end
+        ],
+    }
+
+
+async def _scoped_patient_batches(db, professional_id: str, patient_id: Optional[str]) -> AsyncIterator[List[str]]:
+    """Todos los pacientes del profesional, en tandas de `PATIENT_BATCH_SIZE`"""
+    query: Dict[str, Any] = {"professional_id": professional_id}
+    if patient_id:
+        query["id"] = patient_id
+    batch: List[str] = []
+    async for patient in db.patients.find(query, {"_id": 0, "id": 1}):
+        batch.append(patient["id"])
+        if len(batch) == PATIENT_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _text_query(query: str) -> Dict[str, Any]:
+    return {"$text": {"$search": query, "$language": SEARCH_LANGUAGE}}
+
+
+async def _search_chat(db, query: str, patient_ids: List[str], stems: List[str], limit: int) -> List[Dict[str, Any]]:
+    cursor = db.chat_messages.find(
+        {**_text_query(query), "patient_id": ids_filter(patient_ids)},
+        {"_id": 0, "id": 1, "patient_id": 1, "message": 1, "sender": 1, "timestamp": 1, "is_crisis": 1,
+         "score": {"$meta": "textScore"}}
+    ).sort([("score", {"$meta": "textScore"})]).limit(limit)
+    results = []
+    async for doc in cursor:
+        doc = decode_chat_message(doc)
+        results.append({
+            "type": "chat_message",
+            "id": doc["id"],
+            "patient_id": doc["patient_id"],
+            "date": doc.get("timestamp"),
+            "text_score": round(doc["score"], 4),
+            "sender": doc.get("sender"),
+            "is_crisis": doc.get("is_crisis", False),
+            "matches": {"message": highlight(doc["message"], stems)},
+        })
+    return results
+
+
+async def _search_sessions(db, query: str, professional_id: str, patient_id: Optional[str], stems: List[str], limit: int) -> List[Dict[str, Any]]:
+    scope: Dict[str, Any] = {"professional_id": professional_id}
+    if patient_id:
+        scope["patient_id"] = patient_id
+    cursor = db.sessions.find(
+        {**_text_query(query), **scope},
+        {"_id": 0, "id": 1, "patient_id": 1, "notes": 1, "transcript": 1, "session_date": 1, "session_type": 1,
+         "score": {"$meta": "textScore"}}
+    ).sort([("score", {"$meta": "textScore"})]).limit(limit)
+    results = []
+    async for doc in cursor:
+        matches = {}
+        for field in ("notes", "transcript"):
+            if doc.get(field):
+                fragment = highlight(doc[field], stems)
+                if fragment["highlights"]:
+                    matches[field] = fragment
+        results.append({
+            "type": "session",
+            "id": doc["id"],
+            "patient_id": doc["patient_id"],
+            "date": doc.get("session_date"),
+            "text_score": round(doc["score"], 4),
+            "session_type": doc.get("session_type"),
+            "matches": matches,
+        })
+    return results
+
+
+def _normalize(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """`score` relativo al mejor resultado de la misma fuente, de 0 a 1"""
+    top = max((r["text_score"] for r in results), default=0.0)
+    for result in results:
+        result["score"] = round(result["text_score"] / top, 4) if top else 0.0
+    return results
+
+
+async def search_history(
+    db,
+    professional_id: str,
+    query: str,
+    patient_id: Optional[str] = None,
+    sources: Tuple[str, ...] = SEARCH_SOURCES,
+    limit: int = 20,
+) -> Dict[str, Any]:
+    """Busca en chat y sesiones de los pacientes del profesional, ordenado por relevancia"""
+    stems = query_stems(query)
+    results: List[Dict[str, Any]] = []
+    if "chat" in sources:
+        messages: List[Dict[str, Any]] = []
+        async for patient_ids in _scoped_patient_batches(db, professional_id, patient_id):
+            # Misma colección e índice: los textScore de cada tanda sí son comparables
+            messages.extend(await _search_chat(db, query, patient_ids, stems, limit))
+            messages = sorted(messages, key=lambda r: r["text_score"], reverse=True)[:limit]
+        results.extend(_normalize(messages))
+    if "sessions" in sources:
+        results.extend(_normalize(await _search_sessions(db, query, professional_id, patient_id, stems, limit)))
+    results.sort(key=lambda r: r["score"], reverse=True)
+    results = results[:limit]
+    return {"query": query, "count": len(results), "results": results}
+
+
+async def ensure_search_indexes(db):
+    """Índices de texto en español (uno por colección, como exige Mongo)"""
+    await db.chat_messages.create_index(
+        [("message", "text")],
+        name="message_text",
+        default_language=SEARCH_LANGUAGE
+    )
+    await db.sessions.create_index(
+        [("notes", "text"), ("transcript", "text")],
+        name="notes_transcript_text",
+        default_language=SEARCH_LANGUAGE,
+        weights={"notes": 3, "transcript": 1}
+    )
+
+
+# =============================================================================
+# BENCHMARK
+# =============================================================================
+
+BENCHMARK_PROFESSIONALS = 200
+BENCHMARK_QUERIES = ["ansiedad", "no puedo dormir", "trabajo estrés", "\"ataque de pánico\"", "familia -madre", "tristeza soledad"]
+
+CORPUS_WORDS = {
+    "subject": ["hoy", "esta semana", "anoche", "en el trabajo", "con mi familia", "en clase", "desde la sesión"],
+    "feeling": ["me he sentido", "estoy", "sigo", "noto que estoy", "me encuentro"],
+    "state": ["ansioso", "ansiosa", "triste", "cansado", "tranquila", "mejor", "peor", "agobiado", "nerviosa", "sola"],
+    "cause": ["por el trabajo", "por mi madre", "por los exámenes", "por la soledad", "sin motivo claro",
+              "por una discusión", "por el estrés", "porque no puedo dormir", "tras un ataque de pánico"],
+    "action": ["he practicado la respiración", "he salido a caminar", "he escrito en el diario", "no he hecho los ejercicios",
+               "he hablado con una amiga", "he intentado meditar", "me he quedado en casa"],
+}
+
+
+def _sentence(rng) -> str:
+    return " ".join(rng.choice(CORPUS_WORDS[part]) for part in ("subject", "feeling", "state", "cause")) + \
+        ", " + rng.choice(CORPUS_WORDS["action"]) + "."
+
+
+async def generate_corpus(db, messages: int, patients: int, batch_size: int = 10_000):
+    """Pacientes repartidos entre `BENCHMARK_PROFESSIONALS`, sus mensajes y una sesión cada 20 mensajes"""
+    import random
+    import uuid
+    from datetime import datetime, timedelta
+
+    rng = random.Random(42)
+    patient_ids = [str(uuid.uuid4()) for _ in range(patients)]
+    owner = {pid: f"pro-{i % BENCHMARK_PROFESSIONALS}" for i, pid in enumerate(patient_ids)}
+    await db.patients.insert_many([{"id": pid, "professional_id": owner[pid]} for pid in patient_ids])
+    start = datetime.utcnow() - timedelta(days=90)
+    written = 0
+    while written < messages:
+        size = min(batch_size, messages - written)
+        batch = []
+        for i in range(size):
+            pid = rng.choice(patient_ids)
+            batch.append({
+                "id": str(uuid.uuid4()), "patient_id": pid, "sender": rng.choice(("patient", "assistant")),
+                "message": _sentence(rng), "is_crisis": False,
+                "timestamp": start + timedelta(seconds=(written + i) * 7_776_000 / messages),
+            })
+        await db.chat_messages.insert_many(batch, ordered=False)
+        sessions = [
+            {"id": str(uuid.uuid4()), "patient_id": m["patient_id"], "professional_id": owner[m["patient_id"]],
+             "session_type": "therapy", "session_date": m["timestamp"],
+             "notes": _sentence(rng), "transcript": " ".join(_sentence(rng) for _ in range(20))}
+            for m in batch[::20]
+        ]
+        await db.sessions.insert_many(sessions, ordered=False)
+        written += size
+        print(f"\r{written}/{messages} mensajes", end="", flush=True)
+    print()
+    await ensure_search_indexes(db)
+    await db.patients.create_index([("professional_id", 1), ("id", 1)])
+    await db.sessions.create_index([("professional_id", 1)])
+
+
+async def run_benchmark(db, rounds: int, queries: List[str] = BENCHMARK_QUERIES, limit: int = 20):
+    import time
+
+    professionals = [f"pro-{i}" for i in range(BENCHMARK_PROFESSIONALS)]
+    print(f"{'consulta':<26}{'resultados':>11}{'p50 ms':>10}{'p95 ms':>10}")
+    for query in queries:
+        latencies = []
+        count = 0
+        for i in range(rounds):
+            started = time.perf_counter()
+            response = await search_history(db, professionals[i % len(professionals)], query, limit=limit)
+            latencies.append(time.perf_counter() - started)
+            count += response["count"]
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1000
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000
+        print(f"{query:<26}{count / rounds:>11.1f}{p50:>10.1f}{p95:>10.1f}")
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+    import os
+
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+    parser = argparse.ArgumentParser(description="Corpus sintético y benchmark de la búsqueda")
+    parser.add_argument("command", choices=("generate", "bench", "drop"))
+    parser.add_argument("--messages", type=int, default=2_000_000)
+    parser.add_argument("--patients", type=int, default=20_000)
+    parser.add_argument("--rounds", type=int, default=20, help="Búsquedas por consulta (rotando el profesional)")
+    args = parser.parse_args()
+
+    async def main():
+        client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+        db = client[f"{os.environ.get('DB_NAME', 'zentium')}_search_benchmark"]
+        if args.command == "generate":
+            await generate_corpus(db, args.messages, args.patients)
+        elif args.command == "bench":
+            await run_benchmark(db, args.rounds)
+        else:
+            await client.drop_database(db.name)
+        client.close()
+
+    asyncio.run(main())
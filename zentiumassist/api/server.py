@@ -1,37 +1,133 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Request, Response, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi.openapi.utils import get_openapi
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from contextlib import asynccontextmanager
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 import uuid
-from datetime import datetime, timedelta
-from emergentintegrations.llm.chat import LlmChat, UserMessage
+from datetime import date, datetime, timedelta
 import asyncio
 import json
 
+from chat_archive import (
+    ARCHIVE_AFTER_DAYS,
+    MIN_ARCHIVE_AFTER_DAYS,
+    archive_old_messages,
+    chat_archive_loop,
+    count_archived_crisis,
+    ensure_archive_indexes,
+)
+from http_cache import (
+    CompressionMiddleware,
+    ConditionalGetMiddleware,
+    check_not_modified,
+    collection_version,
+)
+from rate_limit import (
+    DEFAULT_LIMITS_PER_MINUTE,
+    RateLimiter,
+    client_ip,
+    ensure_rate_limit_indexes,
+)
+from record_export import (
+    export_filename,
+    export_media_type,
+    export_stream,
+    iter_patient_records,
+    iter_professional_records,
+)
+from mood_trends import (
+    DEFAULT_WINDOW,
+    compute_trends,
+    load_session_series,
+    session_timeline,
+    trends_to_records,
+)
+from single_flight import coalescing_stats, single_flight
+from micro_batch import MicroBatcher, micro_batch_stats
+from storage_codec import decode_chat_message
+from entity_cache import entity_cache_stats, patient_cache, professional_cache, watch_entity_changes
+from task_scheduler import TaskScheduler, ensure_task_indexes
+from search import SEARCH_SOURCES, ensure_search_indexes, search_history
+from static_frontends import mount_frontends
+from circuit_breaker import CircuitOpenError, llm_circuit
+from crisis_alerts import (
+    CONTEXT_AFTER,
+    CONTEXT_BEFORE,
+    CRISIS_ALERTS_LIMIT,
+    MAX_CONTEXT,
+    ensure_crisis_alert_indexes,
+    load_crisis_alerts,
+)
+from compute_pool import compute_pool
+from health import health_monitor
+from idempotency import IdempotencyMiddleware, ensure_idempotency_indexes
+from llm_dispatch import BACKGROUND, CHAT, CRISIS, llm_dispatcher, llm_priority, set_llm_priority
+from llm_usage import (
+    GROUP_FIELDS,
+    UsageOwner,
+    count_tokens,
+    current_owner,
+    enforce_llm_budget,
+    ensure_llm_usage_indexes,
+    llm_usage,
+    set_usage_entity,
+    usage_report,
+)
+from patient_home import PatientNotFound, load_patient_home
+from repositories import Repositories, mongo_repositories
+from tenancy import (
+    TenantDatabase,
+    TenantMiddleware,
+    TenantRouter,
+    configured_tenants,
+    current_tenant,
+    ensure_tenant_indexes,
+)
+from session_vectors import (
+    embed_text,
+    ensure_vector_indexes,
+    find_similar_sessions,
+    load_session_vector,
+    session_text,
+    store_session_vector,
+)
+from risk_scoring import (
+    apply_session_analysis_risk,
+    ensure_risk_indexes,
+    record_crisis_event,
+    recompute_all_risk,
+    risk_rescore_loop,
+)
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# MongoDB connection, opened and closed by the app lifespan
+client: Optional[AsyncIOMotorClient] = None
+tenant_router: Optional[TenantRouter] = None
+# Database of the current request's tenant (institution)
+db = None
+# Same, with a secondaryPreferred read preference, for stale-tolerant reads
+stale_db = None
+# One scheduler per tenant database
+task_schedulers: Dict[str, TaskScheduler] = {}
+# Data access for patients, sessions, tasks and chat (see repositories.py)
+repos: Optional[Repositories] = None
 
 # OpenAI Configuration
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY', 'your-openai-api-key-here')
 
-# Create the main app with enhanced documentation
-app = FastAPI(
-    title="🧠 Zentium Assist API",
-    description="""
+API_DESCRIPTION = """
 ## AI-Powered Mental Health Platform
 
 Esta API proporciona endpoints para la plataforma Zentium Assist, una solución integral de salud mental con inteligencia artificial.
@@ -52,48 +148,38 @@ Esta API proporciona endpoints para la plataforma Zentium Assist, una solución
 
 ### Autenticación:
 Utiliza JWT tokens. Incluye el token en el header: `Authorization: Bearer <token>`
-    """,
-    version="2.0.0",
-    contact={
-        "name": "Zentium Assist Support",
-        "url": "https://zentiumassist.com",
-        "email": "support@zentiumassist.com",
+"""
+
+OPENAPI_TAGS = [
+    {
+        "name": "authentication",
+        "description": "🔐 Endpoints de autenticación y gestión de usuarios",
     },
-    license_info={
-        "name": "MIT License",
-        "url": "https://opensource.org/licenses/MIT",
+    {
+        "name": "professionals",
+        "description": "👨‍⚕️ Gestión de profesionales de salud mental",
     },
-    openapi_tags=[
-        {
-            "name": "authentication",
-            "description": "🔐 Endpoints de autenticación y gestión de usuarios",
-        },
-        {
-            "name": "professionals",
-            "description": "👨‍⚕️ Gestión de profesionales de salud mental",
-        },
-        {
-            "name": "patients",
-            "description": "👤 Gestión de pacientes y perfiles médicos",
-        },
-        {
-            "name": "chat",
-            "description": "💬 Sistema de chat con IA y detección de crisis",
-        },
-        {
-            "name": "tasks",
-            "description": "✅ Sistema de tareas terapéuticas",
-        },
-        {
-            "name": "analytics",
-            "description": "📊 Analytics y reportes del sistema",
-        },
-        {
-            "name": "health",
-            "description": "🏥 Endpoints de salud del sistema",
-        }
-    ]
-)
+    {
+        "name": "patients",
+        "description": "👤 Gestión de pacientes y perfiles médicos",
+    },
+    {
+        "name": "chat",
+        "description": "💬 Sistema de chat con IA y detección de crisis",
+    },
+    {
+        "name": "tasks",
+        "description": "✅ Sistema de tareas terapéuticas",
+    },
+    {
+        "name": "analytics",
+        "description": "📊 Analytics y reportes del sistema",
+    },
+    {
+        "name": "health",
+        "description": "🏥 Endpoints de salud del sistema",
+    }
+]
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -101,6 +187,9 @@ api_router = APIRouter(prefix="/api")
 # Security
 security = HTTPBearer()
 
+# Per-worker token buckets (optionally shared through Mongo, see rate_limit.py)
+rate_limiter = RateLimiter(DEFAULT_LIMITS_PER_MINUTE)
+
 # =============================================================================
 # ENHANCED MODELS WITH SWAGGER DOCUMENTATION
 # =============================================================================
@@ -233,6 +322,8 @@ class Patient(BaseModel):
     gender: str = Field(..., description="Género del paciente")
     diagnosis: Optional[str] = Field(None, description="Diagnóstico médico (opcional)")
     risk_level: str = Field("low", description="Nivel de riesgo: low, medium, high")
+    risk_score: float = Field(0.0, description="Score de riesgo compuesto (0-100)")
+    risk_updated_at: Optional[datetime] = Field(None, description="Fecha del último cálculo de riesgo")
     emergency_contact: str = Field(..., description="Contacto de emergencia")
     session_count: int = Field(0, description="Número total de sesiones")
     last_session: Optional[datetime] = Field(None, description="Fecha de última sesión")
@@ -248,6 +339,8 @@ class Patient(BaseModel):
                 "gender": "Femenino",
                 "diagnosis": "Trastorno de ansiedad",
                 "risk_level": "medium",
+                "risk_score": 42.5,
+                "risk_updated_at": "2025-01-28T03:00:00Z",
                 "emergency_contact": "+34 600 123 456",
                 "session_count": 15,
                 "last_session": "2025-01-28T14:30:00Z",
@@ -272,8 +365,8 @@ class PatientCreate(BaseModel):
             }
         }
 
-class ChatMessage(BaseModel):
-    """Modelo para mensajes de chat"""
+class ChatRequest(BaseModel):
+    """Mensaje enviado al asistente de IA"""
     message: str = Field(..., min_length=1, max_length=1000, description="Contenido del mensaje")
     session_id: Optional[str] = Field(None, description="ID de sesión (opcional)")
 
@@ -304,31 +397,6 @@ class ChatResponse(BaseModel):
             }
         }
 
-class Task(BaseModel):
-    """Modelo de tarea terapéutica"""
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()), description="ID único de la tarea")
-    patient_id: str = Field(..., description="ID del paciente asignado")
-    title: str = Field(..., description="Título de la tarea")
-    description: str = Field(..., description="Descripción detallada")
-    category: str = Field(..., description="Categoría de la tarea")
-    completed: bool = Field(False, description="Estado de completado")
-    due_date: Optional[datetime] = Field(None, description="Fecha límite")
-    created_at: datetime = Field(default_factory=datetime.utcnow, description="Fecha de creación")
-
-    class Config:
-        schema_extra = {
-            "example": {
-                "id": "task-12345678-1234-1234-1234-123456789012",
-                "patient_id": "pat-12345678-1234-1234-1234-123456789012",
-                "title": "Ejercicio de respiración",
-                "description": "Practica respiración profunda por 10 minutos",
-                "category": "mindfulness",
-                "completed": False,
-                "due_date": "2025-01-30T12:00:00Z",
-                "created_at": "2025-01-28T10:00:00Z"
-            }
-        }
-
 class HealthCheck(BaseModel):
     """Respuesta del endpoint de salud"""
     status: str = Field(..., description="Estado del sistema")
@@ -371,6 +439,7 @@ class SessionCreate(BaseModel):
     notes: Optional[str] = None
 
 class ChatMessage(BaseModel):
+    """Mensaje de chat almacenado (paciente o asistente)"""
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     patient_id: str
     message: str
@@ -384,16 +453,19 @@ class ChatMessageCreate(BaseModel):
     message: str
 
 class Task(BaseModel):
+    """Modelo de tarea terapéutica"""
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     patient_id: str
     professional_id: str
     title: str
     description: str
     task_type: str  # homework, exercise, reflection, mindfulness
-    status: str = "assigned"  # assigned, in_progress, completed, skipped
+    status: str = "assigned"  # assigned, in_progress, completed, skipped, overdue
     due_date: Optional[datetime] = None
     completion_notes: Optional[str] = None
     ai_feedback: Optional[str] = None
+    ai_feedback_failed: bool = False  # Set once feedback generation gave up after several attempts
+    reminder_sent_at: Optional[datetime] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
     completed_at: Optional[datetime] = None
 
@@ -412,9 +484,64 @@ class AIAnalysisRequest(BaseModel):
 # AI SERVICE FUNCTIONS
 # =============================================================================
 
+# Crisis detection (simplified)
+CRISIS_KEYWORDS = ["suicidio", "morir", "lastimar", "dolor", "no puedo más", "acabar", "terminar todo"]
+
+def looks_like_crisis(message: str) -> bool:
+    """Cheap keyword check, usable before any LLM call"""
+    text = message.lower()
+    return "suicid" in text or any(keyword in text for keyword in CRISIS_KEYWORDS)
+
+# Patients with a crisis this recent keep their chat in the crisis LLM lane
+CRISIS_LANE_MINUTES = int(os.environ.get("CRISIS_LANE_MINUTES", "30"))
+
+def in_recent_crisis(patient: Optional[Dict[str, Any]]) -> bool:
+    last_crisis_at = patient.get("last_crisis_at") if patient else None
+    return bool(last_crisis_at) and datetime.utcnow() - last_crisis_at < timedelta(minutes=CRISIS_LANE_MINUTES)
+
+_llm_classes = None
+
+def load_llm():
+    """Import emergentintegrations on first use; it is slow to import and not needed to serve reads"""
+    global _llm_classes
+    if _llm_classes is None:
+        from emergentintegrations.llm.chat import LlmChat, UserMessage
+        _llm_classes = (LlmChat, UserMessage)
+    return _llm_classes
+
+async def send_llm_message(chat, message, *, endpoint: str, model: Optional[str] = None, owners=None, weights=None,
+                           priority: Optional[str] = None, **kwargs):
+    """Send through the priority dispatcher and the LLM circuit breaker (fails fast while the provider is down) and account its tokens"""
+    prompt_tokens = sum(
+        count_tokens(text, model)
+        for text in (getattr(chat, "system_message", None), kwargs.get("system_prompt"),
+                     getattr(message, "text", None) or getattr(message, "content", None))
+        if isinstance(text, str)
+    )
+    try:
+        response = await llm_dispatcher.run(llm_circuit.call, chat.send_message, message, priority=priority, **kwargs)
+    except CircuitOpenError:
+        raise
+    except Exception:
+        llm_usage.record(model, endpoint, prompt_tokens, 0, owners, weights, failed=True)
+        raise
+    llm_usage.record(model, endpoint, prompt_tokens, count_tokens(response, model), owners, weights)
+    return response
+
+async def enter_tenant_of(kind: str, entity_id: str):
+    """Route the rest of the request to the tenant of an entity only known from the body"""
+    if tenant_router:
+        current_tenant.set(await tenant_router.tenant_of(kind, entity_id))
+
+async def register_tenant_entities(*entries):
+    """Record new (kind, id) entities of a dedicated tenant in the tenant directory"""
+    if tenant_router:
+        await tenant_router.register(current_tenant.get(), entries)
+
 async def get_ai_chat_response(patient_id: str, message: str, chat_history: List[Dict] = None) -> Dict[str, Any]:
     """Get AI response using emergentintegrations"""
     try:
+        LlmChat, UserMessage = load_llm()
         # Initialize chat with patient-specific session
         chat = LlmChat(
             api_key=OPENAI_API_KEY,
@@ -433,17 +560,10 @@ async def get_ai_chat_response(patient_id: str, message: str, chat_history: List
         ).with_model("openai", "gpt-4o")
         
         user_message = UserMessage(text=message)
-        response = await chat.send_message(user_message)
+        response = await send_llm_message(chat, user_message, endpoint="chat_message", model="gpt-4o")
         
-        # Simple sentiment analysis
-        sentiment_prompt = f"Analiza el sentimiento del siguiente mensaje en una palabra (positivo/negativo/neutral/crisis): '{message}'"
-        sentiment_chat = LlmChat(
-            api_key=OPENAI_API_KEY,
-            session_id=f"sentiment_{uuid.uuid4()}",
-            system_message="Eres un analizador de sentimientos. Responde solo con una palabra."
-        ).with_model("openai", "gpt-4o-mini")
-        
-        sentiment_response = await sentiment_chat.send_message(UserMessage(text=sentiment_prompt))
+        # Classified together with other messages arriving at the same time, in this request's LLM lane
+        sentiment_response = await sentiment_batcher.submit((message, current_owner(), llm_priority.get()))
         
         return {
             "response": response,
@@ -458,9 +578,68 @@ async def get_ai_chat_response(patient_id: str, message: str, chat_history: List
             "is_crisis": False
         }
 
-async def analyze_session_transcript(transcript: str) -> Dict[str, Any]:
-    """Analyze therapy session transcript"""
+SENTIMENT_LABELS = ("positivo", "negativo", "neutral", "crisis")
+
+async def classify_sentiment(message: str, owner: Optional[UsageOwner] = None, priority: str = CHAT) -> str:
+    """One-word sentiment of a single message"""
+    LlmChat, UserMessage = load_llm()
+    sentiment_prompt = f"Analiza el sentimiento del siguiente mensaje en una palabra (positivo/negativo/neutral/crisis): '{message}'"
+    sentiment_chat = LlmChat(
+        api_key=OPENAI_API_KEY,
+        session_id=f"sentiment_{uuid.uuid4()}",
+        system_message="Eres un analizador de sentimientos. Responde solo con una palabra."
+    ).with_model("openai", "gpt-4o-mini")
+    response = await send_llm_message(
+        sentiment_chat, UserMessage(text=sentiment_prompt),
+        endpoint="sentiment", model="gpt-4o-mini", owners=[owner] if owner else None,
+        priority=CRISIS if looks_like_crisis(message) else priority
+    )
+    return response.lower().strip()
+
+async def classify_sentiments(items: List[Tuple[str, UsageOwner, str]]) -> List[str]:
+    """Sentiment of several (message, owner, LLM lane) items with a single LLM call; unparseable items fall back to single calls"""
+    if len(items) == 1:
+        return [await classify_sentiment(*items[0])]
+    messages = [message for message, _, _ in items]
+    LlmChat, UserMessage = load_llm()
+    chat = LlmChat(
+        api_key=OPENAI_API_KEY,
+        session_id=f"sentiment_batch_{uuid.uuid4()}",
+        system_message="""Eres un analizador de sentimientos. Recibirás una lista JSON de mensajes con su "id".
+        Responde solo con un objeto JSON cuyas claves sean los "id" y cuyos valores sean una sola palabra: positivo, negativo, neutral o crisis."""
+    ).with_model("openai", "gpt-4o-mini")
+    prompt_items = [{"id": str(i), "mensaje": message} for i, message in enumerate(messages)]
+    response = await send_llm_message(
+        chat, UserMessage(text=json.dumps(prompt_items, ensure_ascii=False)),
+        endpoint="sentiment", model="gpt-4o-mini",
+        owners=[owner for _, owner, _ in items], weights=[count_tokens(message) for message in messages],
+        # The batch goes in the most urgent lane of its items
+        priority=CRISIS if any(lane == CRISIS or looks_like_crisis(message) for message, _, lane in items) else CHAT
+    )
     try:
+        parsed = json.loads(response)
+        if not isinstance(parsed, dict):
+            raise ValueError("expected a JSON object")
+    except ValueError as e:
+        logging.warning(f"Unparseable batch sentiment response ({e}); classifying {len(messages)} messages one by one")
+        parsed = {}
+    results = [str(parsed.get(str(i), "")).lower().strip() for i in range(len(messages))]
+    retry = [i for i, sentiment in enumerate(results) if sentiment not in SENTIMENT_LABELS]
+    for i, sentiment in zip(retry, await asyncio.gather(*(classify_sentiment(*items[i]) for i in retry))):
+        results[i] = sentiment
+    return results
+
+sentiment_batcher = MicroBatcher(
+    "sentiment",
+    classify_sentiments,
+    max_items=int(os.environ.get('SENTIMENT_BATCH_MAX_ITEMS', '20')),
+    window=float(os.environ.get('SENTIMENT_BATCH_WINDOW_MS', '20')) / 1000
+)
+
+async def analyze_session_transcript(transcript: str, past_summaries: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Analyze therapy session transcript, optionally with summaries of similar past sessions as context"""
+    try:
+        LlmChat, UserMessage = load_llm()
         chat = LlmChat(
             api_key=OPENAI_API_KEY,
             session_id=f"analysis_{uuid.uuid4()}",
@@ -475,7 +654,13 @@ async def analyze_session_transcript(transcript: str) -> Dict[str, Any]:
         ).with_model("openai", "gpt-4o")
         
         analysis_prompt = f"Analiza la siguiente transcripción de sesión terapéutica:\n\n{transcript}"
-        response = await chat.send_message(UserMessage(text=analysis_prompt))
+        if past_summaries:
+            context = "\n".join(f"- {summary}" for summary in past_summaries)
+            analysis_prompt += f"\n\nResúmenes de sesiones anteriores similares del mismo paciente (solo como contexto):\n{context}"
+        response = await send_llm_message(
+            chat, UserMessage(text=analysis_prompt),
+            endpoint="session_analysis", model="gpt-4o", priority=BACKGROUND
+        )
         
         try:
             return json.loads(response)
@@ -497,6 +682,43 @@ async def analyze_session_transcript(transcript: str) -> Dict[str, Any]:
             "risk_level": "bajo"
         }
 
+async def generate_tasks_feedback(tasks: List[Dict[str, Any]]) -> Dict[str, str]:
+    """Generate feedback for several completed tasks with a single LLM call"""
+    try:
+        LlmChat, UserMessage = load_llm()
+        chat = LlmChat(
+            api_key=OPENAI_API_KEY,
+            session_id=f"task_feedback_{uuid.uuid4()}",
+            system_message="""Eres un asistente terapéutico que da feedback breve (2-3 frases), cálido y motivador sobre tareas terapéuticas completadas por pacientes.
+            No hagas diagnósticos. Si las notas sugieren riesgo, recomienda hablarlo con su profesional.
+
+            Recibirás una lista JSON de tareas. Responde solo con un objeto JSON cuyas claves sean los "id" de las tareas y cuyos valores sean el feedback de cada una."""
+        ).with_model("openai", "gpt-4o-mini")
+
+        items = [
+            {
+                "id": task["id"],
+                "titulo": task.get("title"),
+                "descripcion": task.get("description"),
+                "tipo": task.get("task_type"),
+                "notas_del_paciente": task.get("completion_notes")
+            }
+            for task in tasks
+        ]
+        # Each patient is charged in proportion to the size of their task
+        response = await send_llm_message(
+            chat, UserMessage(text=json.dumps(items, ensure_ascii=False)),
+            endpoint="task_feedback", model="gpt-4o-mini",
+            owners=[UsageOwner(current_tenant.get(), task.get("patient_id"), task.get("professional_id")) for task in tasks],
+            weights=[count_tokens(json.dumps(item, ensure_ascii=False)) for item in items],
+            priority=BACKGROUND
+        )
+        feedback = json.loads(response)
+        return {task_id: text for task_id, text in feedback.items() if isinstance(text, str)}
+    except Exception as e:
+        logging.error(f"Error generating task feedback: {e}")
+        return {}
+
 # =============================================================================
 # AUTHENTICATION & USERS
 # =============================================================================
@@ -504,6 +726,7 @@ async def analyze_session_transcript(transcript: str) -> Dict[str, Any]:
 @api_router.post("/auth/register", response_model=UserBase)
 async def register_user(user_data: UserCreate):
     # Check if user exists
+    await enter_tenant_of("user", user_data.email)
     existing_user = await db.users.find_one({"email": user_data.email})
     if existing_user:
         raise HTTPException(status_code=400, detail="User already exists")
@@ -523,6 +746,7 @@ async def register_user(user_data: UserCreate):
             institution="Zentium Assist"
         )
         await db.professionals.insert_one(professional.dict())
+        await register_tenant_entities(("user", user_obj.email), ("professional", professional.id))
     
     elif user_data.role == UserRole.PATIENT:
         # For patient registration, assign to first available professional
@@ -537,7 +761,7 @@ async def register_user(user_data: UserCreate):
                 gender="no especificado",
                 emergency_contact="Contacto de emergencia no especificado"
             )
-            await db.patients.insert_one(patient.dict())
+            await repos.patients.create(patient.dict())
         else:
             # Create a default professional if none exists
             default_professional = Professional(
@@ -555,12 +779,14 @@ async def register_user(user_data: UserCreate):
                 gender="no especificado",
                 emergency_contact="Contacto de emergencia no especificado"
             )
-            await db.patients.insert_one(patient.dict())
+            await repos.patients.create(patient.dict())
+        await register_tenant_entities(("user", user_obj.email), ("patient", patient.id))
     
     return user_obj
 
 @api_router.post("/auth/login")
 async def login_user(login_data: UserLogin):
+    await enter_tenant_of("user", login_data.email)
     user = await db.users.find_one({"email": login_data.email})
     if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
@@ -603,7 +829,7 @@ async def login_user(login_data: UserLogin):
     summary="💬 Chat con IA",
     description="Envía un mensaje al asistente de IA con detección automática de crisis"
 )
-async def chat_with_ai(message: ChatMessage):
+async def chat_with_ai(message: ChatRequest, request: Request):
     """
     Envía un mensaje al asistente de IA de Zentium Assist.
     
@@ -624,8 +850,17 @@ async def chat_with_ai(message: ChatMessage):
     - `medium`: Preocupación moderada
     - `high`: Riesgo elevado - requiere intervención
     - `critical`: Emergencia - contacto inmediato requerido
+    
+    **Límites:** por IP; los mensajes con indicios de crisis nunca se limitan (429 con `Retry-After`).
     """
+    if looks_like_crisis(message.message):
+        set_llm_priority(CRISIS)
+    else:
+        await rate_limiter.enforce(db, ip=client_ip(request))
+    
     try:
+        LlmChat, UserMessage = load_llm()
+        
         # Initialize LLM chat
         chat = LlmChat(api_key=OPENAI_API_KEY)
         
@@ -636,11 +871,10 @@ async def chat_with_ai(message: ChatMessage):
         
         # Send message to AI
         user_message = UserMessage(content=message.message)
-        response = await chat.send_message(user_message, system_prompt=system_prompt)
+        response = await send_llm_message(chat, user_message, endpoint="ai_chat", system_prompt=system_prompt)
         
         # Crisis detection (simplified)
-        crisis_keywords = ["suicidio", "morir", "lastimar", "dolor", "no puedo más", "acabar", "terminar todo"]
-        crisis_detected = any(keyword in message.message.lower() for keyword in crisis_keywords)
+        crisis_detected = any(keyword in message.message.lower() for keyword in CRISIS_KEYWORDS)
         
         crisis_level = None
         recommendations = []
@@ -691,7 +925,10 @@ async def chat_with_ai(message: ChatMessage):
     summary="👥 Obtener pacientes asignados",
     description="Obtiene la lista de pacientes asignados a un profesional específico"
 )
-async def get_professional_patients(professional_id: str):
+async def get_professional_patients(
+    professional_id: str,
+    risk_level: Optional[str] = Query(None, pattern="^(low|medium|high)$", description="Filtrar por nivel de riesgo")
+):
     """
     Obtiene todos los pacientes asignados a un profesional específico.
     
@@ -703,15 +940,10 @@ async def get_professional_patients(professional_id: str):
     - Diagnóstico (si está disponible)
     
     **Ordenamiento:**
-    - Por nivel de riesgo (crítico primero)
-    - Por fecha de última sesión
+    - Por score de riesgo (mayor riesgo primero)
     """
-    patients_docs = await db.patients.find({"professional_id": professional_id}).to_list(100)
-    patients = []
-    for patient_doc in patients_docs:
-        patient_doc.pop('_id', None)  # Remove MongoDB ObjectId
-        patients.append(Patient(**patient_doc))
-    return patients
+    patients_docs = await repos.patients.list_by_professional(professional_id, risk_level)
+    return [Patient(**patient_doc) for patient_doc in patients_docs]
 
 @api_router.post(
     "/professionals/{professional_id}/patients",
@@ -744,7 +976,7 @@ async def create_patient(professional_id: str, patient_data: PatientCreate):
     - Contador de sesiones en 0
     """
     # Verify professional exists
-    professional = await db.professionals.find_one({"id": professional_id})
+    professional = await professional_cache.get(db, professional_id)
     if not professional:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -763,7 +995,8 @@ async def create_patient(professional_id: str, patient_data: PatientCreate):
     patient_dict = patient_data.dict()
     patient_dict["user_id"] = patient_user.id
     patient_obj = Patient(**patient_dict)
-    await db.patients.insert_one(patient_obj.dict())
+    await repos.patients.create(patient_obj.dict())
+    await register_tenant_entities(("user", patient_user.email), ("patient", patient_obj.id))
     
     return patient_obj
 
@@ -777,63 +1010,35 @@ async def get_professional_dashboard(professional_id: str):
     """
     Obtiene estadísticas y métricas para el dashboard del profesional.
     
-    **Métricas incluidas:**
-    - Número total de pacientes
-    - Pacientes activos en el mes
-    - Sesiones realizadas
-    - Alertas de crisis pendientes
-    - Distribución por nivel de riesgo
-    - Tendencias de progreso
+    **Incluye:**
+    - Pacientes del profesional (hasta 100)
+    - Sus 10 sesiones más recientes
+    - Las 5 alertas de crisis más recientes
+    - Totales: pacientes, sesiones en curso y alertas
     
-    **Actualización:**
-    - Datos en tiempo real
-    - Histórico de 30 días
+    Las cargas simultáneas del mismo dashboard comparten una sola consulta.
     """
-    # Get patients count
-    patients_count = await db.patients.count_documents({"professional_id": professional_id})
-    
-    # Get recent sessions (mock data)
-    recent_sessions = 12  # In production, query actual sessions
-    
-    # Get crisis alerts (mock data)
-    crisis_alerts = 2  # In production, query actual crisis alerts
-    
-    return {
-        "professional_id": professional_id,
-        "total_patients": patients_count,
-        "active_patients": max(0, patients_count - 5),  # Mock calculation
-        "recent_sessions": recent_sessions,
-        "crisis_alerts": crisis_alerts,
-        "avg_risk_level": "medium",
-        "last_updated": datetime.utcnow()
-    }
+    return await single_flight("professional_dashboard").do(
+        ("full", professional_id),
+        lambda: load_professional_dashboard(professional_id)
+    )
 
-@api_router.get("/professionals/{professional_id}/dashboard")
-async def get_professional_dashboard(professional_id: str):
+async def load_professional_dashboard(professional_id: str):
+    # Dashboards tolerate replication lag, so they read from secondaries
     # Get patients
-    patients_docs = await db.patients.find({"professional_id": professional_id}).to_list(100)
-    patients = []
-    for patient_doc in patients_docs:
-        patient_doc.pop('_id', None)  # Remove MongoDB ObjectId
-        patients.append(patient_doc)
+    patients = await stale_db.patients.find({"professional_id": professional_id}, {"_id": 0}).to_list(100)
     
     # Get recent sessions
-    sessions_docs = await db.sessions.find(
-        {"professional_id": professional_id}
+    recent_sessions = await stale_db.sessions.find(
+        {"professional_id": professional_id}, {"_id": 0}
     ).sort("created_at", -1).limit(10).to_list(10)
-    recent_sessions = []
-    for session_doc in sessions_docs:
-        session_doc.pop('_id', None)  # Remove MongoDB ObjectId
-        recent_sessions.append(session_doc)
     
     # Get crisis alerts
-    crisis_docs = await db.chat_messages.find(
-        {"is_crisis": True}
-    ).sort("timestamp", -1).limit(5).to_list(5)
-    crisis_messages = []
-    for crisis_doc in crisis_docs:
-        crisis_doc.pop('_id', None)  # Remove MongoDB ObjectId
-        crisis_messages.append(crisis_doc)
+    crisis_messages = [
+        decode_chat_message(doc) for doc in await stale_db.chat_messages.find(
+            {"is_crisis": True}, {"_id": 0}
+        ).sort("timestamp", -1).limit(5).to_list(5)
+    ]
     
     return {
         "patients_count": len(patients),
@@ -847,42 +1052,285 @@ async def get_professional_dashboard(professional_id: str):
         }
     }
 
+@api_router.get(
+    "/professionals/{professional_id}/crisis-alerts",
+    tags=["professionals"],
+    summary="🚨 Alertas de crisis con contexto",
+    description="Alertas de crisis de los pacientes del profesional, con el resumen del paciente y la conversación alrededor"
+)
+async def get_professional_crisis_alerts(
+    professional_id: str,
+    limit: int = Query(CRISIS_ALERTS_LIMIT, ge=1, le=100, description="Número máximo de alertas"),
+    context_before: int = Query(CONTEXT_BEFORE, ge=0, le=MAX_CONTEXT, description="Mensajes previos a cada alerta"),
+    context_after: int = Query(CONTEXT_AFTER, ge=0, le=MAX_CONTEXT, description="Mensajes posteriores a cada alerta")
+):
+    """
+    Vista de triaje en una sola petición.
+
+    **Por alerta (más recientes primero):**
+    - El mensaje de crisis (mismos campos que el historial de chat)
+    - `patient`: edad, género, nivel de riesgo, contacto de emergencia...
+    - `context`: mensajes alrededor de la alerta, en orden cronológico
+
+    Se lee del primario: una crisis recién detectada debe aparecer de inmediato.
+    """
+    return await single_flight("crisis_alerts").do(
+        (professional_id, limit, context_before, context_after),
+        lambda: load_crisis_alerts(db, professional_id, limit, context_before, context_after)
+    )
+
+@api_router.get(
+    "/professionals/{professional_id}/trends",
+    tags=["professionals"],
+    summary="📈 Tendencias de ánimo de los pacientes",
+    description="Calcula tendencias de ánimo y progreso para todos los pacientes del profesional"
+)
+async def get_professional_trends(
+    professional_id: str,
+    request: Request,
+    response: Response,
+    window: int = Query(DEFAULT_WINDOW, ge=2, le=20, description="Sesiones por media móvil"),
+    deteriorating_only: bool = Query(False, description="Devolver solo pacientes con deterioro")
+):
+    """
+    Resumen de tendencias por paciente a partir de `mood_before`/`mood_after`.
+
+    **Métricas por paciente:**
+    - Medias de ánimo antes/después y delta medio por sesión
+    - Media móvil del ánimo posterior al final de la serie
+    - Cambio respecto a la ventana anterior y pendiente semanal
+    - Marca de deterioro (pendiente negativa, caída brusca o ánimo bajo)
+
+    Todas las métricas se calculan en lote con NumPy.
+    """
+    version = await collection_version(stale_db, "sessions", {"professional_id": professional_id}, ["created_at", "updated_at"])
+    etag, cached = check_not_modified(request, version)
+    if cached:
+        return cached
+    response.headers["ETag"] = etag
+
+    series = await load_session_series(stale_db, {"professional_id": professional_id})
+    trends = await compute_trends.offload(series, window=window)
+    patients = trends_to_records(trends)
+    deteriorating = [p["patient_id"] for p in patients if p["deteriorating"]]
+    if deteriorating_only:
+        patients = [p for p in patients if p["deteriorating"]]
+
+    return {
+        "professional_id": professional_id,
+        "window": window,
+        "sessions_analyzed": series.size,
+        "patients": patients,
+        "deteriorating_patients": deteriorating,
+        "computed_at": datetime.utcnow()
+    }
+
+@api_router.get(
+    "/professionals/{professional_id}/search",
+    tags=["professionals"],
+    summary="🔎 Buscar en el historial de los pacientes",
+    description="Búsqueda de texto completo en mensajes de chat, notas y transcripciones de sesiones"
+)
+async def search_professional_history(
+    professional_id: str,
+    q: str = Query(..., min_length=2, max_length=200, description="Términos de búsqueda (admite \"frases\" y -exclusiones)"),
+    patient_id: Optional[str] = Query(None, description="Limitar la búsqueda a un paciente"),
+    sources: str = Query("chat,sessions", pattern="^(chat|sessions)(,(chat|sessions))?$", description="Fuentes: chat, sessions"),
+    limit: int = Query(20, ge=1, le=100, description="Número máximo de resultados")
+):
+    """
+    Busca en el historial de los pacientes asignados al profesional.
+
+    **Fuentes:**
+    - `chat`: mensajes de chat recientes (no archivados)
+    - `sessions`: notas y transcripciones de sesiones
+
+    La búsqueda usa stemming en español e ignora tildes. Los resultados se
+    ordenan por relevancia (`score`: relativa al mejor resultado de su fuente,
+    de 0 a 1; `text_score`: la puntuación de Mongo, solo comparable dentro de
+    una fuente) y cada uno incluye fragmentos con las posiciones de los
+    términos encontrados (`highlights`) para resaltarlos.
+    """
+    return await search_history(
+        db,
+        professional_id,
+        q,
+        patient_id=patient_id,
+        sources=tuple(source for source in SEARCH_SOURCES if source in sources.split(",")),
+        limit=limit
+    )
+
+@api_router.get(
+    "/professionals/{professional_id}/export",
+    tags=["professionals"],
+    summary="📦 Exportar historial del profesional",
+    description="Exporta en streaming el perfil del profesional y el historial completo de sus pacientes"
+)
+async def export_professional_record(
+    professional_id: str,
+    format: str = Query("ndjson", pattern="^(ndjson|zip)$", description="Formato: ndjson o zip"),
+    compress: bool = Query(False, description="Comprimir NDJSON con gzip al vuelo")
+):
+    """
+    Exporta todos los datos de un profesional y de los pacientes asignados.
+
+    **Contenido:**
+    - Perfil del profesional
+    - Por cada paciente: perfil, sesiones, tareas e historial de chat completo
+
+    Los datos se leen de los cursores de Mongo y se envían en streaming,
+    sin cargar el historial completo en memoria.
+    """
+    professional = await db.professionals.find_one({"id": professional_id}, {"_id": 0})
+    if not professional:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Profesional no encontrado"
+        )
+
+    records = iter_professional_records(db, professional)
+    filename = export_filename("professional", professional_id, format, compress)
+    return StreamingResponse(
+        export_stream(records, format, compress),
+        media_type=export_media_type(format, compress),
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 # =============================================================================
 # PATIENTS
 # =============================================================================
 
 @api_router.get("/patients/{patient_id}/profile", response_model=Patient)
 async def get_patient_profile(patient_id: str):
-    patient = await db.patients.find_one({"id": patient_id})
+    patient = await patient_cache.get(db, patient_id)
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
-    patient.pop('_id', None)  # Remove MongoDB ObjectId
     return Patient(**patient)
 
+@api_router.get(
+    "/patients/{patient_id}/home",
+    tags=["patients"],
+    summary="🏠 Inicio del paciente",
+    description="Perfil, chat reciente, tareas y sesiones del paciente en una sola respuesta"
+)
+async def get_patient_home(patient_id: str):
+    """
+    Todo lo que necesita la vista del paciente al abrirse, leído en paralelo.
+
+    **Secciones:** `profile`, `chat` (del más antiguo al más reciente), `tasks`, `sessions`,
+    cada una solo con los campos que muestra la interfaz.
+
+    **Fallo parcial:** una sección que falla o supera su timeout vuelve a `null` y
+    aparece en `errors`; las demás se devuelven igualmente.
+    """
+    try:
+        return await load_patient_home(repos, lambda pid: patient_cache.get(db, pid), patient_id)
+    except PatientNotFound:
+        raise HTTPException(status_code=404, detail="Patient not found")
+
 @api_router.get("/patients/{patient_id}/sessions", response_model=List[Session])
-async def get_patient_sessions(patient_id: str):
-    sessions_docs = await db.sessions.find({"patient_id": patient_id}).sort("session_date", -1).to_list(50)
-    sessions = []
-    for session_doc in sessions_docs:
-        session_doc.pop('_id', None)  # Remove MongoDB ObjectId
-        sessions.append(Session(**session_doc))
-    return sessions
+async def get_patient_sessions(patient_id: str, request: Request, response: Response):
+    etag, cached = check_not_modified(request, await repos.sessions.version(patient_id))
+    if cached:
+        return cached
+    response.headers["ETag"] = etag
+    
+    sessions_docs = await repos.sessions.list_by_patient(patient_id)
+    return [Session(**session_doc) for session_doc in sessions_docs]
 
 @api_router.get("/patients/{patient_id}/tasks", response_model=List[Task])
-async def get_patient_tasks(patient_id: str):
-    tasks_docs = await db.tasks.find({"patient_id": patient_id}).sort("created_at", -1).to_list(50)
-    tasks = []
-    for task_doc in tasks_docs:
-        task_doc.pop('_id', None)  # Remove MongoDB ObjectId
-        tasks.append(Task(**task_doc))
-    return tasks
+async def get_patient_tasks(patient_id: str, request: Request, response: Response):
+    etag, cached = check_not_modified(request, await repos.tasks.version(patient_id))
+    if cached:
+        return cached
+    response.headers["ETag"] = etag
+    
+    tasks_docs = await repos.tasks.list_by_patient(patient_id)
+    return [Task(**task_doc) for task_doc in tasks_docs]
+
+@api_router.get(
+    "/patients/{patient_id}/trends",
+    tags=["patients"],
+    summary="📈 Tendencia de ánimo del paciente",
+    description="Serie de ánimo por sesión con medias móviles y resumen de tendencia"
+)
+async def get_patient_trends(
+    patient_id: str,
+    request: Request,
+    response: Response,
+    window: int = Query(DEFAULT_WINDOW, ge=2, le=20, description="Sesiones por media móvil")
+):
+    version = await collection_version(db, "sessions", {"patient_id": patient_id}, ["created_at", "updated_at"])
+    etag, cached = check_not_modified(request, version)
+    if cached:
+        return cached
+    response.headers["ETag"] = etag
+
+    series = await load_session_series(db, {"patient_id": patient_id})
+    summaries = trends_to_records(await compute_trends.offload(series, window=window))
+
+    return {
+        "patient_id": patient_id,
+        "window": window,
+        "summary": summaries[0] if summaries else None,
+        "sessions": session_timeline(series, window=window)
+    }
+
+@api_router.get(
+    "/patients/{patient_id}/export",
+    tags=["patients"],
+    summary="📦 Exportar historial del paciente",
+    description="Exporta en streaming perfil, sesiones, tareas e historial de chat completo del paciente"
+)
+async def export_patient_record(
+    patient_id: str,
+    format: str = Query("ndjson", pattern="^(ndjson|zip)$", description="Formato: ndjson o zip"),
+    compress: bool = Query(False, description="Comprimir NDJSON con gzip al vuelo")
+):
+    """
+    Exporta el historial completo de un paciente.
+
+    **Formatos:**
+    - `ndjson`: una línea JSON por registro (`{"type": ..., "data": ...}`), opcionalmente gzip
+    - `zip`: un archivo NDJSON por tipo de registro
+
+    Los datos se leen de los cursores de Mongo y se envían en streaming,
+    sin límite de sesiones, tareas o mensajes.
+    """
+    patient = await db.patients.find_one({"id": patient_id}, {"_id": 0})
+    if not patient:
+        raise HTTPException(status_code=404, detail="Patient not found")
+
+    records = iter_patient_records(db, patient)
+    filename = export_filename("patient", patient_id, format, compress)
+    return StreamingResponse(
+        export_stream(records, format, compress),
+        media_type=export_media_type(format, compress),
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
 
 # =============================================================================
 # CHAT/AI ASSISTANT
 # =============================================================================
 
 @api_router.post("/chat/{patient_id}/message")
-async def send_chat_message(patient_id: str, message_data: ChatMessageCreate):
+async def send_chat_message(patient_id: str, message_data: ChatMessageCreate, request: Request):
+    patient = await patient_cache.get(db, patient_id)
+    professional_id = patient["professional_id"] if patient else None
+
+    # Crisis messages are never throttled
+    crisis_suspected = looks_like_crisis(message_data.message)
+    if not crisis_suspected:
+        await rate_limiter.enforce(db, patient=patient_id, professional=professional_id, ip=client_ip(request))
+        # Same per-call token counts as the usage ledger, which lives in the shared database
+        await enforce_llm_budget(tenant_router.shared, patient_id)
+    
+    # LLM usage of this request is charged to the patient and their professional
+    set_usage_entity(patient_id, professional_id)
+    # Suspected or recent crises skip the queue for the LLM
+    if crisis_suspected or in_recent_crisis(patient):
+        set_llm_priority(CRISIS)
+
     # Save user message
     user_message = ChatMessage(
         patient_id=patient_id,
@@ -903,12 +1351,11 @@ async def send_chat_message(patient_id: str, message_data: ChatMessageCreate):
     )
     
     # Save both messages
-    await db.chat_messages.insert_one(user_message.dict())
-    await db.chat_messages.insert_one(ai_message.dict())
+    await repos.chat.append([user_message.dict(), ai_message.dict()])
     
     # If crisis detected, alert professional
     if ai_result["is_crisis"]:
-        patient = await db.patients.find_one({"id": patient_id})
+        await record_crisis_event(db, patient_id)
         if patient:
             # In production, send real-time notification
             logging.warning(f"CRISIS ALERT: Patient {patient_id} needs immediate attention")
@@ -920,14 +1367,29 @@ async def send_chat_message(patient_id: str, message_data: ChatMessageCreate):
     }
 
 @api_router.get("/chat/{patient_id}/history")
-async def get_chat_history(patient_id: str, limit: int = 50):
-    messages_docs = await db.chat_messages.find(
-        {"patient_id": patient_id}
-    ).sort("timestamp", -1).limit(limit).to_list(limit)
+async def get_chat_history(patient_id: str, request: Request, response: Response, limit: int = 50, before: Optional[datetime] = None):
+    flight = single_flight("chat_history")
+    # Messages are immutable, so the newest timestamp and the count identify the first page
+    if before is None:
+        version = await flight.do(
+            ("version", patient_id),
+            lambda: repos.chat.version(patient_id)
+        )
+        etag, cached = check_not_modified(request, version)
+        if cached:
+            return cached
+        response.headers["ETag"] = etag
+    
+    # Reads recent messages first and falls back to the archive when paging further back.
+    # The first page must show the patient's own messages at once (primary); older pages
+    # don't change, so they are read from secondaries
+    messages_docs = await flight.do(
+        ("page", patient_id, limit, before),
+        lambda: repos.chat.history(patient_id, limit, before)
+    )
     
     messages = []
     for msg_doc in messages_docs:
-        msg_doc.pop('_id', None)  # Remove MongoDB ObjectId
         messages.append(ChatMessage(**msg_doc))
     
     return messages
@@ -938,26 +1400,40 @@ async def get_chat_history(patient_id: str, limit: int = 50):
 
 @api_router.post("/sessions", response_model=Session)
 async def create_session(session_data: SessionCreate):
+    await enter_tenant_of("patient", session_data.patient_id)
     session_dict = session_data.dict()
     session_obj = Session(**session_dict)
-    await db.sessions.insert_one(session_obj.dict())
+    await repos.sessions.create(session_obj.dict())
     return session_obj
 
 @api_router.put("/sessions/{session_id}/transcript")
 async def update_session_transcript(session_id: str, transcript: str):
     # Update transcript
-    await db.sessions.update_one(
+    session = await db.sessions.find_one_and_update(
         {"id": session_id},
         {
             "$set": {
                 "transcript": transcript,
                 "updated_at": datetime.utcnow()
             }
-        }
+        },
+        projection={"_id": 0, "id": 1, "patient_id": 1, "professional_id": 1, "notes": 1, "transcript": 1, "session_date": 1},
+        return_document=ReturnDocument.AFTER
     )
     
+    # Summaries of similar past sessions give the analysis context without the whole history
+    vector = None
+    past_summaries = []
+    if session:
+        set_usage_entity(session["patient_id"], session["professional_id"])
+        vector = await embed_text.offload(session_text(session))
+        similar = await find_similar_sessions(
+            db, session["professional_id"], vector, k=3, patient_id=session["patient_id"], exclude=session_id
+        )
+        past_summaries = [s["summary"] for s in similar if s.get("summary")]
+    
     # Generate AI analysis
-    analysis = await analyze_session_transcript(transcript)
+    analysis = await analyze_session_transcript(transcript, past_summaries)
     
     # Update with analysis
     await db.sessions.update_one(
@@ -965,43 +1441,75 @@ async def update_session_transcript(session_id: str, transcript: str):
         {
             "$set": {
                 "ai_analysis": analysis,
-                "status": "completed"
+                "status": "completed",
+                "updated_at": datetime.utcnow()
             }
         }
     )
     
+    # Keep the patient's risk level current
+    if session:
+        await apply_session_analysis_risk(db, session["patient_id"], analysis)
+        await store_session_vector(db, session, vector, analysis.get("summary"))
+    
     return {"message": "Transcript updated and analyzed", "analysis": analysis}
 
+@api_router.get("/sessions/{session_id}/similar")
+async def get_similar_sessions(
+    session_id: str,
+    limit: int = Query(5, ge=1, le=50),
+    same_patient: bool = Query(False, description="Solo sesiones del mismo paciente")
+):
+    stored = await load_session_vector(db, session_id)
+    if stored is None:
+        # Sessions analyzed before vectors existed are embedded on first request
+        session = await db.sessions.find_one({"id": session_id}, {"_id": 0})
+        if not session:
+            raise HTTPException(status_code=404, detail="Session not found")
+        text = session_text(session)
+        if not text:
+            return []
+        stored = {**session, "vector": await embed_text.offload(text)}
+        await store_session_vector(db, session, stored["vector"], (session.get("ai_analysis") or {}).get("summary"))
+
+    return await find_similar_sessions(
+        db,
+        stored["professional_id"],
+        stored["vector"],
+        k=limit,
+        patient_id=stored["patient_id"] if same_patient else None,
+        exclude=session_id
+    )
+
 # =============================================================================
 # TASKS
 # =============================================================================
 
 @api_router.post("/tasks", response_model=Task)
 async def create_task(task_data: TaskCreate):
+    await enter_tenant_of("patient", task_data.patient_id)
     # Get professional ID from patient
-    patient = await db.patients.find_one({"id": task_data.patient_id})
+    patient = await patient_cache.get(db, task_data.patient_id)
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
     
     task_dict = task_data.dict()
     task_dict["professional_id"] = patient["professional_id"]
     task_obj = Task(**task_dict)
-    await db.tasks.insert_one(task_obj.dict())
+    await repos.tasks.create(task_obj.dict())
+    task_scheduler = task_schedulers.get(current_tenant.get())
+    if task_scheduler:
+        task_scheduler.schedule(task_obj.dict())
     
     return task_obj
 
 @api_router.put("/tasks/{task_id}/complete")
 async def complete_task(task_id: str, completion_notes: Optional[str] = None):
-    await db.tasks.update_one(
-        {"id": task_id},
-        {
-            "$set": {
-                "status": "completed",
-                "completed_at": datetime.utcnow(),
-                "completion_notes": completion_notes
-            }
-        }
-    )
+    completed = await repos.tasks.complete(task_id, completion_notes, datetime.utcnow())
+    # AI feedback is generated in the background, batched with other completed tasks
+    task_scheduler = task_schedulers.get(current_tenant.get())
+    if completed and task_scheduler:
+        task_scheduler.enqueue_feedback(task_id)
     return {"message": "Task completed successfully"}
 
 # =============================================================================
@@ -1010,11 +1518,11 @@ async def complete_task(task_id: str, completion_notes: Optional[str] = None):
 
 @api_router.get("/analytics/dashboard")
 async def get_analytics_dashboard():
-    total_users = await db.users.count_documents({})
-    total_patients = await db.patients.count_documents({})
-    total_professionals = await db.professionals.count_documents({})
-    total_sessions = await db.sessions.count_documents({})
-    crisis_alerts = await db.chat_messages.count_documents({"is_crisis": True})
+    total_users = await stale_db.users.count_documents({})
+    total_patients = await stale_db.patients.count_documents({})
+    total_professionals = await stale_db.professionals.count_documents({})
+    total_sessions = await stale_db.sessions.count_documents({})
+    crisis_alerts = await stale_db.chat_messages.count_documents({"is_crisis": True}) + await count_archived_crisis(stale_db)
     
     return {
         "total_users": total_users,
@@ -1025,6 +1533,171 @@ async def get_analytics_dashboard():
         "system_status": "operational"
     }
 
+@api_router.post(
+    "/analytics/risk/recompute",
+    tags=["analytics"],
+    summary="🚨 Recalcular niveles de riesgo",
+    description="Ejecuta el recálculo en lote del nivel de riesgo de todos los pacientes"
+)
+async def recompute_risk_levels():
+    """
+    Recalcula `risk_level` y `risk_score` de todos los pacientes.
+
+    Combina crisis recientes, historial de sentimiento, el último análisis
+    de sesión y las tendencias de ánimo. El mismo proceso se ejecuta
+    automáticamente cada `RISK_RESCORE_INTERVAL_HOURS` horas.
+    """
+    return await recompute_all_risk(db)
+
+@api_router.post(
+    "/analytics/chat-archive/run",
+    tags=["analytics"],
+    summary="🗄️ Archivar mensajes antiguos",
+    description="Mueve los mensajes de chat antiguos al archivo comprimido"
+)
+async def run_chat_archive(
+    older_than_days: int = Query(ARCHIVE_AFTER_DAYS, ge=MIN_ARCHIVE_AFTER_DAYS, description="Antigüedad mínima en días")
+):
+    """
+    Empaqueta los mensajes con más de `older_than_days` días en buckets
+    comprimidos por paciente y mes dentro de `chat_archive`.
+
+    El mismo proceso se ejecuta automáticamente cada
+    `CHAT_ARCHIVE_INTERVAL_HOURS` horas con `CHAT_ARCHIVE_AFTER_DAYS`.
+
+    No se aceptan antigüedades dentro de las ventanas de la puntuación de
+    riesgo (`RISK_LOOKBACK_DAYS`), que solo lee los mensajes en caliente.
+    """
+    return await archive_old_messages(db, older_than_days=older_than_days)
+
+@api_router.get(
+    "/analytics/request-coalescing",
+    tags=["analytics"],
+    summary="🔀 Métricas de coalescencia de lecturas",
+    description="Peticiones recibidas frente a consultas ejecutadas por cada lectura coalescida"
+)
+async def get_request_coalescing_stats():
+    """
+    Contadores del proceso actual para las lecturas con single-flight
+    (dashboard del profesional, historial de chat y cargas de la caché de
+    pacientes y profesionales).
+
+    `coalescing_ratio` es la fracción de peticiones que reutilizaron una
+    consulta ya en curso en lugar de lanzar la suya.
+    """
+    return coalescing_stats()
+
+@api_router.get(
+    "/admin/llm-usage",
+    tags=["analytics"],
+    summary="💰 Consumo de tokens LLM",
+    description="Tokens y coste estimado del LLM agrupados por paciente, profesional, modelo, endpoint, día o institución"
+)
+async def get_llm_usage(
+    group_by: str = Query("patient_id", pattern=f"^({'|'.join(GROUP_FIELDS)})$", description="Campo de agrupación"),
+    start: Optional[date] = Query(None, description="Primer día (incluido)"),
+    end: Optional[date] = Query(None, description="Último día (incluido)"),
+    patient_id: Optional[str] = Query(None),
+    professional_id: Optional[str] = Query(None),
+    model: Optional[str] = Query(None),
+    endpoint: Optional[str] = Query(None, description="chat_message, sentiment, session_analysis, task_feedback, ai_chat"),
+    tenant: Optional[str] = Query(None),
+    limit: int = Query(100, ge=1, le=1000)
+):
+    """
+    Ledger de uso del LLM, de mayor a menor consumo.
+
+    **Por grupo:** llamadas (y fallidas), elementos (`items`: una llamada por lotes
+    cuenta una vez en `calls` y una vez por paciente en `items`), tokens de
+    entrada/salida, tokens por modelo y coste estimado en USD.
+
+    Cada worker vuelca sus contadores cada `LLM_USAGE_FLUSH_SECONDS`: el uso más
+    reciente puede tardar ese tiempo en aparecer.
+    """
+    filters = {
+        "patient_id": patient_id,
+        "professional_id": professional_id,
+        "model": model,
+        "endpoint": endpoint,
+        "tenant": tenant,
+    }
+    rows = await usage_report(
+        tenant_router.shared, group_by,
+        start.isoformat() if start else None, end.isoformat() if end else None,
+        filters, limit
+    )
+    return {"group_by": group_by, "rows": rows, "ledger": llm_usage.stats()}
+
+@api_router.get(
+    "/analytics/micro-batching",
+    tags=["analytics"],
+    summary="📦 Métricas de micro-batching",
+    description="Elementos recibidos frente a llamadas al LLM por cada clasificación agrupada en lotes"
+)
+async def get_micro_batch_stats():
+    """
+    Contadores del proceso actual por cada micro-batcher (clasificación de
+    sentimiento de los mensajes de chat).
+
+    `avg_batch_size` es cuántas clasificaciones resuelve de media cada
+    llamada al proveedor; `failed_batches`, los lotes que terminaron en error.
+    """
+    return micro_batch_stats()
+
+@api_router.get(
+    "/analytics/llm-dispatcher",
+    tags=["analytics"],
+    summary="🚦 Métricas de la cola del LLM",
+    description="Concurrencia, cola y espera por carril (crisis, chat, segundo plano) de las llamadas al LLM"
+)
+async def get_llm_dispatcher_stats():
+    """
+    Contadores del proceso actual por carril del dispatcher del LLM:
+
+    - `crisis`: mensajes con indicios de crisis o de pacientes con una crisis reciente
+    - `chat`: chat interactivo y clasificación de sentimiento
+    - `background`: análisis de transcripciones y feedback de tareas
+
+    `queued` son las llamadas esperando hueco; `avg_wait_ms`, `p95_wait_ms` y
+    `max_wait_ms` la espera hasta obtenerlo; `promoted`, las que adelantaron a
+    carriles más prioritarios tras esperar `starvation_seconds`.
+    """
+    return llm_dispatcher.stats()
+
+@api_router.get(
+    "/analytics/compute-pool",
+    tags=["analytics"],
+    summary="⚙️ Métricas de los pools de cómputo",
+    description="Cola, espera y tiempo de ejecución del trabajo de CPU descargado del event loop"
+)
+async def get_compute_pool_stats():
+    """
+    Contadores del proceso actual por pool:
+
+    - `process`: tokenización y embeddings de transcripciones largas
+    - `thread`: cálculos con NumPy (tendencias, índices de sesiones)
+
+    `queue_depth` son las tareas esperando un worker libre; `avg_wait_ms` y
+    `max_wait_ms` el tiempo desde que se encolan hasta que empiezan.
+    """
+    return compute_pool.snapshot()
+
+@api_router.get(
+    "/analytics/entity-cache",
+    tags=["analytics"],
+    summary="🗃️ Métricas de la caché de entidades",
+    description="Aciertos, fallos y latencia de carga de la caché de pacientes y profesionales"
+)
+async def get_entity_cache_stats():
+    """
+    Contadores del proceso actual para la caché de lectura de `patients` y
+    `professionals`.
+
+    `avg_load_ms` es la latencia media de las lecturas que fueron a Mongo;
+    los aciertos se sirven desde memoria sin consulta.
+    """
+    return entity_cache_stats()
+
 # Health check
 @api_router.get(
     "/health",
@@ -1043,19 +1716,11 @@ async def health_check():
     - Versión de la API
     - Estado de servicios dependientes (base de datos, IA, etc.)
     
-    **Códigos de respuesta:**
-    - 200: Sistema saludable
-    - 503: Problemas detectados en servicios críticos
+    El estado sale de la sonda en segundo plano; este endpoint no consulta
+    la base de datos. Para balanceadores y orquestadores usa `/live` y `/ready`.
     """
-    try:
-        # Check database connection
-        await db.command("ping")
-        db_status = "connected"
-    except Exception:
-        db_status = "disconnected"
-    
-    # Check AI service (OpenAI key)
-    ai_status = "operational" if OPENAI_API_KEY and OPENAI_API_KEY != 'your-openai-api-key-here' else "not_configured"
+    db_status = "connected" if health_monitor.database["up"] else "disconnected"
+    ai_status = health_monitor.llm_status()
     
     return HealthCheck(
         status="healthy" if db_status == "connected" else "degraded",
@@ -1067,6 +1732,39 @@ async def health_check():
         }
     )
 
+@api_router.get(
+    "/live",
+    tags=["health"],
+    summary="💓 Liveness",
+    description="El proceso está vivo y su event loop responde"
+)
+async def liveness():
+    """Siempre 200 mientras el worker pueda atender peticiones; no comprueba dependencias."""
+    return {"status": "alive"}
+
+@api_router.get(
+    "/ready",
+    tags=["health"],
+    summary="🚦 Readiness",
+    description="El worker puede recibir tráfico: base de datos accesible y event loop sin retraso excesivo"
+)
+async def readiness(response: Response):
+    """
+    Devuelve la última instantánea de la sonda en segundo plano, sin tocar la
+    base de datos.
+
+    **Códigos de respuesta:**
+    - 200: `ready`, o `degraded` si el proveedor de IA no está disponible
+      (el chat responde con mensajes de respaldo)
+    - 503: `starting` o `not_ready` (base de datos inaccesible o event loop
+      con más retraso que `HEALTH_MAX_LOOP_LAG_MS`)
+    """
+    snapshot = health_monitor.readiness()
+    response.headers["Cache-Control"] = "no-store"
+    if not snapshot["ready"]:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return snapshot
+
 # =============================================================================
 # AUTHENTICATION ENDPOINTS
 # =============================================================================
@@ -1196,37 +1894,18 @@ async def login_user(credentials: UserLogin):
         user=user_data
     )
 
-# Include the router in the main app
-app.include_router(api_router)
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
+logger = logging.getLogger(__name__)
 
-# Custom OpenAPI schema
-def custom_openapi():
-    if app.openapi_schema:
-        return app.openapi_schema
-    openapi_schema = get_openapi(
-        title="🧠 Zentium Assist API",
-        version="2.0.0",
-        description=app.description,
-        routes=app.routes,
-    )
-    openapi_schema["info"]["x-logo"] = {
-        "url": "https://zentiumassist.com/logo.png"
-    }
-    app.openapi_schema = openapi_schema
-    return app.openapi_schema
-
-app.openapi = custom_openapi
+# =============================================================================
+# APPLICATION FACTORY
+# =============================================================================
 
 # Redirect root to docs
-@app.get("/", include_in_schema=False)
 async def redirect_to_docs():
     return HTMLResponse("""
     <html>
@@ -1290,13 +1969,141 @@ async def redirect_to_docs():
     </html>
     """)
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+async def warm_up(databases):
+    """Index creation and heavy imports, off the startup path so workers are ready at once"""
+    for database in databases:
+        try:
+            await ensure_risk_indexes(database)
+            await ensure_archive_indexes(database)
+            await ensure_rate_limit_indexes(database)
+            await ensure_task_indexes(database)
+            await ensure_search_indexes(database)
+            await ensure_vector_indexes(database)
+            await ensure_tenant_indexes(database)
+            await ensure_crisis_alert_indexes(database)
+            await ensure_idempotency_indexes(database)
+        except Exception as e:
+            logger.error(f"Error creating indexes in {database.name}: {e}")
+    try:
+        await ensure_llm_usage_indexes(tenant_router.shared)
+    except Exception as e:
+        logger.error(f"Error creating LLM usage indexes: {e}")
+    try:
+        await asyncio.to_thread(load_llm)
+    except Exception as e:
+        logger.error(f"Error loading LLM client: {e}")
+
+async def in_tenant(tenant: str, job):
+    """Run a background job with `tenant` as the current tenant (LLM usage is charged to it)"""
+    current_tenant.set(tenant)
+    await job
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Owns the Mongo client and background jobs for the lifetime of a worker"""
+    global client, tenant_router, db, stale_db, task_schedulers, repos
+    # Health reads the driver's own heartbeats instead of pinging the database
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], event_listeners=[health_monitor.heartbeats])
+    tenant_router = TenantRouter(client, os.environ['DB_NAME'], configured_tenants())
+    db = TenantDatabase(tenant_router)
+    stale_db = TenantDatabase(tenant_router, stale=True)
+    repos = mongo_repositories(db, stale_db)
+    app.state.db = db
+    databases = tenant_router.databases()
+    task_schedulers = {tenant: TaskScheduler(database, generate_tasks_feedback) for tenant, database in databases.items()}
+    llm_configured = bool(OPENAI_API_KEY) and OPENAI_API_KEY != 'your-openai-api-key-here'
+    jobs = [
+        health_monitor.run(tenant_router.shared, llm_configured=llm_configured),
+        warm_up(databases.values()),
+        llm_usage.run(tenant_router.shared),
+    ]
+    # Periodic jobs run once per tenant database, with that tenant as the current one
+    for tenant, database in databases.items():
+        jobs += [
+            in_tenant(tenant, job) for job in (
+                risk_rescore_loop(database),
+                chat_archive_loop(database),
+                watch_entity_changes(database),
+                task_schedulers[tenant].run(),
+                task_schedulers[tenant].feedback_worker(),
+                task_schedulers[tenant].feedback_sweep(),
+            )
+        ]
+    compute_pool.start()
+    app.state.background_tasks = [asyncio.create_task(job) for job in jobs]
+    yield
+    for task in app.state.background_tasks:
+        task.cancel()
+    # Let the jobs finish unwinding before the final flush and closing the client they use
+    await asyncio.gather(*app.state.background_tasks, return_exceptions=True)
+    try:
+        await llm_usage.flush(tenant_router.shared)
+    except Exception as e:
+        logger.error(f"Error flushing LLM usage: {e}")
+    compute_pool.shutdown()
+    client.close()
+
+def create_app() -> FastAPI:
+    """Build the API application; resources are created by its lifespan"""
+    app = FastAPI(
+        title="🧠 Zentium Assist API",
+        description=API_DESCRIPTION,
+        version="2.0.0",
+        contact={
+            "name": "Zentium Assist Support",
+            "url": "https://zentiumassist.com",
+            "email": "support@zentiumassist.com",
+        },
+        license_info={
+            "name": "MIT License",
+            "url": "https://opensource.org/licenses/MIT",
+        },
+        openapi_tags=OPENAPI_TAGS,
+        lifespan=lifespan
+    )
+
+    # Include the router in the main app
+    app.include_router(api_router)
+
+    # Retried LLM writes replay the stored response; inside the tenant middleware so keys live in the tenant's database
+    app.add_middleware(IdempotencyMiddleware, db_getter=lambda: db)
+    # Wraps the idempotency middleware and every handler, so both see the request's tenant database
+    app.add_middleware(TenantMiddleware, router_getter=lambda: tenant_router)
+
+    # ETags are computed on the uncompressed body, so compression must wrap them
+    app.add_middleware(ConditionalGetMiddleware)
+    app.add_middleware(CompressionMiddleware, minimum_size=int(os.environ.get('COMPRESSION_MIN_SIZE', '1024')))
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_credentials=True,
+        allow_origins=["*"],
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    # Custom OpenAPI schema
+    def custom_openapi():
+        if app.openapi_schema:
+            return app.openapi_schema
+        openapi_schema = get_openapi(
+            title="🧠 Zentium Assist API",
+            version="2.0.0",
+            description=app.description,
+            routes=app.routes,
+        )
+        openapi_schema["info"]["x-logo"] = {
+            "url": "https://zentiumassist.com/logo.png"
+        }
+        app.openapi_schema = openapi_schema
+        return app.openapi_schema
+
+    app.openapi = custom_openapi
+
+    # Production mode: serve the built frontends here instead of through the Node proxy
+    mounted = mount_frontends(app) if os.environ.get('SERVE_FRONTENDS', 'false').lower() == 'true' else {}
+    if "/" not in mounted:
+        app.add_api_route("/", redirect_to_docs, include_in_schema=False)
+    return app
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+app = create_app()
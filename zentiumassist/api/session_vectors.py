@@ -0,0 +1,312 @@
+"""
+Recuperación de sesiones similares.
+
+Cada sesión se representa con un vector TF hasheado (feature hashing sobre
+raíces en español, sin modelo externo) que se calcula una sola vez al
+guardar la transcripción y se almacena como float32 en `session_vectors`.
+
+Por profesional se construye en memoria un índice con ponderación IDF:
+búsqueda exacta con un producto matriz-vector para pocos miles de sesiones
+y, por encima, un índice IVF (k-means grueso + exploración de las
+`nprobe` listas más cercanas) para mantener la latencia en milisegundos con
+cientos de miles de sesiones. Al guardar una sesión su vector se añade o
+sustituye en el índice ya construido (IDF y centroides fijos, se asigna a la
+lista del centroide más cercano); el índice se reconstruye al caducar o
+cuando los cambios acumulados superan `INDEX_DRIFT_FRACTION` de su tamaño.
+"""
+
+import hashlib
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from bson import Binary
+from pymongo import ASCENDING
+
+from compute_pool import THREAD, compute_pool, cpu_bound
+from search import STOPWORDS, WORD_RE, fold, light_stem
+from single_flight import single_flight
+
+VECTOR_DIM = 256
+EXACT_SEARCH_LIMIT = 4096
+IVF_NPROBE = 8
+KMEANS_ITERATIONS = 8
+KMEANS_SAMPLE = 20000
+INDEX_TTL_SECONDS = float(os.environ.get("SESSION_INDEX_TTL_SECONDS", "300"))
+INDEX_DRIFT_FRACTION = float(os.environ.get("SESSION_INDEX_DRIFT_FRACTION", "0.2"))
+# Por debajo (~1 ms) no compensa enviar el texto a otro proceso
+EMBED_INLINE_CHARS = 2000
+
+
+def _bucket(token: str) -> int:
+    return int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=4).digest(), "little")
+
+
+@cpu_bound(inline_if=lambda text, dim=VECTOR_DIM: len(text) < EMBED_INLINE_CHARS)
+def embed_text(text: str, dim: int = VECTOR_DIM) -> np.ndarray:
+    """Vector de frecuencias (log TF) hasheado con signo y normalizado en L2"""
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in WORD_RE.findall(fold(text)):
+        if len(word) < 3 or word in STOPWORDS or word.isdigit():
+            continue
+        h = _bucket(light_stem(word))
+        # El signo reduce el sesgo de las colisiones del hashing
+        vector[h % dim] += 1.0 if (h >> 31) & 1 else -1.0
+    vector = np.sign(vector) * np.log1p(np.abs(vector))
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def session_text(session: Dict[str, Any]) -> str:
+    parts = [session.get("notes"), session.get("transcript")]
+    return "\n".join(p for p in parts if isinstance(p, str))
+
+
+def to_binary(vector: np.ndarray) -> Binary:
+    return Binary(vector.astype(np.float32).tobytes())
+
+
+def from_binary(data: bytes) -> np.ndarray:
+    return np.frombuffer(data, dtype=np.float32)
+
+
+async def store_session_vector(db, session: Dict[str, Any], vector: np.ndarray, summary: Optional[str]):
+    await db.session_vectors.update_one(
+        {"_id": session["id"]},
+        {"$set": {
+            "professional_id": session["professional_id"],
+            "patient_id": session["patient_id"],
+            "session_date": session.get("session_date"),
+            "summary": summary,
+            "dim": int(vector.size),
+            "vector": to_binary(vector),
+            "updated_at": datetime.utcnow()
+        }},
+        upsert=True
+    )
+    if vector.size == VECTOR_DIM:
+        session_indexes.add(session["professional_id"], session["id"], session["patient_id"], vector)
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class SessionIndex:
+    """Índice en memoria de las sesiones de un profesional"""
+
+    def __init__(self, ids: List[str], patient_ids: List[str], vectors: np.ndarray):
+        self.ids = list(ids)
+        self.position = {session_id: i for i, session_id in enumerate(ids)}
+        # IDF suavizado sobre los buckets presentes en cada sesión
+        df = np.count_nonzero(vectors, axis=0).astype(np.float32)
+        self.idf = np.log((1.0 + len(ids)) / (1.0 + df)).astype(np.float32) + 1.0
+        # Filas con capacidad de sobra para añadir sesiones sin copiar la matriz cada vez
+        self._rows = _normalize_rows(vectors * self.idf)
+        self._patient_ids = np.asarray(patient_ids, dtype=object)
+        self.built_at = time.monotonic()
+        self.built_size = len(ids)
+        self.changes = 0
+        self.centroids: Optional[np.ndarray] = None
+        self.lists: List[np.ndarray] = []
+        if len(ids) > EXACT_SEARCH_LIMIT:
+            self._build_ivf()
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._rows[:len(self.ids)]
+
+    @property
+    def patient_ids(self) -> np.ndarray:
+        return self._patient_ids[:len(self.ids)]
+
+    def stale(self, ttl: float) -> bool:
+        """Caducado, con demasiados cambios sobre el IDF y los centroides originales o ya grande para búsqueda exacta"""
+        return (
+            time.monotonic() - self.built_at >= ttl
+            or self.changes > INDEX_DRIFT_FRACTION * max(self.built_size, 1)
+            or (self.centroids is None and len(self.ids) > EXACT_SEARCH_LIMIT)
+        )
+
+    def _nearest_list(self, row: np.ndarray) -> int:
+        return int(np.argmax(self.centroids @ row))
+
+    def _grow(self):
+        capacity = max(16, 2 * self._rows.shape[0])
+        rows = np.zeros((capacity, self._rows.shape[1]), dtype=self._rows.dtype)
+        rows[:len(self.ids)] = self.vectors
+        patient_ids = np.empty(capacity, dtype=object)
+        patient_ids[:len(self.ids)] = self.patient_ids
+        self._rows, self._patient_ids = rows, patient_ids
+
+    def upsert(self, session_id: str, patient_id: str, raw_vector: np.ndarray):
+        """Añade o sustituye una sesión sin reconstruir el índice"""
+        row = raw_vector * self.idf
+        row = row / max(float(np.linalg.norm(row)), 1e-12)
+        i = self.position.get(session_id)
+        if i is None:
+            i = len(self.ids)
+            if i == self._rows.shape[0]:
+                self._grow()
+            self.ids.append(session_id)
+            self.position[session_id] = i
+        elif self.centroids is not None:
+            # Los centroides no cambian: la lista actual es la más cercana al vector anterior
+            old = self._nearest_list(self._rows[i])
+            self.lists[old] = self.lists[old][self.lists[old] != i]
+        self._rows[i] = row
+        self._patient_ids[i] = patient_id
+        if self.centroids is not None:
+            nearest = self._nearest_list(row)
+            self.lists[nearest] = np.append(self.lists[nearest], i)
+        self.changes += 1
+
+    def _build_ivf(self):
+        n = self.vectors.shape[0]
+        nlist = int(np.sqrt(n))
+        rng = np.random.default_rng(0)
+        # Los centroides se entrenan sobre una muestra; luego se asignan todas las sesiones
+        sample = self.vectors[rng.choice(n, min(n, KMEANS_SAMPLE), replace=False)]
+        centroids = sample[rng.choice(sample.shape[0], nlist, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = np.bincount(assignment, minlength=nlist) == 0
+            sums[empty] = centroids[empty]
+            centroids = _normalize_rows(sums)
+        self.centroids = centroids
+        assignment = np.argmax(self.vectors @ centroids.T, axis=1)
+        order = np.argsort(assignment, kind="stable")
+        bounds = np.searchsorted(assignment[order], np.arange(nlist + 1))
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(nlist)]
+
+    def _candidates(self, query: np.ndarray) -> Optional[np.ndarray]:
+        if self.centroids is None:
+            return None
+        probe = np.argpartition(-(self.centroids @ query), min(IVF_NPROBE, len(self.lists) - 1))[:IVF_NPROBE]
+        return np.concatenate([self.lists[i] for i in probe])
+
+    def query(self, raw_vector: np.ndarray, k: int, patient_id: Optional[str] = None, exclude: Optional[str] = None) -> List[Dict[str, Any]]:
+        query = raw_vector * self.idf
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
+        query = query / norm
+        candidates = self._candidates(query)
+        if patient_id is not None:
+            # Pocas sesiones por paciente: búsqueda exacta sobre ellas
+            candidates = np.flatnonzero(self.patient_ids == patient_id)
+        if candidates is None:
+            scores = self.vectors @ query
+            candidates = np.arange(scores.size)
+        else:
+            scores = self.vectors[candidates] @ query
+        if exclude is not None and exclude in self.position:
+            # Se descarta antes de elegir los k mejores para devolver k resultados
+            keep = candidates != self.position[exclude]
+            candidates, scores = candidates[keep], scores[keep]
+        top = min(k, scores.size)
+        if top == 0:
+            return []
+        best = np.argpartition(-scores, top - 1)[:top]
+        best = best[np.argsort(-scores[best])]
+        return [
+            {"session_id": self.ids[candidates[i]], "similarity": round(float(scores[i]), 4)}
+            for i in best if scores[i] > 0
+        ]
+
+
+class SessionIndexRegistry:
+    """Índices por profesional, actualizados al guardar vectores y reconstruidos al caducar o al derivar"""
+
+    def __init__(self, ttl: float = INDEX_TTL_SECONDS):
+        self.ttl = ttl
+        self._indexes: Dict[str, SessionIndex] = {}
+        # Vectores guardados mientras se construye el índice, para aplicarlos al terminar
+        self._building: Dict[str, List[Tuple[str, str, np.ndarray]]] = {}
+
+    def add(self, professional_id: str, session_id: str, patient_id: str, vector: np.ndarray):
+        index = self._indexes.get(professional_id)
+        if index is not None:
+            index.upsert(session_id, patient_id, vector)
+        pending = self._building.get(professional_id)
+        if pending is not None:
+            pending.append((session_id, patient_id, vector))
+
+    async def get(self, db, professional_id: str) -> Optional[SessionIndex]:
+        index = self._indexes.get(professional_id)
+        if index is not None and not index.stale(self.ttl):
+            return index
+        return await single_flight("session_index").do(professional_id, lambda: self._build(db, professional_id))
+
+    async def _build(self, db, professional_id: str) -> Optional[SessionIndex]:
+        ids: List[str] = []
+        patient_ids: List[str] = []
+        rows: List[np.ndarray] = []
+        self._building[professional_id] = pending = []
+        try:
+            cursor = db.session_vectors.find(
+                {"professional_id": professional_id, "dim": VECTOR_DIM},
+                {"_id": 1, "patient_id": 1, "vector": 1}
+            )
+            async for doc in cursor:
+                ids.append(doc["_id"])
+                patient_ids.append(doc["patient_id"])
+                rows.append(from_binary(doc["vector"]))
+            if not ids:
+                return None
+            # La construcción (IDF y k-means) es CPU: fuera del event loop
+            index = await compute_pool.run(THREAD, SessionIndex, ids, patient_ids, np.vstack(rows))
+            for session_id, patient_id, vector in pending:
+                index.upsert(session_id, patient_id, vector)
+        finally:
+            del self._building[professional_id]
+        self._indexes[professional_id] = index
+        return index
+
+
+session_indexes = SessionIndexRegistry()
+
+
+async def find_similar_sessions(
+    db, professional_id: str, vector: np.ndarray, k: int = 5,
+    patient_id: Optional[str] = None, exclude: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """Sesiones más parecidas a `vector` con sus metadatos y resumen"""
+    index = await session_indexes.get(db, professional_id)
+    if index is None:
+        return []
+    hits = index.query(vector, k, patient_id=patient_id, exclude=exclude)
+    if not hits:
+        return []
+    docs = {
+        doc["_id"]: doc async for doc in db.session_vectors.find(
+            {"_id": {"$in": [hit["session_id"] for hit in hits]}},
+            {"vector": 0, "dim": 0}
+        )
+    }
+    return [
+        {
+            **hit,
+            "patient_id": docs[hit["session_id"]]["patient_id"],
+            "session_date": docs[hit["session_id"]].get("session_date"),
+            "summary": docs[hit["session_id"]].get("summary"),
+        }
+        for hit in hits if hit["session_id"] in docs
+    ]
+
+
+async def load_session_vector(db, session_id: str) -> Optional[Dict[str, Any]]:
+    doc = await db.session_vectors.find_one({"_id": session_id})
+    if doc is None or doc.get("dim") != VECTOR_DIM:
+        return None
+    doc["vector"] = from_binary(doc["vector"])
+    return doc
+
+
+async def ensure_vector_indexes(db):
+    await db.session_vectors.create_index([("professional_id", ASCENDING)])
@@ -0,0 +1,64 @@
+"""
+Coalescencia de lecturas idénticas concurrentes (single-flight).
+
+Cuando varias peticiones piden exactamente lo mismo a la vez (dashboards
+abiertos al mismo tiempo, peticiones duplicadas del frontend), solo la
+primera consulta a Mongo; el resto espera su resultado. Cada grupo lleva
+contadores para medir la tasa de coalescencia.
+
+Los resultados se comparten entre todos los que esperan: quien los use no
+debe modificarlos.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+_groups: Dict[str, "SingleFlight"] = {}
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.executions = 0
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    def _forget(self, key: Hashable, future: asyncio.Future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """Ejecuta `fn` una sola vez por clave entre las llamadas concurrentes"""
+        self.calls += 1
+        future = self._inflight.get(key)
+        if future is None:
+            self.executions += 1
+            future = asyncio.ensure_future(fn())
+            self._inflight[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+        # Si una petición se cancela, la consulta compartida sigue para los demás
+        return await asyncio.shield(future)
+
+    def stats(self) -> Dict[str, Any]:
+        coalesced = self.calls - self.executions
+        return {
+            "calls": self.calls,
+            "queries": self.executions,
+            "coalesced": coalesced,
+            "coalescing_ratio": round(coalesced / self.calls, 4) if self.calls else 0.0,
+            "in_flight": len(self._inflight),
+        }
+
+
+def single_flight(name: str) -> SingleFlight:
+    """Devuelve (creándolo si hace falta) el grupo con ese nombre"""
+    group = _groups.get(name)
+    if group is None:
+        group = _groups[name] = SingleFlight(name)
+    return group
+
+
+def coalescing_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: group.stats() for name, group in _groups.items()}
@@ -0,0 +1,129 @@
+"""
+Modo de producción: servir los frontends compilados desde la propia API.
+
+Monta los `build/` de `web`, `professional` y `patient` junto a `/api`, sin
+el proxy de Node ni los servidores de desarrollo de CRA:
+
+- Si el cliente acepta brotli o gzip y existe la variante `.br` / `.gz`
+  precomprimida junto al archivo, se sirve esa sin comprimir en cada
+  petición (`python static_frontends.py` las genera tras el build).
+- Los assets con hash de `static/` llevan `Cache-Control: immutable`; el
+  resto (index.html, manifest...) se revalida siempre.
+- Las rutas del cliente (sin extensión) devuelven `index.html` (SPA).
+
+Cada app debe compilarse con su prefijo, p. ej. `PUBLIC_URL=/patient`.
+"""
+
+import gzip
+import mimetypes
+import os
+import stat
+import sys
+from pathlib import Path
+from typing import Dict, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.exceptions import HTTPException
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Scope
+
+from http_cache import preferred_encodings
+
+try:
+    import brotli
+except ImportError:  # sin brotli solo se generan/sirven variantes gzip
+    brotli = None
+
+FRONTENDS_ROOT = Path(os.environ.get("FRONTENDS_ROOT", Path(__file__).resolve().parent.parent))
+# Prefijo de URL -> app; "/" debe montarse la última
+FRONTEND_MOUNTS = {"/professional": "professional", "/patient": "patient", "/": "web"}
+
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+PRECOMPRESS_SUFFIXES = {".html", ".js", ".css", ".json", ".svg", ".txt", ".map", ".ico", ".webmanifest"}
+PRECOMPRESS_MIN_SIZE = 1024
+ENCODING_SUFFIXES = (("br", ".br"), ("gzip", ".gz"))
+
+
+def _media_type(path) -> str:
+    media_type = mimetypes.guess_type(str(path))[0] or "application/octet-stream"
+    return f"{media_type}; charset=utf-8" if media_type.startswith("text/") else media_type
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles con variantes precomprimidas, caché inmutable y fallback SPA"""
+
+    def _precompressed(self, path: str, scope: Scope) -> Optional[Response]:
+        accepted = preferred_encodings(
+            Headers(scope=scope).get("accept-encoding", ""), tuple(encoding for encoding, _ in ENCODING_SUFFIXES)
+        )
+        original, original_stat = self.lookup_path(path)
+        if not original_stat or not stat.S_ISREG(original_stat.st_mode):
+            return None
+        suffixes = dict(ENCODING_SUFFIXES)
+        for encoding in accepted:
+            suffix = suffixes[encoding]
+            full_path, stat_result = self.lookup_path(path + suffix)
+            if stat_result and stat.S_ISREG(stat_result.st_mode) and stat_result.st_mtime >= original_stat.st_mtime:
+                response = self.file_response(full_path, stat_result, scope)
+                response.headers["Content-Encoding"] = encoding
+                if response.status_code == 200:
+                    # El tipo es el del archivo original, no el del .br/.gz
+                    response.headers["Content-Type"] = _media_type(original)
+                return response
+        return None
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        try:
+            response = self._precompressed(path, scope) or await super().get_response(path, scope)
+        except HTTPException as exc:
+            # Rutas del cliente (sin extensión): la SPA resuelve la vista
+            if exc.status_code != 404 or "." in path.rsplit("/", 1)[-1]:
+                raise
+            path = "index.html"
+            response = self._precompressed(path, scope) or await super().get_response(path, scope)
+        headers: MutableHeaders = response.headers
+        headers["Cache-Control"] = IMMUTABLE_CACHE if path.startswith("static/") else REVALIDATE_CACHE
+        headers.add_vary_header("Accept-Encoding")
+        return response
+
+
+def frontend_build_dirs(root: Path = FRONTENDS_ROOT) -> Dict[str, Path]:
+    """Prefijo -> carpeta `build` de cada frontend que exista"""
+    dirs = {prefix: root / app / "build" for prefix, app in FRONTEND_MOUNTS.items()}
+    return {prefix: path for prefix, path in dirs.items() if path.is_dir()}
+
+
+def mount_frontends(app, root: Path = FRONTENDS_ROOT) -> Dict[str, Path]:
+    mounted = frontend_build_dirs(root)
+    for prefix, path in mounted.items():
+        app.mount(prefix, PrecompressedStaticFiles(directory=path, html=True), name=f"frontend:{prefix}")
+    return mounted
+
+
+def precompress_build(build_dir: Path) -> int:
+    """Genera las variantes .gz (y .br si hay brotli) de los assets de texto"""
+    written = 0
+    for path in build_dir.rglob("*"):
+        if not path.is_file() or path.suffix not in PRECOMPRESS_SUFFIXES or path.stat().st_size < PRECOMPRESS_MIN_SIZE:
+            continue
+        data = path.read_bytes()
+        variants = {".gz": lambda: gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants[".br"] = lambda: brotli.compress(data, quality=11)
+        for suffix, compress in variants.items():
+            target = path.with_name(path.name + suffix)
+            if target.exists() and target.stat().st_mtime >= path.stat().st_mtime:
+                continue
+            compressed = compress()
+            if len(compressed) < len(data):
+                target.write_bytes(compressed)
+                written += 1
+    return written
+
+
+if __name__ == "__main__":
+    root = Path(sys.argv[1]) if len(sys.argv) > 1 else FRONTENDS_ROOT
+    for prefix, build_dir in frontend_build_dirs(root).items():
+        print(f"{prefix}: {precompress_build(build_dir)} archivos precomprimidos en {build_dir}")
@@ -0,0 +1,213 @@
+"""
+Codificación compacta de los mensajes de chat en Mongo.
+
+`chat_messages` es con diferencia la colección más grande y su índice
+(`patient_id`, `timestamp`) el que más memoria ocupa. En almacenamiento:
+
+- `id` y `patient_id` son UUID binarios (BSON Binary subtipo 4, 16 bytes)
+  en lugar de cadenas de 36 caracteres.
+- `sender` y el sentimiento se guardan como códigos enteros.
+- `sentiment_analysis: {"sentiment": ...}` se aplana en `sentiment`.
+
+La API no cambia: todo documento se decodifica al leerlo y se codifica al
+escribirlo en este módulo. Los documentos antiguos (cadenas) se siguen
+leyendo, y mientras `CHAT_CODEC_LEGACY_READS=true` los filtros aceptan ambas
+formas, de modo que la migración puede hacerse en caliente:
+
+    python storage_codec.py migrate [--compact]   # migra y muestra el ahorro
+    python storage_codec.py report                # tamaños de colecciones e índices
+
+Con la migración terminada en todas las bases, `CHAT_CODEC_LEGACY_READS=false`
+deja los filtros solo con la forma compacta.
+"""
+
+import asyncio
+import os
+import sys
+import uuid
+from typing import Any, Dict, Iterable, List, Optional
+
+from bson import Binary
+from bson.binary import UUID_SUBTYPE
+from pymongo import ReplaceOne
+
+LEGACY_READS = os.environ.get("CHAT_CODEC_LEGACY_READS", "true").lower() == "true"
+MIGRATION_BATCH_SIZE = 1000
+
+SENDER_CODES = {"patient": 0, "assistant": 1}
+SENTIMENT_CODES = {"neutral": 0, "positivo": 1, "negativo": 2, "crisis": 3}
+SENDERS = {code: name for name, code in SENDER_CODES.items()}
+SENTIMENTS = {code: name for name, code in SENTIMENT_CODES.items()}
+
+
+def encode_uuid(value: Any) -> Any:
+    """UUID en texto -> Binary de 16 bytes; cualquier otro valor se deja igual"""
+    if not isinstance(value, str):
+        return value
+    try:
+        return Binary.from_uuid(uuid.UUID(value))
+    except ValueError:
+        return value
+
+
+def decode_uuid(value: Any) -> Any:
+    if isinstance(value, Binary) and value.subtype == UUID_SUBTYPE:
+        return str(value.as_uuid())
+    return value
+
+
+def id_filter(value: str) -> Any:
+    """Condición sobre un campo de id que encuentra la forma compacta (y la antigua durante la migración)"""
+    encoded = encode_uuid(value)
+    if encoded is value or not LEGACY_READS:
+        return encoded
+    return {"$in": [encoded, value]}
+
+
+def ids_filter(values: Iterable[str]) -> Dict[str, Any]:
+    values = list(values)
+    encoded = [encode_uuid(v) for v in values]
+    return {"$in": encoded + values if LEGACY_READS else encoded}
+
+
+def _sentiment_values(sentiments: Iterable[str]) -> List[Any]:
+    return [SENTIMENT_CODES.get(s, s) for s in sentiments]
+
+
+def sentiment_filter(sentiments: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+    """Mensajes con sentimiento (entre `sentiments` si se indican), en ambas formas"""
+    sentiments = list(sentiments) if sentiments is not None else None
+    condition = {"$exists": True} if sentiments is None else {"$in": _sentiment_values(sentiments)}
+    compact = {"sentiment": condition}
+    if not LEGACY_READS:
+        return compact
+    legacy = {"sentiment_analysis.sentiment": {"$exists": True} if sentiments is None else {"$in": sentiments}}
+    return {"$or": [compact, legacy]}
+
+
+def encode_chat_message(message: Dict[str, Any]) -> Dict[str, Any]:
+    doc = dict(message)
+    doc["id"] = encode_uuid(doc["id"])
+    doc["patient_id"] = encode_uuid(doc["patient_id"])
+    doc["sender"] = SENDER_CODES.get(doc["sender"], doc["sender"])
+    sentiment = (doc.pop("sentiment_analysis", None) or {}).get("sentiment")
+    if sentiment is not None:
+        doc["sentiment"] = SENTIMENT_CODES.get(sentiment, sentiment)
+    return doc
+
+
+def decode_chat_message(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Documento almacenado (compacto o antiguo) -> forma de la API"""
+    message = dict(doc)
+    for field in ("id", "patient_id"):
+        if field in message:
+            message[field] = decode_uuid(message[field])
+    if "sender" in message:
+        message["sender"] = SENDERS.get(message["sender"], message["sender"])
+    if "sentiment" in message:
+        sentiment = message.pop("sentiment")
+        message["sentiment_analysis"] = {"sentiment": SENTIMENTS.get(sentiment, sentiment)}
+    return message
+
+
+# =============================================================================
+# MIGRACIÓN E INFORME
+# =============================================================================
+
+async def collection_sizes(db, collections: Iterable[str] = ("chat_messages", "chat_archive")) -> Dict[str, Dict[str, Any]]:
+    report = {}
+    for name in collections:
+        stats = await db.command("collStats", name)
+        report[name] = {
+            "count": stats.get("count", 0),
+            "size": stats.get("size", 0),
+            "avg_obj_size": stats.get("avgObjSize", 0),
+            "storage_size": stats.get("storageSize", 0),
+            "total_index_size": stats.get("totalIndexSize", 0),
+            "index_sizes": stats.get("indexSizes", {}),
+        }
+    return report
+
+
+async def migrate_chat_messages(db, batch_size: int = MIGRATION_BATCH_SIZE) -> int:
+    """
+    Reescribe en forma compacta los mensajes que aún tienen ids en texto.
+
+    Cada reemplazo exige que el documento siga en forma antigua, así que es
+    seguro con la app en marcha (escribiendo ya en forma compacta) y con el
+    archivado moviendo mensajes a la vez.
+    """
+    migrated = 0
+    last_id = None
+    while True:
+        query: Dict[str, Any] = {"patient_id": {"$type": "string"}}
+        if last_id is not None:
+            # Avanza por _id: los ids que no son UUID siguen en texto y no deben releerse
+            query["_id"] = {"$gt": last_id}
+        batch = await db.chat_messages.find(query).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            return migrated
+        last_id = batch[-1]["_id"]
+        result = await db.chat_messages.bulk_write(
+            [ReplaceOne({"_id": doc["_id"], "patient_id": doc["patient_id"]}, encode_chat_message(doc)) for doc in batch],
+            ordered=False
+        )
+        migrated += result.modified_count
+
+
+async def migrate_chat_archive(db) -> int:
+    """Recodifica los buckets del archivo cuyo `patient_id` sigue en texto"""
+    from chat_archive import decode_bucket, encode_bucket
+
+    migrated = 0
+    async for bucket in db.chat_archive.find({"patient_id": {"$type": "string"}}):
+        patient_id = encode_uuid(bucket["patient_id"])
+        if patient_id is bucket["patient_id"]:
+            continue
+        messages = [encode_chat_message(m) for m in decode_bucket(bucket)]
+        result = await db.chat_archive.update_one(
+            {"_id": bucket["_id"], "patient_id": bucket["patient_id"]},
+            {"$set": {"patient_id": patient_id, "payload": Binary(encode_bucket(messages))}}
+        )
+        migrated += result.modified_count
+    return migrated
+
+
+def _print_report(before: Dict[str, Any], after: Dict[str, Any]):
+    for name, stats in after.items():
+        old = before.get(name, stats)
+        print(f"{name}: {stats['count']} documentos")
+        for key in ("size", "avg_obj_size", "storage_size", "total_index_size"):
+            change = (stats[key] - old[key]) / old[key] if old[key] else 0.0
+            print(f"  {key}: {old[key]} -> {stats[key]} bytes ({change:+.0%})")
+        for index, size in stats["index_sizes"].items():
+            print(f"  índice {index}: {old['index_sizes'].get(index, size)} -> {size} bytes")
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    from tenancy import TenantRouter, configured_tenants
+
+    load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+    if len(sys.argv) < 2 or sys.argv[1] not in ("migrate", "report"):
+        sys.exit("uso: python storage_codec.py migrate [--compact] | report")
+
+    async def main():
+        client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+        router = TenantRouter(client, os.environ["DB_NAME"], configured_tenants())
+        for database in router.databases().values():
+            print(f"== {database.name}")
+            before = await collection_sizes(database)
+            if sys.argv[1] == "migrate":
+                print(f"mensajes migrados: {await migrate_chat_messages(database)}")
+                print(f"buckets migrados: {await migrate_chat_archive(database)}")
+                if "--compact" in sys.argv:
+                    # Devuelve al sistema el espacio liberado y reconstruye los índices
+                    for name in before:
+                        await database.command("compact", name)
+            _print_report(before, await collection_sizes(database))
+        client.close()
+
+    asyncio.run(main())
@@ -0,0 +1,296 @@
+"""
+Programador de tareas terapéuticas por fecha de vencimiento.
+
+- Recordatorios y vencimientos: solo se cargan las tareas abiertas cuyo
+  evento cae dentro del horizonte próximo (consulta por índice sobre
+  `status` + `due_date`) en un heap en memoria; un único bucle duerme hasta
+  el siguiente evento. El horizonte se recarga periódicamente, así que nunca
+  se recorre la colección completa aunque haya cientos de miles de tareas.
+- Feedback de IA: las tareas completadas quedan marcadas con
+  `ai_feedback_pending` y un worker las agrupa para generar el feedback de
+  varias tareas con una sola llamada al LLM. Si una tarea se queda sin
+  feedback se reintenta con espera exponencial (`ai_feedback_retry_at`); tras
+  `FEEDBACK_MAX_ATTEMPTS` intentos se desmarca y queda `ai_feedback_failed`.
+
+Los disparos son actualizaciones condicionales en Mongo, así que con varios
+workers cada recordatorio y cada vencimiento se aplica una sola vez.
+"""
+
+import asyncio
+import heapq
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from pymongo import ASCENDING
+
+from background_jobs import run_periodic
+
+OPEN_TASK_STATUSES = ["assigned", "in_progress"]
+OVERDUE_STATUS = "overdue"
+
+REMINDER_LEAD_HOURS = float(os.environ.get("TASK_REMINDER_LEAD_HOURS", "24"))
+SCHEDULER_HORIZON_MINUTES = float(os.environ.get("TASK_SCHEDULER_HORIZON_MINUTES", "60"))
+FEEDBACK_BATCH_SIZE = int(os.environ.get("TASK_FEEDBACK_BATCH_SIZE", "8"))
+FEEDBACK_BATCH_WAIT_SECONDS = 2.0
+FEEDBACK_SWEEP_MINUTES = 10
+FEEDBACK_SWEEP_LIMIT = 1000
+FEEDBACK_MAX_ATTEMPTS = int(os.environ.get("TASK_FEEDBACK_MAX_ATTEMPTS", "5"))
+FEEDBACK_RETRY_BASE_MINUTES = float(os.environ.get("TASK_FEEDBACK_RETRY_BASE_MINUTES", "10"))
+
+REMINDER = "reminder"
+OVERDUE = "overdue"
+
+logger = logging.getLogger(__name__)
+
+FeedbackGenerator = Callable[[List[Dict[str, Any]]], Awaitable[Dict[str, str]]]
+
+
+class TaskScheduler:
+    def __init__(
+        self,
+        db,
+        generate_feedback: FeedbackGenerator,
+        lead: timedelta = timedelta(hours=REMINDER_LEAD_HOURS),
+        horizon: timedelta = timedelta(minutes=SCHEDULER_HORIZON_MINUTES),
+    ):
+        self.db = db
+        self.generate_feedback = generate_feedback
+        self.lead = lead
+        self.horizon = horizon
+        self._heap: List[Tuple[datetime, str, str]] = []
+        self._scheduled: Set[Tuple[str, str]] = set()
+        self._loaded_until: Optional[datetime] = None
+        self._wakeup = asyncio.Event()
+        self._feedback_queue: "asyncio.Queue[str]" = asyncio.Queue()
+        self._feedback_pending: Set[str] = set()
+        self.stats = {"reminders": 0, "overdue": 0, "feedback_batches": 0, "feedback_tasks": 0, "feedback_failed": 0}
+
+    # -- Recordatorios y vencimientos -------------------------------------
+
+    def _push(self, fire_at: datetime, kind: str, task_id: str):
+        if (task_id, kind) in self._scheduled:
+            return
+        self._scheduled.add((task_id, kind))
+        if not self._heap or fire_at < self._heap[0][0]:
+            self._wakeup.set()
+        heapq.heappush(self._heap, (fire_at, kind, task_id))
+
+    def _schedule_doc(self, task: Dict[str, Any], now: datetime):
+        due = task.get("due_date")
+        if not due:
+            return
+        if task.get("reminder_sent_at") is None and due > now:
+            self._push(max(due - self.lead, now), REMINDER, task["id"])
+        self._push(due, OVERDUE, task["id"])
+
+    def schedule(self, task: Dict[str, Any]):
+        """Programa una tarea recién creada si vence dentro del horizonte ya cargado"""
+        due = task.get("due_date")
+        if due and self._loaded_until and due - self.lead <= self._loaded_until:
+            self._schedule_doc(task, datetime.utcnow())
+
+    async def _load_horizon(self, now: datetime):
+        until = now + self.horizon
+        cursor = self.db.tasks.find(
+            {
+                "status": {"$in": OPEN_TASK_STATUSES},
+                "$or": [
+                    {"due_date": {"$lte": until}},
+                    {"due_date": {"$lte": until + self.lead}, "reminder_sent_at": None},
+                ]
+            },
+            {"_id": 0, "id": 1, "due_date": 1, "reminder_sent_at": 1}
+        )
+        async for task in cursor:
+            if task["due_date"] > until:
+                # Vence fuera del horizonte: solo su recordatorio cae dentro
+                self._push(max(task["due_date"] - self.lead, now), REMINDER, task["id"])
+            else:
+                self._schedule_doc(task, now)
+        self._loaded_until = until
+
+    def _next_reload(self) -> datetime:
+        return self._loaded_until - self.horizon / 2
+
+    def _pop_due(self, now: datetime) -> Dict[str, List[str]]:
+        due: Dict[str, List[str]] = {REMINDER: [], OVERDUE: []}
+        while self._heap and self._heap[0][0] <= now:
+            _, kind, task_id = heapq.heappop(self._heap)
+            self._scheduled.discard((task_id, kind))
+            due[kind].append(task_id)
+        return due
+
+    async def _send_reminders(self, task_ids: List[str], now: datetime):
+        notifications = []
+        for task_id in task_ids:
+            task = await self.db.tasks.find_one_and_update(
+                {"id": task_id, "status": {"$in": OPEN_TASK_STATUSES}, "reminder_sent_at": None},
+                {"$set": {"reminder_sent_at": now, "updated_at": now}},
+                projection={"_id": 0, "id": 1, "patient_id": 1, "title": 1, "due_date": 1}
+            )
+            if task:
+                notifications.append({
+                    "id": str(uuid.uuid4()),
+                    "patient_id": task["patient_id"],
+                    "type": "task_reminder",
+                    "task_id": task_id,
+                    "message": f"Recordatorio: la tarea \"{task['title']}\" vence el {task['due_date']:%d/%m/%Y %H:%M}",
+                    "read": False,
+                    "created_at": now
+                })
+        if notifications:
+            await self.db.notifications.insert_many(notifications)
+            self.stats["reminders"] += len(notifications)
+
+    async def _mark_overdue(self, task_ids: List[str], now: datetime):
+        result = await self.db.tasks.update_many(
+            {"id": {"$in": task_ids}, "status": {"$in": OPEN_TASK_STATUSES}, "due_date": {"$lte": now}},
+            {"$set": {"status": OVERDUE_STATUS, "overdue_at": now, "updated_at": now}}
+        )
+        self.stats["overdue"] += result.modified_count
+
+    async def run(self):
+        """Bucle del heap: recarga el horizonte y dispara los eventos vencidos"""
+        while True:
+            try:
+                now = datetime.utcnow()
+                if self._loaded_until is None or now >= self._next_reload():
+                    await self._load_horizon(now)
+                due = self._pop_due(now)
+                if due[REMINDER]:
+                    await self._send_reminders(due[REMINDER], now)
+                if due[OVERDUE]:
+                    await self._mark_overdue(due[OVERDUE], now)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in task scheduler: {e}")
+
+            self._wakeup.clear()
+            if self._loaded_until is None:
+                delay = 60.0  # La carga falló; se reintenta
+            else:
+                next_event = min(self._heap[0][0], self._next_reload()) if self._heap else self._next_reload()
+                delay = (next_event - datetime.utcnow()).total_seconds()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(delay, 1.0))
+            except asyncio.TimeoutError:
+                pass
+
+    # -- Feedback de IA en lotes ------------------------------------------
+
+    def enqueue_feedback(self, task_id: str):
+        if task_id not in self._feedback_pending:
+            self._feedback_pending.add(task_id)
+            self._feedback_queue.put_nowait(task_id)
+
+    async def _next_batch(self) -> List[str]:
+        """Espera una tarea y agrupa las que lleguen durante la ventana de batching"""
+        batch = [await self._feedback_queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + FEEDBACK_BATCH_WAIT_SECONDS
+        while len(batch) < FEEDBACK_BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._feedback_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _process_feedback(self, task_ids: List[str]):
+        tasks = await self.db.tasks.find(
+            {"id": {"$in": task_ids}, "ai_feedback_pending": True},
+            {
+                "_id": 0, "id": 1, "patient_id": 1, "professional_id": 1, "title": 1, "description": 1,
+                "task_type": 1, "completion_notes": 1, "ai_feedback_attempts": 1
+            }
+        ).to_list(len(task_ids))
+        if not tasks:
+            return
+        try:
+            feedback = await self.generate_feedback(tasks)
+        except Exception as e:
+            logger.error(f"Error generating task feedback: {e}")
+            feedback = {}
+        now = datetime.utcnow()
+        for task in tasks:
+            text = feedback.get(task["id"])
+            if text:
+                await self.db.tasks.update_one(
+                    {"id": task["id"]},
+                    {
+                        "$set": {"ai_feedback": text, "updated_at": now},
+                        "$unset": {"ai_feedback_pending": "", "ai_feedback_attempts": "", "ai_feedback_retry_at": ""}
+                    }
+                )
+            else:
+                await self._feedback_failed(task, now)
+        self.stats["feedback_batches"] += 1
+        self.stats["feedback_tasks"] += len(tasks)
+
+    async def _feedback_failed(self, task: Dict[str, Any], now: datetime):
+        """Programa el siguiente intento con espera exponencial o, agotados, deja la tarea marcada como fallida"""
+        attempts = task.get("ai_feedback_attempts", 0) + 1
+        if attempts >= FEEDBACK_MAX_ATTEMPTS:
+            update = {
+                "$set": {"ai_feedback_failed": True, "updated_at": now},
+                "$unset": {"ai_feedback_pending": "", "ai_feedback_retry_at": ""},
+                "$inc": {"ai_feedback_attempts": 1}
+            }
+            self.stats["feedback_failed"] += 1
+        else:
+            retry_at = now + timedelta(minutes=FEEDBACK_RETRY_BASE_MINUTES * 2 ** (attempts - 1))
+            update = {"$set": {"ai_feedback_retry_at": retry_at}, "$inc": {"ai_feedback_attempts": 1}}
+        await self.db.tasks.update_one({"id": task["id"], "ai_feedback_pending": True}, update)
+
+    async def feedback_worker(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._process_feedback(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Las tareas siguen marcadas en Mongo; el barrido las reencola
+                logger.error(f"Error generating task feedback: {e}")
+            finally:
+                self._feedback_pending.difference_update(batch)
+
+    async def _sweep_feedback(self) -> Dict[str, int]:
+        # Las completadas hace poco ya están en la cola del worker que las recibió
+        now = datetime.utcnow()
+        cutoff = now - timedelta(minutes=FEEDBACK_SWEEP_MINUTES)
+        cursor = self.db.tasks.find(
+            {
+                "ai_feedback_pending": True,
+                "completed_at": {"$lt": cutoff},
+                # Las que fallaron esperan a su siguiente intento
+                "$or": [{"ai_feedback_retry_at": None}, {"ai_feedback_retry_at": {"$lte": now}}]
+            },
+            {"_id": 0, "id": 1}
+        ).limit(FEEDBACK_SWEEP_LIMIT)
+        requeued = 0
+        async for task in cursor:
+            self.enqueue_feedback(task["id"])
+            requeued += 1
+        return {"requeued": requeued}
+
+    async def feedback_sweep(self):
+        """Reencola periódicamente las tareas que quedaron sin feedback (p. ej. tras un reinicio)"""
+        interval = timedelta(minutes=FEEDBACK_SWEEP_MINUTES)
+        await run_periodic(self.db, "task_feedback_sweep", interval, self._sweep_feedback)
+
+
+async def ensure_task_indexes(db):
+    """Índices para cargar solo el horizonte próximo y las tareas pendientes de feedback"""
+    await db.tasks.create_index([("status", ASCENDING), ("due_date", ASCENDING)])
+    await db.tasks.create_index(
+        [("ai_feedback_pending", ASCENDING)],
+        partialFilterExpression={"ai_feedback_pending": True}
+    )
+    await db.notifications.create_index([("patient_id", ASCENDING), ("created_at", ASCENDING)])
@@ -0,0 +1,283 @@
+"""
+Partición de datos por institución (tenant).
+
+Las instituciones listadas en `TENANT_DATABASES` tienen su propia base de
+datos (`<DB_NAME>_<slug>`) con todas sus colecciones: usuarios, profesionales,
+pacientes, chat, sesiones, tareas... Así los recorridos del historial, las
+analíticas y los trabajos periódicos de una clínica grande no compiten con
+los del resto. Las demás instituciones siguen en la base compartida.
+
+- `tenant_directory` (en la base compartida) guarda a qué tenant pertenece
+  cada profesional, paciente y email de usuario de las bases dedicadas; la
+  ausencia de entrada significa base compartida.
+- `TenantMiddleware` resuelve el tenant de cada petición: por el profesional
+  o paciente de la ruta, por la sesión o tarea de la ruta o, si no, por la
+  cabecera `X-Institution`.
+- `TenantDatabase` es el `db` que usan los handlers: delega en la base del
+  tenant de la petición en curso.
+- Los trabajos en segundo plano se ejecutan una vez por base de datos.
+
+`python tenancy.py migrate "<institución>" [--delete]` copia los datos de una
+institución de la base compartida a su base dedicada y registra sus
+entidades en el directorio.
+"""
+
+import asyncio
+import os
+import re
+import sys
+from contextvars import ContextVar
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import ASCENDING, ReplaceOne
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from entity_cache import TtlLru
+from read_routing import stale_read_db
+from search import fold
+from single_flight import single_flight
+from storage_codec import ids_filter
+
+DEFAULT_TENANT = "default"
+TENANT_HEADER = "x-institution"
+DIRECTORY_TTL_SECONDS = float(os.environ.get("TENANT_DIRECTORY_TTL_SECONDS", "60"))
+DIRECTORY_MAX_ENTRIES = int(os.environ.get("TENANT_DIRECTORY_MAX_ENTRIES", "100000"))
+MIGRATION_BATCH_SIZE = 1000
+
+current_tenant: ContextVar[str] = ContextVar("current_tenant", default=DEFAULT_TENANT)
+
+
+def tenant_slug(institution: str) -> str:
+    """'Clínica San Rafael' -> 'clinica_san_rafael'"""
+    return re.sub(r"[^a-z0-9]+", "_", fold(institution).replace("ñ", "n")).strip("_")
+
+
+def configured_tenants() -> List[str]:
+    return [tenant_slug(name) for name in os.environ.get("TENANT_DATABASES", "").split(",") if name.strip()]
+
+
+class TenantRouter:
+    """Base de datos de cada tenant y directorio de entidades"""
+
+    def __init__(self, client, db_name: str, tenants: Iterable[str] = ()):
+        self.shared = client[db_name]
+        self._databases = {DEFAULT_TENANT: self.shared}
+        for tenant in tenants:
+            self._databases[tenant] = client[f"{db_name}_{tenant}"]
+        self._stale = {tenant: stale_read_db(database) for tenant, database in self._databases.items()}
+        # clave del directorio -> tenant (profesionales, pacientes, emails, sesiones, tareas)
+        self._directory = TtlLru(DIRECTORY_TTL_SECONDS, DIRECTORY_MAX_ENTRIES)
+
+    @property
+    def tenants(self) -> List[str]:
+        return list(self._databases)
+
+    def is_dedicated(self, tenant: str) -> bool:
+        return tenant != DEFAULT_TENANT and tenant in self._databases
+
+    def database(self, tenant: str, stale: bool = False):
+        return (self._stale if stale else self._databases)[tenant]
+
+    def databases(self) -> Dict[str, Any]:
+        return dict(self._databases)
+
+    def tenant_of_institution(self, institution: Optional[str]) -> str:
+        tenant = tenant_slug(institution) if institution else DEFAULT_TENANT
+        return tenant if self.is_dedicated(tenant) else DEFAULT_TENANT
+
+    async def _lookup(self, key: str) -> str:
+        cached = self._directory.get(key)
+        if cached is not None:
+            return cached
+        doc = await single_flight("tenant_directory").do(
+            key, lambda: self.shared.tenant_directory.find_one({"_id": key})
+        )
+        tenant = doc["tenant"] if doc and doc["tenant"] in self._databases else DEFAULT_TENANT
+        self._directory.set(key, tenant)
+        return tenant
+
+    async def tenant_of(self, kind: str, entity_id: str) -> str:
+        """Tenant de un profesional, paciente o usuario (`kind` = professional/patient/user)"""
+        if len(self._databases) == 1:
+            return DEFAULT_TENANT
+        return await self._lookup(f"{kind}:{entity_id}")
+
+    async def locate(self, collection: str, doc_id: str) -> str:
+        """Tenant que contiene el documento `id` de una colección sin entrada en el directorio"""
+        key = f"{collection}:{doc_id}"
+        cached = self._directory.get(key)
+        if cached is not None:
+            return cached
+        dedicated = [t for t in self._databases if t != DEFAULT_TENANT]
+        found = await asyncio.gather(*(
+            self._databases[t][collection].find_one({"id": doc_id}, {"_id": 1}) for t in dedicated
+        ))
+        tenant = next((t for t, doc in zip(dedicated, found) if doc), DEFAULT_TENANT)
+        self._directory.set(key, tenant)
+        return tenant
+
+    async def register(self, tenant: str, entries: Iterable[Tuple[str, str]]):
+        """Apunta (kind, id) en el directorio; las entidades de la base compartida no se registran"""
+        if not self.is_dedicated(tenant):
+            return
+        keys = [f"{kind}:{entity_id}" for kind, entity_id in entries]
+        if keys:
+            await self.shared.tenant_directory.bulk_write(
+                [ReplaceOne({"_id": key}, {"tenant": tenant}, upsert=True) for key in keys], ordered=False
+            )
+        for key in keys:
+            self._directory.set(key, tenant)
+
+
+class TenantDatabase:
+    """Base de datos del tenant de la petición en curso"""
+
+    def __init__(self, router: TenantRouter, stale: bool = False):
+        self._router = router
+        self._stale = stale
+
+    def _current(self):
+        return self._router.database(current_tenant.get(), self._stale)
+
+    def __getattr__(self, name: str):
+        return getattr(self._current(), name)
+
+    def __getitem__(self, name: str):
+        return self._current()[name]
+
+
+# (regex de ruta, tipo de entidad del directorio o colección a localizar)
+TENANT_ROUTES = [
+    (re.compile(r"^/api/professionals/([^/]+)"), "professional"),
+    (re.compile(r"^/api/patients/([^/]+)"), "patient"),
+    (re.compile(r"^/api/chat/([^/]+)/"), "patient"),
+    (re.compile(r"^/api/sessions/([^/]+)"), "sessions"),
+    (re.compile(r"^/api/tasks/([^/]+)"), "tasks"),
+]
+LOCATED_COLLECTIONS = {"sessions", "tasks"}
+
+
+class TenantMiddleware:
+    """Fija `current_tenant` para toda la petición"""
+
+    def __init__(self, app: ASGIApp, router_getter):
+        self.app = app
+        self.router_getter = router_getter
+
+    async def resolve(self, router: TenantRouter, scope: Scope) -> str:
+        path = scope["path"]
+        for pattern, kind in TENANT_ROUTES:
+            match = pattern.match(path)
+            if match:
+                # La entidad de la ruta manda sobre la cabecera
+                if kind in LOCATED_COLLECTIONS:
+                    return await router.locate(kind, match.group(1))
+                return await router.tenant_of(kind, match.group(1))
+        return router.tenant_of_institution(Headers(scope=scope).get(TENANT_HEADER))
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        router = self.router_getter()
+        if scope["type"] != "http" or router is None or len(router.tenants) == 1:
+            await self.app(scope, receive, send)
+            return
+        token = current_tenant.set(await self.resolve(router, scope))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_tenant.reset(token)
+
+
+async def ensure_tenant_indexes(db):
+    """Búsquedas por `id` de sesiones y tareas al localizar su tenant"""
+    await db.sessions.create_index([("id", ASCENDING)])
+    await db.tasks.create_index([("id", ASCENDING)])
+
+
+# =============================================================================
+# MIGRACIÓN
+# =============================================================================
+
+async def _copy(source, target, collection: str, query: Dict[str, Any]) -> int:
+    copied = 0
+    batch = []
+    async for doc in source[collection].find(query):
+        batch.append(ReplaceOne({"_id": doc["_id"]}, doc, upsert=True))
+        if len(batch) >= MIGRATION_BATCH_SIZE:
+            await target[collection].bulk_write(batch, ordered=False)
+            copied += len(batch)
+            batch = []
+    if batch:
+        await target[collection].bulk_write(batch, ordered=False)
+        copied += len(batch)
+    if await target[collection].count_documents(query) < copied:
+        raise RuntimeError(f"Copia incompleta de {collection}")
+    return copied
+
+
+async def migrate_institution(router: TenantRouter, institution: str, delete: bool = False) -> Dict[str, int]:
+    """
+    Copia una institución de la base compartida a su base dedicada.
+
+    Es idempotente (reemplaza por `_id`). Los datos se copian antes de
+    registrar el directorio, así que las peticiones siguen leyendo de la base
+    compartida hasta que todo está copiado; con `delete` se borran del origen
+    al final. Conviene ejecutarla con poco tráfico: lo escrito durante la
+    copia se recoge repitiéndola.
+    """
+    tenant = tenant_slug(institution)
+    if not router.is_dedicated(tenant):
+        raise ValueError(f"{tenant} no está en TENANT_DATABASES")
+    source, target = router.shared, router.database(tenant)
+
+    professionals = await source.professionals.find({"institution": institution}, {"id": 1, "user_id": 1}).to_list(None)
+    professional_ids = [p["id"] for p in professionals]
+    patients = await source.patients.find({"professional_id": {"$in": professional_ids}}, {"id": 1, "user_id": 1}).to_list(None)
+    patient_ids = [p["id"] for p in patients]
+    user_ids = [p["user_id"] for p in professionals + patients]
+    users = await source.users.find({"id": {"$in": user_ids}}, {"email": 1}).to_list(None)
+
+    by_professional = {"professional_id": {"$in": professional_ids}}
+    by_patient = {"patient_id": {"$in": patient_ids}}
+    by_patient_chat = {"patient_id": ids_filter(patient_ids)}
+    plan = [
+        ("sessions", by_professional),
+        ("session_vectors", by_professional),
+        ("tasks", by_patient),
+        ("chat_messages", by_patient_chat),
+        ("chat_archive", by_patient_chat),
+        ("notifications", by_patient),
+        ("users", {"id": {"$in": user_ids}}),
+        ("patients", {"id": {"$in": patient_ids}}),
+        ("professionals", {"id": {"$in": professional_ids}}),
+    ]
+    copied = {collection: await _copy(source, target, collection, query) for collection, query in plan}
+
+    await router.register(tenant, [
+        *(("professional", i) for i in professional_ids),
+        *(("patient", i) for i in patient_ids),
+        *(("user", u["email"]) for u in users),
+    ])
+    if delete:
+        for collection, query in plan:
+            await source[collection].delete_many(query)
+    return copied
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+    if len(sys.argv) < 3 or sys.argv[1] != "migrate":
+        sys.exit('uso: python tenancy.py migrate "<institución>" [--delete]')
+
+    async def main():
+        client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+        router = TenantRouter(client, os.environ["DB_NAME"], configured_tenants())
+        copied = await migrate_institution(router, sys.argv[2], delete="--delete" in sys.argv)
+        for collection, count in copied.items():
+            print(f"{collection}: {count} documentos")
+        client.close()
+
+    asyncio.run(main())